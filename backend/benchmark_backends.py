@@ -0,0 +1,87 @@
+import os
+import copy
+import time
+import argparse
+import numpy as np
+import torch
+import open_clip
+from PIL import Image
+
+from clip_backend import BACKENDS, IMAGE_RESOLUTION, build_backend
+
+SAMPLE_TEXTS = [
+    "Giày sneaker Nike Air Force 1",
+    "Tai nghe không dây Sony WF-1000XM5",
+    "Nồi chiên không dầu Philips HD9650",
+    "Laptop Apple MacBook Air M2 13 inch",
+    "Son môi MAC Matte Lipstick màu Ruby Woo",
+    "Balo leo núi The North Face Borealis",
+    "Máy chơi game Sony PlayStation 5",
+    "Kem chống nắng La Roche-Posay Anthelios SPF 50",
+]
+
+
+def load_images(image_dir, preprocess, count):
+    """Ảnh mẫu từ thư mục (nếu có), ngược lại dùng tensor ngẫu nhiên"""
+    if image_dir and os.path.isdir(image_dir):
+        files = sorted(f for f in os.listdir(image_dir) if f.lower().endswith((".jpg", ".jpeg", ".png")))[:count]
+        if files:
+            return [preprocess(Image.open(os.path.join(image_dir, f)).convert("RGB")) for f in files]
+    return [torch.randn(3, IMAGE_RESOLUTION, IMAGE_RESOLUTION) for _ in range(count)]
+
+
+def encode_all(model, images, tokens):
+    """Encode từng mẫu (batch 1, giống một query), trả về embedding và latency trung bình (ms)"""
+    image_vecs, text_vecs = [], []
+    image_times, text_times = [], []
+    with torch.no_grad():
+        for image in images:
+            start = time.perf_counter()
+            image_vecs.append(model.encode_image(image.unsqueeze(0)).float().numpy()[0])
+            image_times.append(time.perf_counter() - start)
+        for row in tokens:
+            start = time.perf_counter()
+            text_vecs.append(model.encode_text(row.unsqueeze(0)).float().numpy()[0])
+            text_times.append(time.perf_counter() - start)
+    return np.array(image_vecs), np.array(text_vecs), np.mean(image_times) * 1000, np.mean(text_times) * 1000
+
+
+def cosine_drift(reference, candidate):
+    ref = reference / np.linalg.norm(reference, axis=1, keepdims=True)
+    cand = candidate / np.linalg.norm(candidate, axis=1, keepdims=True)
+    cos = np.sum(ref * cand, axis=1)
+    return float(cos.mean()), float(cos.min())
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Báo cáo độ chính xác (cosine so với fp32) và latency của các backend CLIP")
+    parser.add_argument("--model", default="ViT-L-14-336")
+    parser.add_argument("--backends", default=",".join(b for b in BACKENDS if b != "fp32"))
+    parser.add_argument("--images", default=None, help="Thư mục ảnh mẫu")
+    parser.add_argument("--samples", type=int, default=8)
+    args = parser.parse_args()
+
+    reference, _, preprocess = open_clip.create_model_and_transforms(
+        model_name=args.model, pretrained="openai", image_resolution=IMAGE_RESOLUTION
+    )
+    reference.eval()
+    tokenizer = open_clip.get_tokenizer(args.model)
+    images = load_images(args.images, preprocess, args.samples)
+    tokens = tokenizer((SAMPLE_TEXTS * args.samples)[:args.samples])
+
+    encode_all(reference, images[:1], tokens[:1])  # warmup
+    ref_img, ref_txt, ref_img_ms, ref_txt_ms = encode_all(reference, images, tokens)
+
+    print(f"{'backend':<12} | {'image ms':>9} | {'text ms':>8} | {'img cos mean/min':>18} | {'txt cos mean/min':>18}")
+    print(f"{'fp32':<12} | {ref_img_ms:9.1f} | {ref_txt_ms:8.1f} | {'1.0000 / 1.0000':>18} | {'1.0000 / 1.0000':>18}")
+    for backend in args.backends.split(","):
+        try:
+            model = build_backend(copy.deepcopy(reference), args.model, backend)
+            encode_all(model, images[:1], tokens[:1])  # warmup
+            img, txt, img_ms, txt_ms = encode_all(model, images, tokens)
+        except Exception as e:
+            print(f"{backend:<12} | ❌ {e}")
+            continue
+        img_mean, img_min = cosine_drift(ref_img, img)
+        txt_mean, txt_min = cosine_drift(ref_txt, txt)
+        print(f"{backend:<12} | {img_ms:9.1f} | {txt_ms:8.1f} | {img_mean:8.4f} / {img_min:.4f} | {txt_mean:8.4f} / {txt_min:.4f}")
@@ -0,0 +1,67 @@
+import time
+import argparse
+import threading
+import numpy as np
+import torch
+
+from model_loader import load_model, device, ready, status
+from encoder_scheduler import MicroBatchEncoder
+
+
+def run_load(encode_fn, num_requests, concurrency):
+    """Bắn num_requests request encode ảnh từ `concurrency` luồng, trả về (thời gian, danh sách latency)"""
+    latencies = []
+    lock = threading.Lock()
+    counter = iter(range(num_requests))
+    image = torch.randn(3, 336, 336)
+
+    def client():
+        while True:
+            with lock:
+                if next(counter, None) is None:
+                    return
+            start = time.perf_counter()
+            encode_fn(image)
+            elapsed = time.perf_counter() - start
+            with lock:
+                latencies.append(elapsed)
+
+    threads = [threading.Thread(target=client) for _ in range(concurrency)]
+    start = time.perf_counter()
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    return time.perf_counter() - start, latencies
+
+
+def encode_unbatched(image):
+    with torch.no_grad():
+        return model.encode_image(image.unsqueeze(0).to(device)).cpu().numpy()[0]
+
+
+def report(name, total_time, latencies):
+    lat_ms = np.array(latencies) * 1000
+    print(f"{name:<10} | {len(latencies) / total_time:8.2f} req/s | "
+          f"p50 {np.percentile(lat_ms, 50):8.1f} ms | p99 {np.percentile(lat_ms, 99):8.1f} ms")
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="So sánh throughput encode ảnh có / không gom batch")
+    parser.add_argument("--requests", type=int, default=64)
+    parser.add_argument("--concurrency", type=int, default=16)
+    parser.add_argument("--max-batch-size", type=int, default=16)
+    parser.add_argument("--max-wait-ms", type=float, default=5)
+    args = parser.parse_args()
+
+    # load_model đã chạy warmup nên không tính thời gian khởi tạo kernel
+    model = load_model()
+    if not ready.is_set():
+        raise SystemExit(f"❌ Không load được mô hình: {status.get('error')}")
+
+    print(f"🔍 {args.requests} request, {args.concurrency} client đồng thời, device={device}")
+    report("unbatched", *run_load(encode_unbatched, args.requests, args.concurrency))
+
+    encoder = MicroBatchEncoder(model, device, args.max_batch_size, args.max_wait_ms)
+    report("batched", *run_load(encoder.encode_image, args.requests, args.concurrency))
+    print(f"📊 Batch: {encoder.stats}")
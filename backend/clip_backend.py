@@ -0,0 +1,201 @@
+import os
+import time
+import torch
+import open_clip
+
+# Backend suy luận cho OpenCLIP: fp32 | int8 | bf16 | torchscript | onnx
+CLIP_BACKEND = os.getenv("CLIP_BACKEND", "fp32")
+CLIP_ARTIFACT_DIR = os.getenv("CLIP_ARTIFACT_DIR", "artifacts")
+# Lưu / load mô hình đã serialize trong CLIP_ARTIFACT_DIR thay vì dựng lại và tải từ mạng mỗi lần khởi động
+CLIP_MODEL_CACHE = os.getenv("CLIP_MODEL_CACHE", "1") == "1"
+BACKENDS = ("fp32", "int8", "bf16", "torchscript", "onnx")
+
+IMAGE_RESOLUTION = 336
+CONTEXT_LENGTH = 77
+
+
+class ImageTower(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, image):
+        return self.model.encode_image(image)
+
+
+class TextTower(torch.nn.Module):
+    def __init__(self, model):
+        super().__init__()
+        self.model = model
+
+    def forward(self, tokens):
+        return self.model.encode_text(tokens)
+
+
+class CastModel:
+    """Chạy mô hình ở dtype thấp hơn (bf16), trả về đặc trưng float32"""
+
+    def __init__(self, model, dtype):
+        self.model = model.to(dtype)
+        self.dtype = dtype
+
+    def encode_image(self, image):
+        return self.model.encode_image(image.to(self.dtype)).float()
+
+    def encode_text(self, tokens):
+        return self.model.encode_text(tokens).float()
+
+
+class TracedTowers:
+    """Hai tower ảnh / text đã export TorchScript, cùng giao diện encode_* với mô hình gốc"""
+
+    def __init__(self, image_tower, text_tower):
+        self.image_tower = image_tower
+        self.text_tower = text_tower
+
+    def encode_image(self, image):
+        return self.image_tower(image)
+
+    def encode_text(self, tokens):
+        return self.text_tower(tokens)
+
+
+class OnnxTowers:
+    """Hai tower ảnh / text chạy bằng onnxruntime trên CPU"""
+
+    def __init__(self, image_path, text_path):
+        try:
+            import onnxruntime as ort
+        except ImportError:
+            raise RuntimeError("❌ CLIP_BACKEND=onnx cần cài đặt onnxruntime")
+        options = ort.SessionOptions()
+        options.graph_optimization_level = ort.GraphOptimizationLevel.ORT_ENABLE_ALL
+        providers = ["CPUExecutionProvider"]
+        self.image_session = ort.InferenceSession(image_path, options, providers=providers)
+        self.text_session = ort.InferenceSession(text_path, options, providers=providers)
+
+    def encode_image(self, image):
+        out = self.image_session.run(None, {"image": image.cpu().numpy()})[0]
+        return torch.from_numpy(out)
+
+    def encode_text(self, tokens):
+        out = self.text_session.run(None, {"tokens": tokens.cpu().numpy()})[0]
+        return torch.from_numpy(out)
+
+
+def example_inputs():
+    image = torch.randn(1, 3, IMAGE_RESOLUTION, IMAGE_RESOLUTION)
+    tokens = torch.zeros(1, CONTEXT_LENGTH, dtype=torch.long)
+    tokens[0, 0], tokens[0, 1] = 49406, 49407  # <start_of_text>, <end_of_text>
+    return image, tokens
+
+
+def artifact_path(model_name, tower, ext):
+    return os.path.join(CLIP_ARTIFACT_DIR, f"{model_name}_{tower}.{ext}")
+
+
+def export_torchscript(model, model_name):
+    image, tokens = example_inputs()
+    os.makedirs(CLIP_ARTIFACT_DIR, exist_ok=True)
+    with torch.no_grad():
+        for tower, module, example in (("image", ImageTower(model), image), ("text", TextTower(model), tokens)):
+            traced = torch.jit.trace(module.eval(), example, check_trace=False)
+            traced.save(artifact_path(model_name, tower, "pt"))
+
+
+def export_onnx(model, model_name):
+    image, tokens = example_inputs()
+    os.makedirs(CLIP_ARTIFACT_DIR, exist_ok=True)
+    with torch.no_grad():
+        for tower, module, example, input_name in (
+            ("image", ImageTower(model), image, "image"),
+            ("text", TextTower(model), tokens, "tokens"),
+        ):
+            torch.onnx.export(
+                module.eval(), (example,), artifact_path(model_name, tower, "onnx"),
+                input_names=[input_name], output_names=["features"],
+                dynamic_axes={input_name: {0: "batch"}, "features": {0: "batch"}},
+                opset_version=17,
+            )
+
+
+def build_backend(model, model_name, backend):
+    """Chuyển mô hình fp32 đã load sang backend được chọn"""
+    if backend == "fp32":
+        return model
+    if backend == "int8":
+        # Lượng tử hóa động int8 cho các lớp Linear (phần lớn FLOPs của ViT và text transformer)
+        return torch.ao.quantization.quantize_dynamic(model, {torch.nn.Linear}, dtype=torch.qint8)
+    if backend == "bf16":
+        return CastModel(model, torch.bfloat16)
+    if backend == "torchscript":
+        paths = [artifact_path(model_name, t, "pt") for t in ("image", "text")]
+        if not all(os.path.exists(p) for p in paths):
+            print(f"📦 Export TorchScript cho {model_name} vào {CLIP_ARTIFACT_DIR}...")
+            export_torchscript(model, model_name)
+        return TracedTowers(*[torch.jit.optimize_for_inference(torch.jit.load(p).eval()) for p in paths])
+    if backend == "onnx":
+        paths = [artifact_path(model_name, t, "onnx") for t in ("image", "text")]
+        if not all(os.path.exists(p) for p in paths):
+            print(f"📦 Export ONNX cho {model_name} vào {CLIP_ARTIFACT_DIR}...")
+            export_onnx(model, model_name)
+        return OnnxTowers(*paths)
+    raise ValueError(f"CLIP_BACKEND không hợp lệ: {backend} (hỗ trợ: {', '.join(BACKENDS)})")
+
+
+def cached_model_path(model_name, pretrained):
+    # Gắn version open_clip vào tên file vì artifact pickle cả class của mô hình
+    return artifact_path(model_name, f"{pretrained}_open_clip{open_clip.__version__}", "pt")
+
+
+def load_cached_model(path):
+    """Load mô hình đã serialize, dùng mmap để không phải đọc toàn bộ vài GB trọng số vào RAM ngay"""
+    try:
+        return torch.load(path, map_location="cpu", mmap=True, weights_only=False)
+    except TypeError:
+        # torch < 2.1 chưa hỗ trợ mmap
+        return torch.load(path, map_location="cpu")
+
+
+def load_fp32_model(model_name, pretrained, use_cache=CLIP_MODEL_CACHE):
+    """Load mô hình fp32 từ artifact trên đĩa nếu có, ngược lại tạo bằng open_clip và lưu artifact"""
+    path = cached_model_path(model_name, pretrained)
+    if use_cache and os.path.exists(path):
+        start = time.time()
+        model = load_cached_model(path)
+        preprocess = open_clip.image_transform(
+            IMAGE_RESOLUTION, is_train=False,
+            mean=open_clip.OPENAI_DATASET_MEAN, std=open_clip.OPENAI_DATASET_STD
+        )
+        print(f"📦 Load mô hình từ artifact {path} trong {time.time() - start:.1f}s")
+        return model, preprocess
+
+    model, _, preprocess = open_clip.create_model_and_transforms(
+        model_name=model_name, pretrained=pretrained, image_resolution=IMAGE_RESOLUTION
+    )
+    if use_cache:
+        try:
+            os.makedirs(CLIP_ARTIFACT_DIR, exist_ok=True)
+            tmp_path = f"{path}.{os.getpid()}.tmp"
+            torch.save(model, tmp_path)
+            os.replace(tmp_path, path)
+            print(f"📦 Đã lưu artifact mô hình vào {path}")
+        except Exception as e:
+            print(f"⚠️ Không lưu được artifact mô hình: {e}")
+    return model, preprocess
+
+
+def load_clip(model_name="ViT-L-14-336", pretrained="openai", device="cpu", backend=CLIP_BACKEND):
+    """Load OpenCLIP và trả về (model, preprocess, tokenizer) theo backend đã chọn"""
+    model, preprocess = load_fp32_model(model_name, pretrained)
+    tokenizer = open_clip.get_tokenizer(model_name)
+    model.to(device)
+    model.eval()
+    if backend != "fp32" and device != "cpu":
+        print(f"⚠️ Backend {backend} chỉ dành cho CPU, dùng fp32 trên {device}")
+        backend = "fp32"
+    start = time.time()
+    model = build_backend(model, model_name, backend)
+    if backend != "fp32":
+        print(f"⚙️ Backend {backend} sẵn sàng sau {time.time() - start:.1f}s")
+    return model, preprocess, tokenizer
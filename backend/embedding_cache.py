@@ -0,0 +1,185 @@
+import os
+import re
+import time
+import sqlite3
+import hashlib
+import threading
+import unicodedata
+from collections import OrderedDict
+
+import numpy as np
+
+from clip_backend import CLIP_BACKEND
+from image_preprocess import iter_chunks
+
+EMBED_CACHE_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_MAX_ENTRIES", "50000"))
+EMBED_CACHE_MAX_MB = float(os.getenv("EMBED_CACHE_MAX_MB", "256"))
+EMBED_CACHE_TTL = float(os.getenv("EMBED_CACHE_TTL", "86400"))
+# Đường dẫn file sqlite cho tầng đĩa (giữ cache qua các lần khởi động lại), bỏ trống để tắt
+EMBED_CACHE_DISK_PATH = os.getenv("EMBED_CACHE_DISK_PATH", "")
+# Số dòng tối đa của tầng đĩa; dòng cũ nhất và dòng hết TTL được xóa mỗi EMBED_CACHE_DISK_PRUNE_EVERY lần ghi
+EMBED_CACHE_DISK_MAX_ENTRIES = int(os.getenv("EMBED_CACHE_DISK_MAX_ENTRIES", "500000"))
+EMBED_CACHE_DISK_PRUNE_EVERY = int(os.getenv("EMBED_CACHE_DISK_PRUNE_EVERY", "1000"))
+
+# Vector của các backend khác nhau (int8, bf16...) không giống hệt nhau nên không dùng chung key
+KEY_PREFIX = f"ViT-L-14-336:{CLIP_BACKEND}"
+
+
+def text_key(text):
+    """Key cho query text: chuẩn hóa unicode, chữ thường, gộp khoảng trắng"""
+    normalized = unicodedata.normalize("NFC", text).lower()
+    normalized = re.sub(r"\s+", " ", normalized).strip()
+    return f"{KEY_PREFIX}:text:{normalized}"
+
+
+def image_key(fileobj):
+    """Key cho ảnh upload: hash nội dung file (đọc theo từng chunk)"""
+    digest = hashlib.sha256()
+    for chunk in iter_chunks(fileobj):
+        digest.update(chunk)
+    return f"{KEY_PREFIX}:image:{digest.hexdigest()}"
+
+
+class DiskTier:
+    """Tầng cache trên đĩa bằng sqlite, giới hạn số dòng và xóa dòng hết TTL.
+
+    Connection được mở lazily trong từng process: EmbeddingCache được tạo lúc import main.py, tức là ở master
+    khi chạy gunicorn preload_app, còn connection sqlite không được dùng qua fork."""
+
+    def __init__(self, path, ttl, max_entries=EMBED_CACHE_DISK_MAX_ENTRIES, prune_every=EMBED_CACHE_DISK_PRUNE_EVERY):
+        self.path = path
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.prune_every = prune_every
+        self.lock = threading.Lock()
+        self._conn = None
+        self._pid = None
+        self._puts = 0
+
+    def _connection(self):
+        if self._conn is None or self._pid != os.getpid():
+            conn = sqlite3.connect(self.path, check_same_thread=False)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute(
+                "CREATE TABLE IF NOT EXISTS embeddings (key TEXT PRIMARY KEY, vector BLOB, created REAL)"
+            )
+            conn.commit()
+            self._conn, self._pid, self._puts = conn, os.getpid(), 0
+        return self._conn
+
+    def get(self, key):
+        with self.lock:
+            row = self._connection().execute(
+                "SELECT vector, created FROM embeddings WHERE key = ?", (key,)
+            ).fetchone()
+        if row is None or time.time() - row[1] > self.ttl:
+            return None
+        return np.frombuffer(row[0], dtype=np.float32).copy()
+
+    def put(self, key, vector, created):
+        with self.lock:
+            conn = self._connection()
+            conn.execute(
+                "INSERT OR REPLACE INTO embeddings (key, vector, created) VALUES (?, ?, ?)",
+                (key, vector.astype(np.float32).tobytes(), created),
+            )
+            if self._puts % self.prune_every == 0:
+                self._prune(conn)
+            self._puts += 1
+            conn.commit()
+
+    def _prune(self, conn):
+        conn.execute("DELETE FROM embeddings WHERE created < ?", (time.time() - self.ttl,))
+        # INSERT OR REPLACE cấp rowid mới nên rowid nhỏ nhất là dòng ghi lâu nhất
+        conn.execute(
+            "DELETE FROM embeddings WHERE rowid <= (SELECT MAX(rowid) FROM embeddings) - ?", (self.max_entries,)
+        )
+
+
+class EmbeddingCache:
+    """Cache LRU + TTL cho embedding query, giới hạn theo số entry và dung lượng"""
+
+    def __init__(self, max_entries=EMBED_CACHE_MAX_ENTRIES, max_mb=EMBED_CACHE_MAX_MB,
+                 ttl=EMBED_CACHE_TTL, disk_path=EMBED_CACHE_DISK_PATH):
+        self.max_entries = max_entries
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.ttl = ttl
+        self.disk = DiskTier(disk_path, ttl) if disk_path else None
+        self._data = OrderedDict()
+        self._bytes = 0
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "misses": 0, "evictions": 0}
+
+    def get(self, key):
+        vector = self.get_memory(key)
+        if vector is None and self.disk is not None:
+            vector = self.get_disk(key)
+        return vector
+
+    def get_memory(self, key):
+        """Chỉ tra tầng RAM (không I/O, gọi được trên event loop). Không có tầng đĩa thì trượt ở đây là miss"""
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                vector, created = entry
+                if time.time() - created <= self.ttl:
+                    self._data.move_to_end(key)
+                    self.stats["hits"] += 1
+                    return vector
+                self._remove(key)
+            if self.disk is None:
+                self.stats["misses"] += 1
+        return None
+
+    def get_disk(self, key):
+        """Tra tầng đĩa (SQLite, blocking) sau khi get_memory trượt; trúng thì đưa lên RAM"""
+        vector = self.disk.get(key)
+        with self._lock:
+            self.stats["disk_hits" if vector is not None else "misses"] += 1
+        if vector is not None:
+            self._put_memory(key, vector, time.time())
+        return vector
+
+    def put(self, key, vector):
+        created = self.put_memory(key, vector)
+        if self.disk is not None:
+            self.put_disk(key, vector, created)
+
+    def put_memory(self, key, vector):
+        """Ghi tầng RAM, trả về thời điểm tạo để put_disk dùng cùng TTL"""
+        created = time.time()
+        self._put_memory(key, vector, created)
+        return created
+
+    def put_disk(self, key, vector, created):
+        """Ghi tầng đĩa (SQLite, blocking)"""
+        self.disk.put(key, vector, created)
+
+    def _put_memory(self, key, vector, created):
+        if vector.base is not None:
+            # View vào mảng lớn hơn (vd. một dòng của batch) giữ cả mảng gốc, nbytes sẽ tính thiếu
+            vector = vector.copy()
+        with self._lock:
+            if key in self._data:
+                self._remove(key)
+            self._data[key] = (vector, created)
+            self._bytes += vector.nbytes
+            while self._data and (len(self._data) > self.max_entries or self._bytes > self.max_bytes):
+                oldest = next(iter(self._data))
+                self._remove(oldest)
+                self.stats["evictions"] += 1
+
+    def _remove(self, key):
+        vector, _ = self._data.pop(key)
+        self._bytes -= vector.nbytes
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["disk_hits"] + self.stats["misses"]
+            hit_rate = (self.stats["hits"] + self.stats["disk_hits"]) / lookups if lookups else 0.0
+            return {
+                **self.stats,
+                "hit_rate": round(hit_rate, 4),
+                "entries": len(self._data),
+                "bytes": self._bytes,
+            }
@@ -0,0 +1,103 @@
+import os
+import time
+import queue
+import threading
+from concurrent.futures import Future
+
+import torch
+
+# Tham số gom batch: chờ tối đa MAX_WAIT_MS hoặc đủ MAX_BATCH_SIZE request thì chạy
+MAX_BATCH_SIZE = int(os.getenv("ENCODER_MAX_BATCH_SIZE", "16"))
+MAX_WAIT_MS = float(os.getenv("ENCODER_MAX_WAIT_MS", "5"))
+
+
+class MicroBatchEncoder:
+    """Gom các request encode ảnh / text đang chờ thành một batch và chạy một lần forward"""
+
+    def __init__(self, model, device, max_batch_size=MAX_BATCH_SIZE, max_wait_ms=MAX_WAIT_MS):
+        self.model = model
+        self.device = device
+        self.max_batch_size = max(1, int(max_batch_size))
+        self.max_wait = max(0.0, float(max_wait_ms)) / 1000.0
+        self._queue = queue.Queue()
+        self._stats_lock = threading.Lock()
+        self.stats = {"requests": 0, "batches": 0, "max_batch": 0}
+        # Thread được tạo khi có request đầu tiên: an toàn khi tạo encoder trong master trước khi fork worker
+        self._thread = None
+        self._start_lock = threading.Lock()
+
+    def _ensure_started(self):
+        if self._thread is not None:
+            return
+        with self._start_lock:
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._run, name="encoder-scheduler", daemon=True)
+                self._thread.start()
+
+    def submit_image(self, image_tensor):
+        """Đưa một tensor ảnh đã preprocess (3, H, W) vào hàng đợi, trả về Future chứa vector float32"""
+        return self._submit("image", image_tensor)
+
+    def submit_text(self, tokens):
+        """Đưa token của một câu (1, 77) hoặc (77,) vào hàng đợi, trả về Future chứa vector float32"""
+        if tokens.dim() == 2:
+            tokens = tokens[0]
+        return self._submit("text", tokens)
+
+    def encode_image(self, image_tensor):
+        return self.submit_image(image_tensor).result()
+
+    def encode_text(self, tokens):
+        return self.submit_text(tokens).result()
+
+    def _submit(self, kind, tensor):
+        self._ensure_started()
+        future = Future()
+        self._queue.put((kind, tensor, future))
+        return future
+
+    def _collect(self):
+        # Chặn đến khi có request đầu tiên, sau đó gom thêm trong cửa sổ max_wait
+        batch = [self._queue.get()]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.max_batch_size:
+            remaining = deadline - time.monotonic()
+            try:
+                if remaining <= 0:
+                    batch.append(self._queue.get_nowait())
+                else:
+                    batch.append(self._queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+    def _run(self):
+        while True:
+            batch = self._collect()
+            for kind in ("image", "text"):
+                items = [(t, f) for k, t, f in batch if k == kind and f.set_running_or_notify_cancel()]
+                if items:
+                    self._encode(kind, items)
+
+    def _encode(self, kind, items):
+        try:
+            inputs = torch.stack([t for t, _ in items]).to(self.device)
+            with torch.no_grad():
+                if kind == "image":
+                    features = self.model.encode_image(inputs)
+                else:
+                    features = self.model.encode_text(inputs)
+            vectors = features.float().cpu().numpy().astype("float32")
+        except Exception as e:
+            for _, future in items:
+                future.set_exception(e)
+            return
+
+        for (_, future), vector in zip(items, vectors):
+            # copy: mỗi kết quả là mảng riêng, không giữ cả batch (B, D) sống theo một vector được cache
+            future.set_result(vector.copy())
+
+        with self._stats_lock:
+            self.stats["requests"] += len(items)
+            self.stats["batches"] += 1
+            self.stats["max_batch"] = max(self.stats["max_batch"], len(items))
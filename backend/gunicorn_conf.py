@@ -0,0 +1,28 @@
+import os
+import multiprocessing
+
+# Chạy nhiều worker uvicorn dùng chung một bản trọng số mô hình:
+#   gunicorn -c gunicorn_conf.py main:app
+# Master import main.py (preload_app) => model_loader.preload() load trọng số trước khi fork,
+# các worker kế thừa các trang bộ nhớ đó theo cơ chế copy-on-write. Kết nối Milvus, cache và các thread nền
+# không tồn tại qua fork nên được tạo trong lifespan của từng worker (xem main.py), không phải lúc import.
+os.environ.setdefault("MODEL_PRELOAD", "1")
+
+cpu_count = multiprocessing.cpu_count()
+workers = int(os.getenv("API_WORKERS", str(max(1, cpu_count // 4))))
+# Mặc định chia đều số core cho các worker để thread intra-op không tranh nhau
+torch_threads = int(os.getenv("WORKER_TORCH_THREADS", str(max(1, cpu_count // workers))))
+
+bind = os.getenv("API_BIND", "0.0.0.0:8000")
+worker_class = "uvicorn.workers.UvicornWorker"
+preload_app = True
+timeout = int(os.getenv("API_TIMEOUT", "120"))
+
+
+def post_fork(server, worker):
+    # Thư viện OpenMP / MKL đọc biến môi trường khi khởi tạo thread pool lần đầu trong worker
+    os.environ["OMP_NUM_THREADS"] = str(torch_threads)
+    os.environ["MKL_NUM_THREADS"] = str(torch_threads)
+    import model_loader
+    model_loader.configure_threads(torch_threads)
+    server.log.info(f"Worker {worker.pid}: {torch_threads} torch threads")
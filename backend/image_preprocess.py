@@ -0,0 +1,86 @@
+import os
+import numpy as np
+import torch
+from PIL import Image
+
+IMAGE_RESOLUTION = 336
+# Mean / std chuẩn hóa của OpenCLIP (pretrained="openai")
+OPENAI_MEAN = np.array([0.48145466, 0.4578275, 0.40821073], dtype=np.float32)
+OPENAI_STD = np.array([0.26862954, 0.26130258, 0.27577711], dtype=np.float32)
+
+MAX_IMAGE_BYTES = int(os.getenv("MAX_IMAGE_BYTES", str(20 * 1024 * 1024)))
+MAX_IMAGE_PIXELS = int(os.getenv("MAX_IMAGE_PIXELS", str(50_000_000)))
+# PIL cũng chặn decompression bomb ở mức này
+Image.MAX_IMAGE_PIXELS = MAX_IMAGE_PIXELS
+
+CHUNK_SIZE = 1024 * 1024
+
+
+class ImageTooLarge(ValueError):
+    pass
+
+
+class InvalidImage(ValueError):
+    pass
+
+
+def check_byte_size(fileobj):
+    """Kiểm tra dung lượng file (không đọc nội dung vào RAM), trả về số byte"""
+    fileobj.seek(0, os.SEEK_END)
+    size = fileobj.tell()
+    fileobj.seek(0)
+    if size > MAX_IMAGE_BYTES:
+        raise ImageTooLarge(f"Ảnh {size} bytes vượt giới hạn {MAX_IMAGE_BYTES} bytes")
+    return size
+
+
+def iter_chunks(fileobj, chunk_size=CHUNK_SIZE):
+    fileobj.seek(0)
+    while True:
+        chunk = fileobj.read(chunk_size)
+        if not chunk:
+            break
+        yield chunk
+    fileobj.seek(0)
+
+
+def decode_image(fileobj, size=IMAGE_RESOLUTION):
+    """Giải mã ảnh và đưa về size x size bằng một lần resize (cạnh ngắn) + center crop.
+
+    Với JPEG dùng draft mode: libjpeg giải mã thẳng ở tỉ lệ 1/2, 1/4, 1/8 sao cho cả hai cạnh
+    vẫn >= size, nên ảnh điện thoại 12MP không bao giờ được giải mã ở độ phân giải đầy đủ.
+    """
+    check_byte_size(fileobj)
+    try:
+        image = Image.open(fileobj)
+        width, height = image.size  # chỉ đọc header
+        if width * height > MAX_IMAGE_PIXELS:
+            raise ImageTooLarge(f"Ảnh {width}x{height} vượt giới hạn {MAX_IMAGE_PIXELS} pixel")
+        if image.format == "JPEG":
+            image.draft("RGB", (size, size))
+        image = image.convert("RGB")
+    except ImageTooLarge:
+        raise
+    except Image.DecompressionBombError as e:
+        raise ImageTooLarge(str(e))
+    except Exception as e:
+        raise InvalidImage(f"Không đọc được ảnh: {e}")
+
+    width, height = image.size
+    scale = size / min(width, height)
+    new_w, new_h = max(size, round(width * scale)), max(size, round(height * scale))
+    left, top = (new_w - size) // 2, (new_h - size) // 2
+    # resize + crop trong một lần gọi: chỉ resample vùng được giữ lại
+    box = (left / scale, top / scale, (left + size) / scale, (top + size) / scale)
+    return image.resize((size, size), Image.BICUBIC, box=box)
+
+
+def to_tensor(image):
+    """PIL RGB -> tensor (3, H, W) đã chuẩn hóa như preprocess của OpenCLIP"""
+    array = np.asarray(image, dtype=np.float32) / 255.0
+    array = (array - OPENAI_MEAN) / OPENAI_STD
+    return torch.from_numpy(array.transpose(2, 0, 1).copy())
+
+
+def preprocess_image(fileobj, size=IMAGE_RESOLUTION):
+    return to_tensor(decode_image(fileobj, size))
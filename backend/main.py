@@ -1,20 +1,115 @@
-from fastapi import FastAPI, UploadFile, File, Form
-from typing import List
-from PIL import Image
-import io
-import torch
+from fastapi import FastAPI, UploadFile, File, Form, Depends, HTTPException
+from typing import Optional
+from fastapi.responses import JSONResponse
+from contextlib import asynccontextmanager
+import os
+import asyncio
+import functools
 import numpy as np
+from concurrent.futures import ThreadPoolExecutor
 
 from fastapi.middleware.cors import CORSMiddleware
-from model_loader import model, preprocess, tokenizer, device
+import model_loader
+from model_loader import device
+from encoder_scheduler import MicroBatchEncoder
+from reranker import rerank
+from embedding_cache import EmbeddingCache, text_key, image_key
+from image_preprocess import preprocess_image, check_byte_size, ImageTooLarge, InvalidImage
+from schemas import SearchResponse, HistoryResponse, FastJSONResponse, parse_fields, project, search_response
 from elastic_utils import search_product_ids_by_text
+import milvus_utils
 from milvus_utils import (
     get_products_by_ids,
     search_by_image_vector,
-    get_combine_embeddings_by_ids
+    get_combine_embeddings_by_ids,
+    get_product_history,
 )
 
-app = FastAPI()
+# Chế độ nhiều worker (gunicorn --preload): trọng số được load một lần ở master trước khi fork
+if model_loader.MODEL_PRELOAD:
+    model_loader.preload()
+
+# Mô hình được gắn vào encoder khi thread nền load + warmup xong
+encoder = MicroBatchEncoder(None, device)
+
+def attach_model(model):
+    encoder.model = model
+
+@asynccontextmanager
+async def lifespan(app):
+    # Kết nối Milvus + cache sản phẩm (subscriber Redis) trong từng worker sau fork,
+    # chỉ trọng số mô hình được preload ở master
+    milvus_utils.connect()
+    model_loader.start_background_load(on_ready=attach_model)
+    yield
+
+app = FastAPI(lifespan=lifespan)
+
+# Executor giới hạn cho các bước blocking, tránh chặn event loop
+# - cpu_executor: giải mã + preprocess ảnh, tokenize
+# - io_executor: truy vấn Elasticsearch / Milvus (client đồng bộ)
+cpu_executor = ThreadPoolExecutor(max_workers=int(os.getenv("PREPROCESS_WORKERS", "4")), thread_name_prefix="preprocess")
+io_executor = ThreadPoolExecutor(max_workers=int(os.getenv("SEARCH_IO_WORKERS", "16")), thread_name_prefix="search-io")
+
+# Cache embedding query: trúng cache thì bỏ qua hoàn toàn bước forward của transformer
+embedding_cache = EmbeddingCache()
+
+# Chiến lược xếp hạng lại cho /search/multimodal: cosine | weighted | rrf
+RERANK_STRATEGY = os.getenv("RERANK_STRATEGY", "cosine")
+
+async def run_in(executor, fn, *args, **kwargs):
+    loop = asyncio.get_running_loop()
+    return await loop.run_in_executor(executor, functools.partial(fn, *args, **kwargs))
+
+def require_model():
+    # Chỉ nhận request cần encode khi mô hình đã warmup xong
+    if not model_loader.ready.is_set():
+        raise HTTPException(status_code=503, detail=f"Model {model_loader.status['state']}")
+
+
+def search_image_ids(vector, top_k):
+    return [p["id"] for p in search_by_image_vector(vector.tolist(), top_k=top_k)]
+
+async def cache_get(key):
+    # Tầng RAM tra ngay trên event loop; tầng đĩa (SQLite) chạy trong io_executor
+    vector = embedding_cache.get_memory(key)
+    if vector is None and embedding_cache.disk is not None:
+        vector = await run_in(io_executor, embedding_cache.get_disk, key)
+    return vector
+
+async def cache_put(key, vector):
+    created = embedding_cache.put_memory(key, vector)
+    if embedding_cache.disk is not None:
+        await run_in(io_executor, embedding_cache.put_disk, key, vector, created)
+
+async def embed_text(q):
+    key = text_key(q)
+    vector = await cache_get(key)
+    if vector is None:
+        tokens = await run_in(cpu_executor, model_loader.tokenizer, [q])
+        vector = await asyncio.wrap_future(encoder.submit_text(tokens))
+        await cache_put(key, vector)
+    return vector
+
+async def embed_image(file: UploadFile):
+    # Đọc thẳng từ file tạm (SpooledTemporaryFile) của upload, không nạp toàn bộ vào RAM
+    fileobj = file.file
+    await run_in(cpu_executor, check_byte_size, fileobj)
+    key = await run_in(cpu_executor, image_key, fileobj)
+    vector = await cache_get(key)
+    if vector is None:
+        image_tensor = await run_in(cpu_executor, preprocess_image, fileobj)
+        vector = await asyncio.wrap_future(encoder.submit_image(image_tensor))
+        await cache_put(key, vector)
+    return vector
+
+@app.exception_handler(ImageTooLarge)
+async def image_too_large_handler(request, exc):
+    return JSONResponse(status_code=413, content={"detail": str(exc)})
+
+@app.exception_handler(InvalidImage)
+async def invalid_image_handler(request, exc):
+    return JSONResponse(status_code=400, content={"detail": str(exc)})
 
 app.add_middleware(
     CORSMiddleware,
@@ -24,60 +119,73 @@ app.add_middleware(
     allow_headers=["*"],
 )
 
-@app.get("/search/text")
-def search_text(q: str, limit: int = 50):
+@app.get("/health")
+def health():
+    code = 200 if model_loader.ready.is_set() else 503
+    return JSONResponse(status_code=code, content=model_loader.status)
+
+@app.get("/stats")
+def stats():
+    return {
+        "embedding_cache": embedding_cache.snapshot(),
+        "product_cache": milvus_utils.product_cache.snapshot(),
+        "encoder": dict(encoder.stats),
+    }
+
+@app.get("/search/text", response_model=SearchResponse)
+def search_text(q: str, limit: int = 50, fields: Optional[str] = None):
+    fields = parse_fields(fields)
     ids = search_product_ids_by_text(q, size=limit)
-    results = get_products_by_ids(ids)
-    return {"results": results}
-
-@app.post("/search/image")
-async def search_image(file: UploadFile = File(...), limit: int = 50):
-    image_bytes = await file.read()
-    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-    image_tensor = preprocess(image).unsqueeze(0).to(device)
-    with torch.no_grad():
-        image_features = model.encode_image(image_tensor)
-        image_vector = image_features.cpu().numpy()[0].astype("float32")
-    ids = search_by_image_vector(image_vector.tolist(), top_k=limit)
-    id_list = [p["id"] for p in ids]
-    results = get_products_by_ids(id_list)
-    return {"results": results}
-
-@app.post("/search/multimodal")
-async def search_multimodal(q: str = Form(...), file: UploadFile = File(...), limit: int = 50):
-    # 1. Text embedding
-    with torch.no_grad():
-        text_features = model.encode_text(tokenizer([q]).to(device))
-        text_vector = text_features.cpu().numpy()[0].astype("float32")
-
-    # 2. Image embedding
-    image_bytes = await file.read()
-    image = Image.open(io.BytesIO(image_bytes)).convert("RGB")
-    image_tensor = preprocess(image).unsqueeze(0).to(device)
-    with torch.no_grad():
-        image_features = model.encode_image(image_tensor)
-        image_vector = image_features.cpu().numpy()[0].astype("float32")
-
-    # 3. Combine embedding (normalize)
-    combined_vector = text_vector + image_vector
-    combined_vector /= np.linalg.norm(combined_vector)
-
-    # 4. Lấy danh sách ID từ text + ảnh
-    ids_text = search_product_ids_by_text(q, size=limit*2)
-    ids_image_dict = search_by_image_vector(image_vector.tolist(), top_k=limit*2)
-    ids_image = [p["id"] for p in ids_image_dict]
+    results = get_products_by_ids(ids, fields)
+    return search_response(project(results, fields))
+
+@app.get("/products/{product_id}/history", response_model=HistoryResponse)
+def product_history(product_id: str, start: Optional[int] = None, end: Optional[int] = None):
+    # Chuỗi giá / đánh giá dạng cột (chỉ các điểm thay đổi) trong khoảng [start, end] (unix timestamp)
+    if start is not None and end is not None and start > end:
+        raise HTTPException(status_code=400, detail="start phải nhỏ hơn hoặc bằng end")
+    return FastJSONResponse(content=get_product_history(product_id, start, end))
+
+@app.post("/search/image", response_model=SearchResponse, dependencies=[Depends(require_model)])
+async def search_image(file: UploadFile = File(...), limit: int = 50, fields: Optional[str] = None):
+    fields = parse_fields(fields)
+    image_vector = await embed_image(file)
+    id_list = await run_in(io_executor, search_image_ids, image_vector, limit)
+    results = await run_in(io_executor, get_products_by_ids, id_list, fields)
+    return search_response(project(results, fields))
+
+@app.post("/search/multimodal", response_model=SearchResponse, dependencies=[Depends(require_model)])
+async def search_multimodal(q: str = Form(...), file: UploadFile = File(...), limit: int = 50, fields: Optional[str] = None):
+    fields = parse_fields(fields)
+    # Tìm theo text trên ES không phụ thuộc embedding nên chạy song song ngay từ đầu
+    ids_text_task = asyncio.ensure_future(run_in(io_executor, search_product_ids_by_text, q, size=limit*2))
+    try:
+        # 1 + 2. Text embedding và image embedding (qua cache, cùng đợi một batch của encoder)
+        text_vector, image_vector = await asyncio.gather(embed_text(q), embed_image(file))
+
+        # 3. Combine embedding (normalize)
+        combined_vector = text_vector + image_vector
+        combined_vector /= np.linalg.norm(combined_vector)
+
+        # 4. Lấy danh sách ID từ text + ảnh (ES và ANN Milvus chạy đồng thời)
+        ids_text, ids_image = await asyncio.gather(
+            ids_text_task, run_in(io_executor, search_image_ids, image_vector, limit*2)
+        )
+    finally:
+        # Nhánh ảnh lỗi (ảnh hỏng, quá lớn...) trước khi task ES được await: hủy task để lỗi của nó không bị bỏ quên
+        if not ids_text_task.done():
+            ids_text_task.cancel()
+        elif not ids_text_task.cancelled():
+            ids_text_task.exception()  # đánh dấu đã lấy lỗi (nếu có), asyncio không cảnh báo nữa
     candidate_ids = list(set(ids_text + ids_image))
 
     # 5. Lấy combine_embedding của các ứng viên
-    id_vec_pairs = get_combine_embeddings_by_ids(candidate_ids)
-
-    # 6. Tính cosine similarity và xếp hạng
-    def cosine_score(vec1, vec2):
-        return float(np.dot(vec1, vec2) / (np.linalg.norm(vec1) * np.linalg.norm(vec2)))
+    id_vec_pairs = await run_in(io_executor, get_combine_embeddings_by_ids, candidate_ids)
 
-    scored = [(pid, cosine_score(combined_vector, vec)) for pid, vec in id_vec_pairs]
-    top_ids = [pid for pid, _ in sorted(scored, key=lambda x: x[1], reverse=True)[:limit]]
+    # 6. Tính cosine similarity (vector hóa) và xếp hạng
+    ranked = rerank(combined_vector, id_vec_pairs, limit, ranked_lists=[ids_text, ids_image], strategy=RERANK_STRATEGY)
+    top_ids = [pid for pid, _ in ranked]
 
     # 7. Lấy thông tin sản phẩm
-    results = get_products_by_ids(top_ids)
-    return {"results": results}
+    results = await run_in(io_executor, get_products_by_ids, top_ids, fields)
+    return search_response(project(results, fields))
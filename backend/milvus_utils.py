@@ -4,6 +4,8 @@ import numpy as np
 
 from dotenv import load_dotenv
 from pymilvus import connections, Collection
+from product_cache import ProductCache
+from schemas import PRODUCT_FIELDS
 
 
 load_dotenv()
@@ -11,32 +13,46 @@ load_dotenv()
 MILVUS_HOST = os.getenv('MILVUS_HOST')
 MILVUS_PORT = os.getenv('MILVUS_PORT')
 
-connections.connect("default", host=MILVUS_HOST, port=MILVUS_PORT)
-info_col = Collection("product_information")
-embed_col = Collection("product_embedding")
-info_col.load()
-embed_col.load()
-
-def convert_to_json_safe(obj):
-    if isinstance(obj, dict):
-        return {k: convert_to_json_safe(v) for k, v in obj.items()}
-    elif isinstance(obj, list):
-        return [convert_to_json_safe(i) for i in obj]
-    elif hasattr(obj, 'tolist'):  # numpy types
-        return obj.tolist()
-    elif isinstance(obj, (np.float32, np.float64)):
-        return float(obj)
-    elif isinstance(obj, (np.int32, np.int64)):
-        return int(obj)
-    return obj
-
-def get_products_by_ids(ids: list):
-    if not ids:
-        return []
+# Được gán trong connect(), gọi ở lifespan của từng worker. Không kết nối lúc import: với gunicorn preload_app
+# main.py được import ở master, còn kênh gRPC của pymilvus và thread pub/sub Redis của cache không tồn tại sau fork.
+info_col = None
+embed_col = None
+price_history_col = None
+review_history_col = None
+# Cache thông tin sản phẩm trước product_information, chỉ query Milvus cho các id chưa có
+product_cache = None
+
+def connect():
+    global info_col, embed_col, price_history_col, review_history_col, product_cache
+    if info_col is not None:
+        return
+    connections.connect("default", host=MILVUS_HOST, port=MILVUS_PORT)
+    info = Collection("product_information")
+    embed_col = Collection("product_embedding")
+    price_history_col = Collection("product_price_history")
+    review_history_col = Collection("product_review_history")
+    for col in (info, embed_col, price_history_col, review_history_col):
+        col.load()
+    # Mỗi worker có subscriber invalidation riêng (thread run_in_thread không được fork sang worker)
+    product_cache = ProductCache()
+    info_col = info  # gán cuối cùng: info_col khác None nghĩa là đã kết nối xong
+
+def to_python(value):
+    # Các trường đều là vô hướng nên chỉ cần đổi numpy scalar (nếu có), không cần duyệt đệ quy
+    return value.item() if isinstance(value, np.generic) else value
+
+def query_products_by_ids(ids: list, fields=PRODUCT_FIELDS):
+    # Chỉ lấy các trường cần thiết (không bao giờ lấy vector __dummy__)
     quoted_ids = [json.dumps(i) for i in ids]
     expr = f"id in [{', '.join(quoted_ids)}]"
-    results = info_col.query(expr, output_fields=["*"])
-    return [convert_to_json_safe(r) for r in results]
+    results = info_col.query(expr, output_fields=list(fields))
+    return [{f: to_python(r[f]) for f in fields} for r in results]
+
+def get_products_by_ids(ids: list, fields=PRODUCT_FIELDS):
+    # Kết quả trả về theo đúng thứ tự xếp hạng của ids
+    if not ids:
+        return []
+    return product_cache.get_many(ids, lambda missing: query_products_by_ids(missing, fields), fields)
 
 def search_by_image_vector(vector, top_k=10, ef=None):
     if ef is None or ef <= top_k:
@@ -60,3 +76,46 @@ def get_combine_embeddings_by_ids(ids):
     expr = f"id in [{', '.join(quoted_ids)}]"
     results = embed_col.query(expr, output_fields=["id", "combine_embedding"])
     return [(r["id"], np.array(r["combine_embedding"], dtype=np.float32)) for r in results]
+
+# Các cửa sổ (giây) lùi dần trước start để tìm điểm cuối cùng trước start, None = toàn bộ phần còn lại.
+# query của Milvus 2.5 không có ORDER BY nên limit=1 không cho điểm mới nhất; thay vào đó quét các khoảng
+# rời nhau từ gần tới xa, thường chỉ cần khoảng đầu tiên.
+HISTORY_LOOKBACK_WINDOWS = [86400, 7 * 86400, 30 * 86400, 365 * 86400, None]
+
+def last_point_before(collection, base_expr, start, output_fields):
+    upper = int(start)
+    for window in HISTORY_LOOKBACK_WINDOWS:
+        expr = f"{base_expr} and timestamp < {upper}"
+        if window is not None:
+            expr += f" and timestamp >= {int(start) - window}"
+        rows = collection.query(expr, output_fields=output_fields)
+        if rows:
+            return [max(rows, key=lambda r: r["timestamp"])]
+        if window is not None:
+            upper = int(start) - window
+    return []
+
+def query_series(collection, product_id, value_fields, start=None, end=None):
+    """Chuỗi thời gian dạng cột {"timestamp": [...], <field>: [...]} của một sản phẩm trong [start, end].
+
+    Lịch sử chỉ lưu điểm khi giá trị đổi (chuỗi bậc thang) nên kèm thêm điểm cuối cùng trước start:
+    đó là giá trị tại thời điểm start."""
+    base_expr = f"product_id == {json.dumps(product_id)}"
+    output_fields = ["timestamp"] + value_fields
+    expr = base_expr
+    if start is not None:
+        expr += f" and timestamp >= {int(start)}"
+    if end is not None:
+        expr += f" and timestamp <= {int(end)}"
+    rows = collection.query(expr, output_fields=output_fields)
+    rows.sort(key=lambda r: r["timestamp"])
+    if start is not None and (end is None or start <= end):
+        rows = last_point_before(collection, base_expr, start, output_fields) + rows
+    return {f: [to_python(r[f]) for r in rows] for f in output_fields}
+
+def get_product_history(product_id, start=None, end=None):
+    return {
+        "id": product_id,
+        "price": query_series(price_history_col, product_id, ["price"], start, end),
+        "reviews": query_series(review_history_col, product_id, ["rating", "review_count"], start, end),
+    }
@@ -1,11 +1,88 @@
+import os
+import gc
+import time
+import threading
 import torch
-import open_clip
+from clip_backend import load_clip, CLIP_BACKEND, IMAGE_RESOLUTION
 
 device = "cuda" if torch.cuda.is_available() else "cpu"
-print("🔍 Load mô hình OpenCLIP ViT-L-14-336...")
-model, _, preprocess = open_clip.create_model_and_transforms(
-    model_name="ViT-L-14-336", pretrained="openai", image_resolution=336
-)
-tokenizer = open_clip.get_tokenizer("ViT-L-14-336")
-model.to(device)
-model.eval()
+WARMUP_ITERS = int(os.getenv("MODEL_WARMUP_ITERS", "2"))
+WARMUP_BATCH_SIZES = [int(b) for b in os.getenv("MODEL_WARMUP_BATCH_SIZES", "1,4").split(",") if b]
+# MODEL_PRELOAD=1: load trọng số trong process master trước khi fork để các worker dùng chung (copy-on-write)
+MODEL_PRELOAD = os.getenv("MODEL_PRELOAD", "0") == "1"
+
+# Được gán sau khi load xong, trước đó API trả 503
+model = None
+preprocess = None
+tokenizer = None
+
+ready = threading.Event()
+status = {"state": "pending", "error": None, "load_seconds": None, "warmup_seconds": None}
+
+
+def warmup():
+    """Chạy vài lượt forward cho cả hai tower để khởi tạo kernel trước khi nhận traffic thật"""
+    tokens = tokenizer(["warmup"])
+    with torch.no_grad():
+        for batch_size in WARMUP_BATCH_SIZES:
+            images = torch.zeros(batch_size, 3, IMAGE_RESOLUTION, IMAGE_RESOLUTION, device=device)
+            texts = tokens.repeat(batch_size, 1).to(device)
+            for _ in range(WARMUP_ITERS):
+                model.encode_image(images)
+                model.encode_text(texts)
+
+
+def load_weights():
+    global model, preprocess, tokenizer
+    status["state"] = "loading"
+    print(f"🔍 Load mô hình OpenCLIP ViT-L-14-336 (backend: {CLIP_BACKEND})...")
+    start = time.time()
+    model, preprocess, tokenizer = load_clip("ViT-L-14-336", pretrained="openai", device=device)
+    status["load_seconds"] = round(time.time() - start, 2)
+
+
+def preload():
+    """Load trọng số trong master (không warmup: tránh khởi tạo thread pool của torch trước khi fork)"""
+    load_weights()
+    # Đưa các object đã tạo vào vùng permanent của GC để worker không chạm (và copy) các trang này
+    gc.freeze()
+
+
+def configure_threads(num_threads):
+    """Giới hạn số thread intra-op / inter-op của torch cho từng worker"""
+    if num_threads > 0:
+        torch.set_num_threads(num_threads)
+        try:
+            torch.set_num_interop_threads(1)
+        except RuntimeError:
+            pass  # đã có công việc inter-op chạy trước đó
+
+
+def load_model(on_ready=None):
+    """Load mô hình (nếu chưa preload) + warmup (blocking). Gọi on_ready(model) rồi đánh dấu ready khi xong"""
+    try:
+        if model is None:
+            load_weights()
+
+        status["state"] = "warming_up"
+        start = time.time()
+        warmup()
+        status["warmup_seconds"] = round(time.time() - start, 2)
+
+        if on_ready:
+            on_ready(model)
+        status["state"] = "ready"
+        ready.set()
+        print(f"✅ Mô hình sẵn sàng (load {status['load_seconds']}s, warmup {status['warmup_seconds']}s)")
+    except Exception as e:
+        status["state"] = "error"
+        status["error"] = str(e)
+        print(f"❌ Lỗi khi load mô hình: {e}")
+    return model
+
+
+def start_background_load(on_ready=None):
+    """Load mô hình trong thread nền để process khởi động ngay và trả lời health check"""
+    thread = threading.Thread(target=load_model, args=(on_ready,), name="model-loader", daemon=True)
+    thread.start()
+    return thread
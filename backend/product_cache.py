@@ -0,0 +1,136 @@
+import os
+import json
+import time
+import threading
+from collections import OrderedDict
+
+PRODUCT_CACHE_MAX_ENTRIES = int(os.getenv("PRODUCT_CACHE_MAX_ENTRIES", "20000"))
+PRODUCT_CACHE_TTL = float(os.getenv("PRODUCT_CACHE_TTL", "300"))
+# Tầng cache dùng chung giữa các worker / node (Redis), bỏ trống để chỉ dùng cache trong process
+REDIS_URL = os.getenv("REDIS_URL", "")
+SHARED_KEY_PREFIX = "product:"
+# Ingestor publish "<id>:<last_update>" vào channel này mỗi khi ghi sản phẩm
+INVALIDATION_CHANNEL = "product_updates"
+
+
+class SharedTier:
+    """Tầng Redis: lưu row dạng JSON và nhận thông báo invalidation từ ingestor"""
+
+    def __init__(self, url, ttl):
+        import redis  # phụ thuộc tùy chọn, chỉ cần khi bật REDIS_URL
+        self.client = redis.Redis.from_url(url)
+        self.ttl = int(ttl)
+
+    def get_many(self, ids):
+        values = self.client.mget([SHARED_KEY_PREFIX + i for i in ids])
+        return {i: json.loads(v) for i, v in zip(ids, values) if v is not None}
+
+    def put_many(self, rows):
+        pipe = self.client.pipeline()
+        for row in rows:
+            pipe.set(SHARED_KEY_PREFIX + row["id"], json.dumps(row), ex=self.ttl)
+        pipe.execute()
+
+    def subscribe(self, callback):
+        pubsub = self.client.pubsub(ignore_subscribe_messages=True)
+        pubsub.subscribe(**{INVALIDATION_CHANNEL: lambda msg: callback(msg["data"].decode())})
+        return pubsub.run_in_thread(sleep_time=1.0, daemon=True)
+
+
+class ProductCache:
+    """Cache LRU + TTL cho row product_information, chỉ query Milvus các id chưa có trong cache"""
+
+    def __init__(self, max_entries=PRODUCT_CACHE_MAX_ENTRIES, ttl=PRODUCT_CACHE_TTL, redis_url=REDIS_URL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "shared_hits": 0, "misses": 0, "invalidations": 0}
+        self.shared = None
+        if redis_url:
+            try:
+                self.shared = SharedTier(redis_url, ttl)
+                self.shared.subscribe(self.on_update_message)
+            except Exception as e:
+                print(f"⚠️ Không kết nối được Redis, chỉ dùng cache trong process: {e}")
+                self.shared = None
+
+    def get_many(self, ids, fetch_fn, fields=None):
+        """Trả về row theo đúng thứ tự ids; fetch_fn(missing_ids) chỉ được gọi một lần cho các id thiếu.
+
+        Row trong cache chỉ được dùng nếu có đủ các trường `fields` được yêu cầu.
+        """
+        found = {}
+        now = time.time()
+        with self._lock:
+            for pid in ids:
+                entry = self._data.get(pid)
+                if entry is not None and now - entry[1] <= self.ttl and (fields is None or entry[0].keys() >= set(fields)):
+                    self._data.move_to_end(pid)
+                    found[pid] = entry[0]
+            self.stats["hits"] += len(found)
+
+        missing = [pid for pid in dict.fromkeys(ids) if pid not in found]
+        if missing and self.shared is not None:
+            try:
+                shared_rows = self.shared.get_many(missing)
+            except Exception:
+                shared_rows = {}
+            if fields is not None:
+                shared_rows = {pid: row for pid, row in shared_rows.items() if row.keys() >= set(fields)}
+            self._put_local(shared_rows.values())
+            found.update(shared_rows)
+            with self._lock:
+                self.stats["shared_hits"] += len(shared_rows)
+            missing = [pid for pid in missing if pid not in shared_rows]
+
+        if missing:
+            rows = fetch_fn(missing)
+            self._put_local(rows)
+            if self.shared is not None and rows:
+                try:
+                    self.shared.put_many(rows)
+                except Exception:
+                    pass
+            found.update((row["id"], row) for row in rows)
+            with self._lock:
+                self.stats["misses"] += len(missing)
+
+        return [found[pid] for pid in ids if pid in found]
+
+    def _put_local(self, rows):
+        now = time.time()
+        with self._lock:
+            for row in rows:
+                entry = self._data.get(row["id"])
+                # Gộp các trường khi cùng phiên bản, để các projection khác nhau không đẩy nhau ra
+                if entry is not None and entry[0].get("last_update") == row.get("last_update"):
+                    row = {**entry[0], **row}
+                self._data[row["id"]] = (row, now)
+                self._data.move_to_end(row["id"])
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def invalidate(self, pid, last_update=None):
+        """Xóa entry nếu ingestor đã ghi bản mới hơn (last_update lớn hơn bản đang cache)"""
+        with self._lock:
+            entry = self._data.get(pid)
+            if entry is None:
+                return
+            if last_update is None or entry[0].get("last_update", 0) < last_update:
+                del self._data[pid]
+                self.stats["invalidations"] += 1
+
+    def on_update_message(self, message):
+        pid, _, last_update = message.rpartition(":")
+        try:
+            self.invalidate(pid, int(last_update))
+        except ValueError:
+            self.invalidate(message)
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["shared_hits"] + self.stats["misses"]
+            hit_rate = (self.stats["hits"] + self.stats["shared_hits"]) / lookups if lookups else 0.0
+            return {**self.stats, "hit_rate": round(hit_rate, 4), "entries": len(self._data),
+                    "shared_tier": self.shared is not None}
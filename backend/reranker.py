@@ -0,0 +1,98 @@
+import numpy as np
+
+RRF_K = 60
+
+
+def stack_candidates(id_vec_pairs):
+    """Gộp danh sách (id, vector) thành (list id, ma trận N x D float32)"""
+    if not id_vec_pairs:
+        return [], np.empty((0, 0), dtype=np.float32)
+    ids = [pid for pid, _ in id_vec_pairs]
+    matrix = np.vstack([vec for _, vec in id_vec_pairs]).astype(np.float32, copy=False)
+    return ids, matrix
+
+
+def cosine_scores(query_vector, matrix, normalized=True):
+    """Cosine của query với mọi hàng trong một phép nhân ma trận - vector.
+
+    Ingestor đã lưu combine_embedding ở dạng chuẩn hóa nên mặc định chỉ cần tích vô hướng.
+    """
+    query = np.asarray(query_vector, dtype=np.float32)
+    query = query / np.linalg.norm(query)
+    scores = matrix @ query
+    if not normalized:
+        scores /= np.linalg.norm(matrix, axis=1) + 1e-12
+    return scores
+
+
+def top_k_indices(scores, k):
+    """Chọn top-k bằng argpartition (O(N)) rồi chỉ sắp xếp k phần tử"""
+    n = len(scores)
+    if k <= 0 or n == 0:
+        return np.empty(0, dtype=np.int64)
+    if k < n:
+        idx = np.argpartition(-scores, k - 1)[:k]
+    else:
+        idx = np.arange(n)
+    return idx[np.argsort(-scores[idx], kind="stable")]
+
+
+def rank_positions(ids, ranked_list):
+    """Vị trí (0-based) của từng id trong ranked_list, -1 nếu không có"""
+    position = {pid: rank for rank, pid in enumerate(ranked_list)}
+    return np.array([position.get(pid, -1) for pid in ids], dtype=np.int64)
+
+
+# ---- Chiến lược fusion: nhận (ids, cosine, ranked_lists) trả về điểm cuối cùng ----
+
+def cosine_fusion(ids, cos, ranked_lists):
+    return cos
+
+
+def weighted_sum_fusion(ids, cos, ranked_lists, cosine_weight=0.7, list_weights=None):
+    """cosine_weight * cosine + tổng w_i * (1 - rank / len) trên từng danh sách ES / ANN"""
+    if list_weights is None:
+        list_weights = [(1.0 - cosine_weight) / max(1, len(ranked_lists))] * len(ranked_lists)
+    scores = cosine_weight * cos
+    for weight, ranked in zip(list_weights, ranked_lists):
+        if not ranked:
+            continue
+        pos = rank_positions(ids, ranked)
+        scores = scores + weight * np.where(pos >= 0, 1.0 - pos / len(ranked), 0.0)
+    return scores
+
+
+def rrf_fusion(ids, cos, ranked_lists, k=RRF_K, include_cosine=True):
+    """Reciprocal rank fusion: tổng 1 / (k + rank) trên ES, ANN và (tùy chọn) thứ hạng cosine"""
+    scores = np.zeros(len(ids), dtype=np.float64)
+    lists = [rank_positions(ids, ranked) for ranked in ranked_lists]
+    if include_cosine:
+        cos_rank = np.empty(len(ids), dtype=np.int64)
+        cos_rank[np.argsort(-cos, kind="stable")] = np.arange(len(ids))
+        lists.append(cos_rank)
+    for pos in lists:
+        scores += np.where(pos >= 0, 1.0 / (k + pos + 1), 0.0)
+    return scores
+
+
+FUSION_STRATEGIES = {
+    "cosine": cosine_fusion,
+    "weighted": weighted_sum_fusion,
+    "rrf": rrf_fusion,
+}
+
+
+def register_fusion(name, fn):
+    FUSION_STRATEGIES[name] = fn
+
+
+def rerank(query_vector, id_vec_pairs, limit, ranked_lists=(), strategy="cosine", normalized=True, **params):
+    """Xếp hạng lại các ứng viên và trả về danh sách (id, score) top `limit`"""
+    if strategy not in FUSION_STRATEGIES:
+        raise ValueError(f"Chiến lược fusion không hợp lệ: {strategy}")
+    ids, matrix = stack_candidates(id_vec_pairs)
+    if not ids:
+        return []
+    cos = cosine_scores(query_vector, matrix, normalized=normalized)
+    scores = FUSION_STRATEGIES[strategy](ids, cos, list(ranked_lists), **params)
+    return [(ids[i], float(scores[i])) for i in top_k_indices(scores, limit)]
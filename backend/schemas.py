@@ -0,0 +1,79 @@
+import json
+from typing import List, Optional
+
+from fastapi import HTTPException
+from fastapi.responses import JSONResponse
+from pydantic import BaseModel
+
+try:
+    import orjson
+except ImportError:  # orjson là tùy chọn, fallback về json chuẩn
+    orjson = None
+
+# Các trường vô hướng của product_information (bỏ vector __dummy__)
+PRODUCT_FIELDS = ["id", "product_name", "url", "price", "rating", "review_count", "last_update", "image_url"]
+# Luôn lấy kèm để cache và invalidation hoạt động
+REQUIRED_FIELDS = ["id", "last_update"]
+
+
+class Product(BaseModel):
+    id: str
+    product_name: Optional[str] = None
+    url: Optional[str] = None
+    price: Optional[float] = None
+    rating: Optional[float] = None
+    review_count: Optional[int] = None
+    last_update: Optional[int] = None
+    image_url: Optional[str] = None
+
+
+class SearchResponse(BaseModel):
+    results: List[Product]
+
+
+class PriceSeries(BaseModel):
+    timestamp: List[int]
+    price: List[float]
+
+
+class ReviewSeries(BaseModel):
+    timestamp: List[int]
+    rating: List[float]
+    review_count: List[int]
+
+
+class HistoryResponse(BaseModel):
+    id: str
+    price: PriceSeries
+    reviews: ReviewSeries
+
+
+def parse_fields(fields):
+    """'id,price' -> danh sách trường cần lấy; None -> toàn bộ PRODUCT_FIELDS"""
+    if not fields:
+        return PRODUCT_FIELDS
+    requested = [f.strip() for f in fields.split(",") if f.strip()]
+    unknown = [f for f in requested if f not in PRODUCT_FIELDS]
+    if unknown:
+        raise HTTPException(status_code=400, detail=f"Trường không hợp lệ: {', '.join(unknown)}")
+    return [f for f in PRODUCT_FIELDS if f in requested or f in REQUIRED_FIELDS]
+
+
+def project(rows, fields):
+    if fields is PRODUCT_FIELDS:
+        return rows
+    return [{f: row.get(f) for f in fields} for row in rows]
+
+
+class FastJSONResponse(JSONResponse):
+    """Serialize thẳng bằng orjson, không qua jsonable_encoder của FastAPI"""
+
+    def render(self, content):
+        if orjson is not None:
+            return orjson.dumps(content, option=orjson.OPT_SERIALIZE_NUMPY)
+        return json.dumps(content, ensure_ascii=False, separators=(",", ":")).encode("utf-8")
+
+
+def search_response(results):
+    # Trả về Response trực tiếp nên FastAPI bỏ qua bước validate / encode lại theo response_model
+    return FastJSONResponse(content={"results": results})
@@ -0,0 +1,104 @@
+import time
+import argparse
+import threading
+import urllib.parse
+
+from selenium.webdriver.common.by import By
+from selenium.webdriver.support.ui import WebDriverWait
+from selenium.webdriver.support import expected_conditions as EC
+from selenium.common.exceptions import TimeoutException
+
+from crawler import ProductCrawler, TRANSPORTS
+from proxy_broker import broker as proxy_broker
+from driver_pool import browser_rss_mb, psutil
+from extractor import CARD_PROFILES
+
+# So sánh hai chế độ proxy (wire / extension) trên cùng keyword và proxy key:
+#   - trang / phút: mở trang kết quả và chờ thẻ sản phẩm đầu tiên, không click từng thẻ
+#   - RSS mỗi crawler: Chrome + chromedriver, cộng phần RAM tăng thêm của process Python
+#     (selenium-wire chạy proxy MITM ngay trong process crawler)
+# Ví dụ: python benchmark_transport.py --key <proxy_key> --keywords "áo thun,giày" --pages 20
+
+
+def python_rss_mb():
+    if psutil is None:
+        return None
+    return psutil.Process().memory_info().rss / (1024 * 1024)
+
+
+def wait_for_cards(driver, timeout):
+    selector = ", ".join(profile["card"] for profile in CARD_PROFILES)
+    try:
+        WebDriverWait(driver, timeout).until(EC.presence_of_element_located((By.CSS_SELECTOR, selector)))
+        return True
+    except TimeoutException:
+        return False
+
+
+def benchmark(proxy_key, transport, keywords, pages, timeout=30):
+    crawler = ProductCrawler(proxy_key, f"Bench-{transport}", transport)
+    crawler.stop_event = threading.Event()
+    base_rss = python_rss_mb()
+    peak_browser = peak_python = 0.0
+    loaded = 0
+    # Một proxy cho cả lượt đo: key giữ proxy broker giao cho tới hết lượt (broker không đổi proxy khi key đang
+    # dùng), để chế độ extension không phải mở lại Chrome mỗi lần proxy đổi làm lệch kết quả
+    proxy_options = crawler.get_proxy_config()
+    started = time.monotonic()
+    try:
+        for i in range(pages):
+            keyword = keywords[i % len(keywords)]
+            driver = crawler.driver_pool.acquire(proxy_options)
+            url = f"https://www.google.com/search?q={urllib.parse.quote(keyword)}&tbm=shop&hl=vi&gl=vn"
+            healthy = False
+            try:
+                crawler.request_policy.start_page(driver)
+                page_started = time.monotonic()
+                driver.get(url)
+                healthy = wait_for_cards(driver, timeout)
+                crawler.request_policy.finish_page(time.monotonic() - page_started, driver)
+                loaded += healthy
+            except Exception as e:
+                print(f"⚠️ {transport} - Lỗi trang {i + 1}: {e}")
+            browser = browser_rss_mb(driver) or 0.0
+            peak_browser = max(peak_browser, browser)
+            if base_rss is not None:
+                peak_python = max(peak_python, python_rss_mb() - base_rss)
+            crawler.driver_pool.release(healthy)
+    finally:
+        crawler.driver_pool.close()
+        # Trả key cho broker (cho phép đổi proxy) và ghi nhận kết quả cho IP exit
+        proxy_broker.release(proxy_key, ok=loaded > 0)
+    minutes = (time.monotonic() - started) / 60
+    traffic = crawler.request_policy.snapshot()
+    return {
+        "transport": transport,
+        "pages": pages,
+        "loaded": loaded,
+        "pages_per_min": round(loaded / minutes, 2) if minutes else 0.0,
+        "peak_browser_mb": round(peak_browser, 1),
+        "python_overhead_mb": round(peak_python, 1),
+        "peak_rss_mb": round(peak_browser + peak_python, 1),
+        "avg_kb_per_page": traffic["avg_kb_per_page"],
+        "avg_load_seconds": traffic["avg_load_seconds"],
+        "launches": crawler.driver_pool.stats["launches"],
+    }
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Đo trang/phút và RSS mỗi crawler của hai chế độ proxy")
+    parser.add_argument("--key", required=True, help="proxy key trong proxy_list.txt")
+    parser.add_argument("--keywords", default="áo thun,giày thể thao,tai nghe bluetooth")
+    parser.add_argument("--pages", type=int, default=10)
+    parser.add_argument("--transports", default=",".join(TRANSPORTS))
+    args = parser.parse_args()
+
+    if psutil is None:
+        print("⚠️ Chưa cài psutil, không đo được RSS")
+    keywords = [k.strip() for k in args.keywords.split(",") if k.strip()]
+    results = [benchmark(args.key, t.strip(), keywords, args.pages) for t in args.transports.split(",") if t.strip()]
+
+    columns = list(results[0].keys())
+    print(" | ".join(columns))
+    for r in results:
+        print(" | ".join(str(r[c]) for c in columns))
@@ -12,6 +12,7 @@ from datetime import datetime
 from dotenv import load_dotenv
 
 from seleniumwire import webdriver
+from selenium import webdriver as chrome_webdriver
 from selenium.webdriver.common.by import By
 from selenium.webdriver.chrome.service import Service
 from selenium.webdriver.chrome.options import Options
@@ -21,57 +22,47 @@ from selenium.webdriver.common.action_chains import ActionChains
 from selenium.common.exceptions import TimeoutException
 
 
-from proxy import RotatingProxy
+from proxy_broker import broker as proxy_broker
 from human_simulator import HumanBehaviorSimulator
+from extractor import CARD_PROFILES, CardExtractor
+from driver_pool import DriverPool
+from request_policy import RequestPolicy
+from proxy_extension import build_proxy_extension
 from rabbitmq_connector import RabbitMQConnector
 from pipelines import upload_file_to_s3, send_sqs_message_from_json, zip_folder
 
 
 load_dotenv()
 
+# Cách đưa proxy vào Chrome (mặc định cho mọi crawler, có thể ghi đè từng dòng trong proxy_list.txt):
+#   wire: selenium-wire làm proxy MITM trong process Python (đổi proxy được trên session đang chạy)
+#   extension: Chrome tự dùng proxy qua extension sinh ra lúc khởi động, nhẹ hơn nhưng đổi proxy phải mở lại Chrome
+CRAWLER_TRANSPORT = os.getenv("CRAWLER_TRANSPORT", "wire")
+TRANSPORTS = ("wire", "extension")
+
 class ProductCrawler:
-    def __init__(self, proxy_key, name):
+    def __init__(self, proxy_key, name, transport=CRAWLER_TRANSPORT):
+        if transport not in TRANSPORTS:
+            raise ValueError(f"transport không hợp lệ: {transport} (chọn một trong {TRANSPORTS})")
         self.proxy_key = proxy_key
         self.name = name
+        self.transport = transport
         self.crawl_timestamp = "%d%m%Y_%H%M%S"
-        self.proxy_manager = RotatingProxy(proxy_key)
         self.current_proxy = None
-        self.last_proxy_change = 0
+        proxy_broker.register(proxy_key)  # broker bắt đầu lấy proxy cho key ngay, trước keyword đầu tiên
         self.total_saved_count = 0
         self.stop_event = None
+        # Chặn ảnh / font / quảng cáo và đếm byte mỗi trang, xem request_policy.py
+        self.request_policy = RequestPolicy()
+        # Session Chrome được giữ lại giữa các keyword, xem driver_pool.py
+        self.driver_pool = DriverPool(name, self.setup_driver, self.switch_proxy)
 
     def get_proxy_config(self):
-        current_time = time.time()
-        elapsed_time = current_time - self.last_proxy_change
-
-        def try_get_valid_proxy():
-            for attempt in range(3):
-                proxy_info = self.proxy_manager.get_new_proxy()
-                if proxy_info:
-                    return proxy_info
-                else:
-                    print(f"⚠️ {self.name} - Proxy chưa sẵn sàng, thử lại sau 60 giây...")
-                    time.sleep(60)
-            print(f"❌ {self.name} - Không thể lấy proxy hợp lệ sau nhiều lần thử.")
-            return None
-
-        # ⚠️ Nếu chưa đủ 60 giây thì đợi cho đến khi đủ
-        if self.current_proxy and elapsed_time < 60:
-            wait_time = int(60 - elapsed_time)
-            print(f"⏳ {self.name} - Chưa đủ thời gian đổi proxy. Đang chờ {wait_time}s...")
-            time.sleep(wait_time)
-
-        # Đổi proxy (sau khi đã đủ 60s)
-        new_proxy = try_get_valid_proxy()
-        if new_proxy:
-            self.current_proxy = new_proxy
-            self.last_proxy_change = time.time()
-        else:
-            print(f"❌ {self.name} - Không đổi được proxy, giữ nguyên proxy cũ và tiếp tục.")
-
-        proxy = self.current_proxy
+        """Nhận proxy đã được kiểm tra từ proxy broker dùng chung (proxy_broker.py), không chờ trong thread crawl"""
+        proxy = proxy_broker.acquire(self.proxy_key)
         if not proxy:
-            raise Exception(f"🛑 {self.name}Không có proxy nào khả dụng để tiếp tục.")
+            raise Exception(f"🛑 {self.name} - Không có proxy nào khả dụng để tiếp tục.")
+        self.current_proxy = proxy
 
         proxy_url = f"http://{proxy['username']}:{proxy['password']}@{proxy['ip']}:{proxy['port']}"
         return {
@@ -94,8 +85,15 @@ class ProductCrawler:
         ]
         return random.choice(user_agents)
 
+    def switch_proxy(self, driver, proxy):
+        """Đổi upstream proxy của selenium-wire ngay trên session đang chạy, không cần mở lại Chrome"""
+        if self.transport != "wire":
+            return False  # proxy nằm trong extension, DriverPool sẽ mở lại Chrome
+        driver.proxy = proxy['proxy']
+        return True
+
     def setup_driver(self, proxy=None):
-        """Khởi tạo trình duyệt Chrome với options phù hợp và proxy sử dụng selenium-wire"""
+        """Khởi tạo trình duyệt Chrome với options phù hợp và proxy (selenium-wire hoặc extension, theo self.transport)"""
         chrome_options = Options()
         # Cấu hình cơ bản
         # chrome_options.add_argument("--headless=new")  # Sử dụng headless mới, ít bị phát hiện hơn
@@ -106,7 +104,8 @@ class ProductCrawler:
         # Giảm tài nguyên
         chrome_options.add_argument("--disable-dev-shm-usage")
         chrome_options.add_argument("--disable-gpu")
-        chrome_options.add_argument("--disable-extensions")
+        if self.transport == "wire":
+            chrome_options.add_argument("--disable-extensions")
         chrome_options.add_argument("--no-sandbox")
         chrome_options.add_argument("--window-size=1280,720")  # Kích thước nhỏ hơn để tiết kiệm RAM
         chrome_options.add_argument("--disable-audio-output")
@@ -134,7 +133,8 @@ class ProductCrawler:
         seleniumwire_options = {
             'connection_timeout': 60,  # Giảm thời gian timeout
             'verify_ssl': False,       # Tắt xác minh SSL để tăng tốc
-            'suppress_connection_errors': True
+            'suppress_connection_errors': True,
+            **self.request_policy.seleniumwire_options()
         }
         
         # Thêm cấu hình proxy nếu được cung cấp
@@ -149,10 +149,24 @@ class ProductCrawler:
 
         chromedriver_autoinstaller.install()
 
-        driver = webdriver.Chrome(
-            options=chrome_options,
-            seleniumwire_options=seleniumwire_options
-        )
+        if self.transport == "extension":
+            extension_path = None
+            if proxy:
+                extension_path = build_proxy_extension(
+                    proxy['proxy']['https'], self.request_policy.block_types, self.request_policy.block_patterns, self.name
+                )
+                chrome_options.add_extension(extension_path)
+            self.request_policy.chrome_logging_options(chrome_options)
+            try:
+                driver = chrome_webdriver.Chrome(options=chrome_options)
+            finally:
+                if extension_path:
+                    os.remove(extension_path)
+        else:
+            driver = webdriver.Chrome(
+                options=chrome_options,
+                seleniumwire_options=seleniumwire_options
+            )
 
         # driver = webdriver.Chrome(
         #     service=Service(os.getenv('CHROMEDRIVER_PATH')),
@@ -166,6 +180,7 @@ class ProductCrawler:
         
         # Thiết lập page load timeout hợp lý
         driver.set_page_load_timeout(30)
+        self.request_policy.attach(driver)
         
         # Cài đặt Stealth JavaScript
         stealth_js = """
@@ -201,6 +216,8 @@ class ProductCrawler:
             get: () => ['vi-VN', 'vi', 'en-US', 'en']
         });
         """
+        # Đăng ký chạy trên mọi trang mới để vẫn còn hiệu lực khi session được dùng lại cho keyword sau
+        driver.execute_cdp_cmd("Page.addScriptToEvaluateOnNewDocument", {"source": stealth_js})
         driver.execute_script(stealth_js)
         
         return driver
@@ -314,18 +331,27 @@ class ProductCrawler:
 
         sw_options = self.get_proxy_config()
         self.current_proxy_config = sw_options
-        driver = self.setup_driver(sw_options)
+        try:
+            driver = self.driver_pool.acquire(sw_options)
+        except Exception:
+            proxy_broker.release(self.proxy_key, ok=False)
+            raise
 
         self.last_saved_count = 0  # <-- lưu số lượng sản phẩm thành công cho mỗi keyword
+        healthy = False  # CAPTCHA hoặc lỗi thì bỏ session, keyword sau mở Chrome mới
 
         try:
             url = f"https://www.google.com/search?q={urllib.parse.quote(keyword)}&tbm=shop&hl=vi&gl=vn"
+            self.request_policy.start_page(driver)
+            started = time.monotonic()
             driver.get(url)
+            load_seconds = time.monotonic() - started
 
             page_source = driver.page_source
             if "recaptcha" in page_source or "captcha-form" in page_source:
                 print(f"{self.name} - Phát hiện CAPTCHA. Bỏ qua keyword: {keyword}")
                 return False  # Không ack để requeue
+            healthy = True
 
             simulator = HumanBehaviorSimulator(driver)
             simulator.perform_random_action()
@@ -333,29 +359,27 @@ class ProductCrawler:
             handled = False
             total_saved = 0
 
-            selector_handlers = [
-                ("div.MtXiu", self.process_cards_mtXiu),
-                ("div.LrTUQ", self.process_cards_LrTUQ)
-            ]
-
-            for selector, handler in selector_handlers:
+            for profile in CARD_PROFILES:
                 if self.stop_event.is_set():
                     print(f"{self.name}: Nhận tín hiệu dừng, thoát khỏi crawl_keyword.")
                     break
 
                 try:
                     cards = WebDriverWait(driver, 30).until(
-                        EC.presence_of_all_elements_located((By.CSS_SELECTOR, selector))
+                        EC.presence_of_all_elements_located((By.CSS_SELECTOR, profile["card"]))
                     )
                     print(f"{self.name}: Found {len(cards)} products")
                     if cards:
-                        print(f"{self.name} start crawling by {selector} card")
-                        total_saved = handler(driver, cards, simulator)
+                        print(f"{self.name} start crawling by {profile['card']} card")
+                        total_saved = self.process_cards(driver, cards, simulator, profile)
                         handled = True
                         break
                 except TimeoutException:
                     pass
 
+            # Trả proxy trước khi zip / upload để broker đổi proxy cho key trong lúc này
+            proxy_broker.release(self.proxy_key, ok=True)
+
             try:
                 for folder in [self.image_folder, self.json_folder]:
                     zip_path = zip_folder(folder)
@@ -370,85 +394,53 @@ class ProductCrawler:
             except Exception as e:
                 print(f"❌ {self.name} - Lỗi khi zip/upload folder sau crawl: {e}")
 
+            page = self.request_policy.finish_page(load_seconds, driver)
+            print(f"📉 {self.name} - Trang '{keyword}': tải {load_seconds:.1f}s, {page['requests']} request / "
+                  f"{page['bytes'] / 1024:.0f} KB qua proxy, chặn {page['blocked']} {page['blocked_by_type']}")
+
             self.last_saved_count = total_saved  # <-- cập nhật số lượng sản phẩm
             return handled and total_saved > 0
         
         except:
+            healthy = False
             return False
         finally:
-            driver.quit()
-
-    def process_cards_mtXiu(self, driver, cards, simulator):
+            self.driver_pool.release(healthy)
+            proxy_broker.release(self.proxy_key, ok=healthy)  # không làm gì nếu đã trả ở trên
+
+    def process_cards(self, driver, cards, simulator, profile):
+        """Duyệt các thẻ theo profile selector: click từng thẻ để mở khung chi tiết, đọc mọi trường bằng một
+        lần gọi script (xem extractor.py). Trả về số sản phẩm lưu được."""
+        extractor = CardExtractor(driver, profile)
+        extractor.load_cards()
+        saved = 0
         for i, card in enumerate(cards):
             if self.stop_event.is_set():
-                print(f"{self.name}: Nhận tín hiệu dừng, thoát giữa danh sách sản phẩm MtXiu.")
+                print(f"{self.name}: Nhận tín hiệu dừng, thoát giữa danh sách sản phẩm {profile['name']}.")
                 break
-
-            product = {}
             try:
-                driver.execute_script("arguments[0].scrollIntoView({behavior: 'auto', block: 'center'});", card)
-                ActionChains(driver).move_to_element(card).pause(2).click().perform()
-                WebDriverWait(driver, 30).until(EC.presence_of_element_located((By.CSS_SELECTOR, "div.mLFOe")))
+                previous = extractor.scroll_to(i)
+                ActionChains(driver).move_to_element(card).pause(profile["click_pause"]).click().perform()
+                product = extractor.read_panel(i, previous)
                 simulator.simulate_reading()
+                if product is None:
+                    continue
 
                 product['timestamp'] = self.crawl_timestamp
-                product['image_url'] = driver.find_element(By.CSS_SELECTOR, "div.Cl9jQc img.KfAt4d").get_attribute('src')
-                product['name'] = driver.find_element(By.CSS_SELECTOR, "h2.u44bxd").text
-                product['store_url'] = driver.find_element(By.XPATH, "//div[contains(@class, 'sCXXQd')]/a").get_attribute('href')
-
-                price_element = card.find_element(By.CSS_SELECTOR, "span.lmQWe")
-                product['price'] = price_element.text
-
-                rating_raw = card.find_element(By.CSS_SELECTOR, "span.yi40Hd").text.strip()
-                product['rating'] = rating_raw
-
-                reviews_text = driver.find_element(By.CSS_SELECTOR, "span.QJUAn").text
-                match = re.search(r'(\d+\.?\d*[KM]?)', reviews_text)
-                product['reviews_count'] = match.group(1) if match else "0"
-
                 if self.save_product(product):
+                    saved += 1
                     self.total_saved_count += 1  # ✅ cập nhật biến toàn cục
 
-            except:
-                pass
-
-    def process_cards_LrTUQ(self, driver, cards, simulator):
-        for i, card in enumerate(cards):
-            if self.stop_event.is_set():
-                print(f"{self.name}: Nhận tín hiệu dừng, thoát giữa danh sách sản phẩm LrTUQ.")
-                break
-            product = {}
-            try:
-                driver.execute_script("arguments[0].scrollIntoView({behavior: 'auto', block: 'center'});", card)
-                ActionChains(driver).move_to_element(card).pause(0.5).click().perform()
-                WebDriverWait(driver, 30).until(EC.presence_of_element_located((By.CSS_SELECTOR, "div.mLFOe")))
-                simulator.simulate_reading()
-
-                product['timestamp'] = self.crawl_timestamp
-                product['image_url'] = driver.find_element(By.CSS_SELECTOR, "div.Cl9jQc img.KfAt4d").get_attribute('src')
-                product['name'] = driver.find_element(By.CSS_SELECTOR, "div.bi9tFe").text
-                product['store_url'] = driver.find_element(By.XPATH, "//div[contains(@class, 'sCXXQd')]/a").get_attribute('href')
-
-                price_element = card.find_element(By.CSS_SELECTOR, "span.lmQWe")
-                product['price'] = price_element.text
-
-                rating_raw = card.find_element(By.CSS_SELECTOR, "span.yi40Hd").text.strip()
-                product['rating'] = rating_raw
-
-                reviews_text = driver.find_element(By.CSS_SELECTOR, "span.Bk5Fre").text
-                match = re.search(r'(\d+\.?\d*[KM]?)', reviews_text)
-                product['reviews_count'] = match.group(1) if match else "0"
-
-                if self.save_product(product):
-                    self.total_saved_count += 1  # ✅ cập nhật biến toàn cục
-
-                if i % 5 == 0:
+                every = profile["random_action_every"]
+                if every and i % every == 0:
                     simulator.perform_random_action()
             except:
                 pass
 
-    def process_cards_new_style(self, driver, cards, simulator):
-        pass
+        if extractor.extracted:
+            print(f"{self.name} - Trích xuất {extractor.extracted} thẻ {profile['name']}: "
+                  f"{extractor.extract_seconds * 1000 / extractor.extracted:.0f} ms/thẻ (không tính thời gian giả lập)")
+        return saved
 
     def run(self, stop_event):
         self.stop_event = stop_event
@@ -464,4 +456,6 @@ class ProductCrawler:
             self.connector = connector
             connector.start_safe_consume("keywords", callback)
         except Exception as e:
-            print(f"❌ {self.name} gặp lỗi trong run(): {e}")
\ No newline at end of file
+            print(f"❌ {self.name} gặp lỗi trong run(): {e}")
+        finally:
+            self.driver_pool.close()
\ No newline at end of file
@@ -3,7 +3,8 @@ import time
 import datetime
 import os
 import random
-from crawler import ProductCrawler
+from crawler import ProductCrawler, CRAWLER_TRANSPORT
+from proxy_broker import broker as proxy_broker
 from collections import defaultdict
 
 LOG_FILE_PATH = "crawler_stats_log.txt"
@@ -13,12 +14,12 @@ stats_lock = threading.Lock()
 stop_event = threading.Event()
 all_crawlers = {}
 
-def run_crawler(proxy_key, name):
+def run_crawler(proxy_key, name, transport):
     delay = random.uniform(1, 60)
     print(f"{name} sẽ khởi động sau {delay:.1f} giây...")
     time.sleep(delay)
     try:
-        crawler = ProductCrawler(proxy_key, name)
+        crawler = ProductCrawler(proxy_key, name, transport)
         all_crawlers[proxy_key] = crawler
         crawler.run(stop_event)
     except Exception as e:
@@ -47,11 +48,21 @@ def display_stats():
 
         for proxy_key, crawler in all_crawlers.items():
             count = crawler.total_saved_count
-            print(f"{crawler.name} ({proxy_key}): {count} sản phẩm")
+            print(f"{crawler.name} ({proxy_key}, {crawler.transport}): {count} sản phẩm")
+            session = crawler.driver_pool.snapshot()
+            print(f"   🌐 Chrome: mở {session['launches']} lần, dùng lại {session['reuses']} lần, "
+                  f"đổi proxy tại chỗ {session['proxy_switches']} lần, tiết kiệm ~{session['saved_seconds']}s khởi động")
+            traffic = crawler.request_policy.snapshot()
+            print(f"   📉 {traffic['pages']} trang: trung bình {traffic['avg_kb_per_page']} KB, "
+                  f"{traffic['avg_load_seconds']}s tải, đã chặn {traffic['blocked']} request {traffic['blocked_by_type']}")
             total += count
             log_lines.append(f"{crawler.name} | {count} | {timestamp}")
         log_lines.append(f"Total | {total} | {timestamp}")
         print(f"👉 Tổng cộng: {total} sản phẩm")
+        proxies = proxy_broker.snapshot()
+        print(f"🔁 Proxy broker: {proxies['keys_ready']}/{proxies['keys']} key sẵn sàng, đã lấy {proxies['fetched']}, "
+              f"health check lỗi {proxies['health_failures']}, chậm {proxies['slow']}, loại {proxies['retired']}, "
+              f"crawler phải chờ {proxies['waited']} lần, latency TB {proxies['avg_latency']}s")
         print("============================================================\n")
 
         with open(current_log_file, 'a', encoding='utf-8') as f:
@@ -71,14 +82,20 @@ def monitor_user_input():
 def main():
     threads = []
 
-    # Đọc danh sách proxy key
+    # Đọc danh sách proxy key, mỗi dòng: <key> [wire|extension]
     with open("proxy_list.txt", "r") as f:
-        proxy_keys = [line.strip() for line in f if line.strip()]
+        entries = [line.split() for line in f if line.strip()]
 
-    for idx, key in enumerate(proxy_keys, start=1):
+    # Broker lấy và kiểm tra proxy cho mọi key ngay, trong lúc các crawler còn đang chờ khởi động
+    for entry in entries:
+        proxy_broker.register(entry[0])
+
+    for idx, entry in enumerate(entries, start=1):
         name = f"Crawler-{idx}"
+        key = entry[0]
+        transport = entry[1] if len(entry) > 1 else CRAWLER_TRANSPORT
 
-        t = threading.Thread(target=run_crawler, args=(key, name), daemon=True)
+        t = threading.Thread(target=run_crawler, args=(key, name, transport), daemon=True)
         t.start()
         threads.append(t)
 
@@ -0,0 +1,145 @@
+import os
+import time
+
+try:
+    import psutil
+except ImportError:  # psutil là tùy chọn, thiếu thì không kiểm tra bộ nhớ
+    psutil = None
+
+# Một session Chrome được dùng lại cho nhiều keyword, và được khởi động lại khi:
+#   - đã mở CRAWLER_SESSION_MAX_PAGES trang
+#   - chromedriver + Chrome dùng quá CRAWLER_SESSION_MAX_MB MB RAM (cần psutil)
+#   - đã chạy quá CRAWLER_SESSION_MAX_AGE giây
+#   - keyword trước gặp CAPTCHA hoặc lỗi
+CRAWLER_SESSION_MAX_PAGES = int(os.getenv("CRAWLER_SESSION_MAX_PAGES", "30"))
+CRAWLER_SESSION_MAX_MB = float(os.getenv("CRAWLER_SESSION_MAX_MB", "1500"))
+CRAWLER_SESSION_MAX_AGE = float(os.getenv("CRAWLER_SESSION_MAX_AGE", "3600"))
+
+
+def browser_rss_mb(driver):
+    """RSS (MB) của chromedriver và toàn bộ process con (Chrome, renderer...), None nếu không đo được"""
+    if psutil is None:
+        return None
+    try:
+        root = psutil.Process(driver.service.process.pid)
+        processes = [root] + root.children(recursive=True)
+    except (AttributeError, psutil.Error):
+        return None
+    total = 0
+    for p in processes:
+        try:
+            total += p.memory_info().rss
+        except psutil.Error:
+            pass
+    return total / (1024 * 1024)
+
+
+class BrowserSession:
+    def __init__(self, driver, proxy_options, launch_seconds):
+        self.driver = driver
+        self.proxy_options = proxy_options
+        self.launch_seconds = launch_seconds
+        self.created = time.monotonic()
+        self.pages = 0
+
+
+class DriverPool:
+    """Giữ session Chrome ấm cho một crawler thay vì mở Chrome mới cho mỗi keyword.
+
+    launch_fn(proxy_options) -> driver tạo session mới. Khi proxy đổi, switch_fn(driver, proxy_options) đổi proxy
+    ngay trên session đang chạy; trả về False nếu không đổi được (khi đó session được khởi động lại)."""
+
+    def __init__(self, name, launch_fn, switch_fn=None, max_pages=CRAWLER_SESSION_MAX_PAGES,
+                 max_mb=CRAWLER_SESSION_MAX_MB, max_age=CRAWLER_SESSION_MAX_AGE):
+        self.name = name
+        self.launch_fn = launch_fn
+        self.switch_fn = switch_fn
+        self.max_pages = max_pages
+        self.max_mb = max_mb
+        self.max_age = max_age
+        self.session = None
+        self.stats = {"launches": 0, "reuses": 0, "proxy_switches": 0, "recycled": 0, "launch_seconds": 0.0}
+
+    def recycle_reason(self, session):
+        if session.pages >= self.max_pages:
+            return f"đã mở {session.pages} trang"
+        if time.monotonic() - session.created > self.max_age:
+            return "session quá lâu"
+        rss = browser_rss_mb(session.driver)
+        if rss is not None and rss > self.max_mb:
+            return f"dùng {rss:.0f} MB RAM"
+        return None
+
+    def acquire(self, proxy_options):
+        """Trả về driver sẵn sàng với proxy_options, dùng lại session hiện tại nếu còn tốt"""
+        session = self.session
+        if session is not None:
+            reason = self.recycle_reason(session)
+            if reason is None and session.proxy_options != proxy_options and not self._switch_proxy(session, proxy_options):
+                reason = "không đổi được proxy trên session đang chạy"
+            if reason is not None:
+                print(f"♻️ {self.name} - Khởi động lại Chrome: {reason}")
+                self.close()
+                self.stats["recycled"] += 1
+                session = None
+            else:
+                self.stats["reuses"] += 1
+
+        if session is None:
+            started = time.monotonic()
+            driver = self.launch_fn(proxy_options)
+            elapsed = time.monotonic() - started
+            session = self.session = BrowserSession(driver, proxy_options, elapsed)
+            self.stats["launches"] += 1
+            self.stats["launch_seconds"] += elapsed
+            print(f"🚀 {self.name} - Mở Chrome mất {elapsed:.1f}s")
+
+        session.pages += 1
+        return session.driver
+
+    def _switch_proxy(self, session, proxy_options):
+        if self.switch_fn is None:
+            return False
+        try:
+            if not self.switch_fn(session.driver, proxy_options):
+                return False
+        except Exception as e:
+            print(f"⚠️ {self.name} - Lỗi khi đổi proxy trên session: {e}")
+            return False
+        session.proxy_options = proxy_options
+        self.stats["proxy_switches"] += 1
+        return True
+
+    def release(self, healthy=True):
+        """Gọi sau mỗi keyword. healthy=False (CAPTCHA, lỗi) thì đóng session để lần sau mở Chrome mới"""
+        session = self.session
+        if session is None:
+            return
+        if not healthy:
+            self.close()
+            self.stats["recycled"] += 1
+            return
+        try:
+            # Dọn trạng thái giữa các keyword: bỏ request selenium-wire đã lưu, rời trang kết quả
+            if hasattr(session.driver, "requests"):
+                del session.driver.requests
+            session.driver.get("about:blank")
+        except Exception:
+            self.close()
+
+    def close(self):
+        session, self.session = self.session, None
+        if session is not None:
+            try:
+                session.driver.quit()
+            except Exception:
+                pass
+
+    def saved_seconds(self):
+        """Thời gian khởi động ước tính đã tiết kiệm: số lần dùng lại x thời gian mở Chrome trung bình"""
+        if not self.stats["launches"]:
+            return 0.0
+        return self.stats["reuses"] * self.stats["launch_seconds"] / self.stats["launches"]
+
+    def snapshot(self):
+        return {**self.stats, "saved_seconds": round(self.saved_seconds(), 1)}
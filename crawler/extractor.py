@@ -0,0 +1,155 @@
+import re
+import time
+
+# Mỗi layout kết quả Google Shopping được mô tả bằng một profile selector, không cần viết hàm riêng:
+#   card: selector của thẻ sản phẩm trong danh sách
+#   panel: selector của khung chi tiết mở ra sau khi click thẻ; panel_key: trường phải có giá trị thì khung
+#          mới được coi là đã tải xong
+#   fields: tên trường -> {"scope": "card" | "page", "css" hoặc "xpath", "attr" (bỏ trống = lấy text)}
+#   click_pause: thời gian dừng chuột trên thẻ trước khi click; random_action_every: mỗi N thẻ thực hiện
+#          một hành động ngẫu nhiên giả lập người dùng (0 = không)
+CARD_PROFILES = [
+    {
+        "name": "MtXiu",
+        "card": "div.MtXiu",
+        "panel": "div.mLFOe",
+        "panel_key": "name",
+        "click_pause": 2,
+        "random_action_every": 0,
+        "fields": {
+            "image_url": {"scope": "page", "css": "div.Cl9jQc img.KfAt4d", "attr": "src"},
+            "name": {"scope": "page", "css": "h2.u44bxd"},
+            "store_url": {"scope": "page", "xpath": "//div[contains(@class, 'sCXXQd')]/a", "attr": "href"},
+            "price": {"scope": "card", "css": "span.lmQWe"},
+            "rating": {"scope": "card", "css": "span.yi40Hd"},
+            "reviews_text": {"scope": "page", "css": "span.QJUAn"},
+        },
+    },
+    {
+        "name": "LrTUQ",
+        "card": "div.LrTUQ",
+        "panel": "div.mLFOe",
+        "panel_key": "name",
+        "click_pause": 0.5,
+        "random_action_every": 5,
+        "fields": {
+            "image_url": {"scope": "page", "css": "div.Cl9jQc img.KfAt4d", "attr": "src"},
+            "name": {"scope": "page", "css": "div.bi9tFe"},
+            "store_url": {"scope": "page", "xpath": "//div[contains(@class, 'sCXXQd')]/a", "attr": "href"},
+            "price": {"scope": "card", "css": "span.lmQWe"},
+            "rating": {"scope": "card", "css": "span.yi40Hd"},
+            "reviews_text": {"scope": "page", "css": "span.Bk5Fre"},
+        },
+    },
+]
+
+# Hàm đọc trường dùng chung cho các script bên dưới. attr lấy theo property trước (src / href đã là URL tuyệt đối,
+# giống get_attribute của Selenium), text lấy innerText (giống .text)
+_READ_JS = """
+function __find(root, spec) {
+    if (spec.xpath) {
+        return document.evaluate(spec.xpath, root, null, XPathResult.FIRST_ORDERED_NODE_TYPE, null).singleNodeValue;
+    }
+    return root.querySelector(spec.css);
+}
+function __read(root, spec) {
+    const el = __find(root, spec);
+    if (!el) return null;
+    if (spec.attr) return el[spec.attr] != null ? String(el[spec.attr]) : el.getAttribute(spec.attr);
+    return (el.innerText || el.textContent || "").trim();
+}
+function __fields(root, fields, scope) {
+    const out = {};
+    for (const [name, spec] of Object.entries(fields)) {
+        if (spec.scope === scope) out[name] = __read(root, spec);
+    }
+    return out;
+}
+"""
+
+# Một lần gọi: trường nằm trên thẻ (giá, rating) của tất cả thẻ trong danh sách
+CARDS_JS = _READ_JS + """
+const profile = arguments[0];
+return Array.from(document.querySelectorAll(profile.card)).map(card => __fields(card, profile.fields, "card"));
+"""
+
+# Một lần gọi: cuộn thẻ thứ index vào giữa màn hình, trả về nội dung khung chi tiết đang mở (nếu có).
+# Phần tử panel_key của khung đang mở được đánh dấu data-crawler-stale: khi khung tải sản phẩm mới, phần tử này
+# được vẽ lại (mất dấu) kể cả khi hai thẻ liên tiếp có nội dung giống hệt nhau
+SCROLL_JS = _READ_JS + """
+const [profile, index] = arguments;
+const card = document.querySelectorAll(profile.card)[index];
+if (card) card.scrollIntoView({behavior: 'auto', block: 'center'});
+const panel = document.querySelector(profile.panel);
+if (!panel) return null;
+const key = __find(document, profile.fields[profile.panel_key]);
+if (key) key.setAttribute("data-crawler-stale", String(index));
+return JSON.stringify(__fields(document, profile.fields, "page"));
+"""
+
+# Một lần gọi (async): chờ khung chi tiết chuyển sang sản phẩm mới (nội dung khác, hoặc phần tử panel_key đã được
+# vẽ lại không còn dấu của scroll_to) rồi trả về toàn bộ trường "page"
+PANEL_JS = _READ_JS + """
+const [profile, previous, timeoutMs, done] = arguments;
+const deadline = Date.now() + timeoutMs;
+(function poll() {
+    if (document.querySelector(profile.panel)) {
+        const fields = __fields(document, profile.fields, "page");
+        const key = __find(document, profile.fields[profile.panel_key]);
+        const redrawn = key && !key.hasAttribute("data-crawler-stale");
+        if (fields[profile.panel_key] && (JSON.stringify(fields) !== previous || redrawn)) return done(fields);
+    }
+    if (Date.now() > deadline) return done(null);
+    setTimeout(poll, 100);
+})();
+"""
+
+
+def parse_reviews_count(reviews_text):
+    match = re.search(r'(\d+\.?\d*[KM]?)', reviews_text or "")
+    return match.group(1) if match else "0"
+
+
+class CardExtractor:
+    """Trích xuất sản phẩm theo profile với số round trip tối thiểu tới chromedriver:
+    một lần cho trường trên thẻ của cả trang, rồi mỗi thẻ một lần cuộn và một lần đọc khung chi tiết.
+    Click vẫn dùng ActionChains (sự kiện chuột thật, không phải click bằng JavaScript)."""
+
+    def __init__(self, driver, profile, timeout=30):
+        self.driver = driver
+        self.profile = profile
+        self.timeout = timeout
+        self.card_data = []
+        self.extract_seconds = 0.0
+        self.extracted = 0
+        driver.set_script_timeout(timeout + 5)
+
+    def load_cards(self):
+        started = time.monotonic()
+        self.card_data = self.driver.execute_script(CARDS_JS, self.profile)
+        self.extract_seconds += time.monotonic() - started
+        return len(self.card_data)
+
+    def scroll_to(self, index):
+        """Trả về nội dung khung chi tiết đang mở và đánh dấu phần tử panel_key của nó, dùng để nhận biết khung
+        đã cập nhật sau khi click"""
+        started = time.monotonic()
+        previous = self.driver.execute_script(SCROLL_JS, self.profile, index)
+        self.extract_seconds += time.monotonic() - started
+        return previous
+
+    def read_panel(self, index, previous):
+        """Trả về dict sản phẩm (chưa có timestamp) hoặc None nếu khung chi tiết không cập nhật kịp"""
+        started = time.monotonic()
+        fields = self.driver.execute_async_script(PANEL_JS, self.profile, previous, int(self.timeout * 1000))
+        self.extract_seconds += time.monotonic() - started
+        if not fields:
+            return None
+        card = self.card_data[index] if index < len(self.card_data) else {}
+        product = {**card, **fields}
+        if any(product.get(name) is None for name in self.profile["fields"]):
+            # Thiếu trường nào thì bỏ sản phẩm (như khi find_element lỗi trước đây)
+            return None
+        product["reviews_count"] = parse_reviews_count(product.pop("reviews_text", None))
+        self.extracted += 1
+        return product
@@ -0,0 +1,254 @@
+import os
+import time
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+
+from proxy import RotatingProxy
+
+# Broker dùng chung cho mọi crawler trong process: lấy proxy mới và kiểm tra trước ở thread nền, crawler nhận
+# proxy đã sẵn sàng ngay khi bắt đầu keyword thay vì tự chờ 60 giây / gọi lại API trong thread crawl.
+#   - mỗi key chỉ đổi proxy khi crawler của key đó đang nghỉ giữa hai keyword (không đổi IP giữa chừng) và đã
+#     dùng proxy hiện tại ít nhất PROXY_ROTATE_SECONDS (giới hạn của API)
+#   - chỉ đổi khi crawler đã nghỉ ít nhất PROXY_MIN_IDLE_SECONDS, để không bắt đầu đổi ngay trước keyword kế tiếp
+#   - gọi API đổi IP exit phía sau gateway, nên crawler nhận proxy khi key đang được làm mới vẫn chờ lần làm mới
+#     đó xong trước (không đổi IP giữa keyword): tối đa một lần gọi API (10s) cộng PROXY_HEALTH_TIMEOUT
+#   - proxy mới phải qua health check (PROXY_HEALTH_URL) trong PROXY_MAX_LATENCY giây mới được giao; health check
+#     trả về IP exit thật (ip/port của proxy là gateway, giống nhau cho mọi exit)
+#   - IP exit chậm (sau ít nhất PROXY_MIN_CHECKS lần đo) hoặc có tỉ lệ lỗi (CAPTCHA, lỗi tải trang) cao bị loại
+#     trong PROXY_RETIRE_SECONDS giây, với mọi key
+PROXY_ROTATE_SECONDS = float(os.getenv("PROXY_ROTATE_SECONDS", "60"))
+PROXY_MIN_IDLE_SECONDS = float(os.getenv("PROXY_MIN_IDLE_SECONDS", "3"))
+# Phải trả về IP exit (JSON {"ip": ...} hoặc text); URL khác vẫn dùng được, khi đó số liệu tính theo gateway
+PROXY_HEALTH_URL = os.getenv("PROXY_HEALTH_URL", "https://api.ipify.org?format=json")
+PROXY_HEALTH_TIMEOUT = float(os.getenv("PROXY_HEALTH_TIMEOUT", "10"))
+PROXY_MAX_LATENCY = float(os.getenv("PROXY_MAX_LATENCY", "5"))
+PROXY_MAX_FAILURE_RATE = float(os.getenv("PROXY_MAX_FAILURE_RATE", "0.5"))
+PROXY_MIN_USES = int(os.getenv("PROXY_MIN_USES", "3"))
+PROXY_MIN_CHECKS = int(os.getenv("PROXY_MIN_CHECKS", "3"))
+PROXY_RETIRE_SECONDS = float(os.getenv("PROXY_RETIRE_SECONDS", "1800"))
+PROXY_ACQUIRE_TIMEOUT = float(os.getenv("PROXY_ACQUIRE_TIMEOUT", "300"))
+PROXY_BROKER_WORKERS = int(os.getenv("PROXY_BROKER_WORKERS", "4"))
+
+
+def proxy_url(proxy):
+    return f"http://{proxy['username']}:{proxy['password']}@{proxy['ip']}:{proxy['port']}"
+
+
+def exit_ip(proxy):
+    """IP exit đã đo được khi health check, không có thì dùng IP gateway"""
+    return proxy.get("exit_ip") or proxy["ip"]
+
+
+def parse_exit_ip(response):
+    try:
+        body = response.json()
+        ip = body.get("ip") if isinstance(body, dict) else None
+    except ValueError:
+        ip = response.text.strip()
+    if isinstance(ip, str) and ip and len(ip) <= 45 and all(c.isalnum() or c in ".:" for c in ip):
+        return ip
+    return None
+
+
+class ExitStats:
+    """Số liệu của một IP exit, dùng chung giữa các key"""
+
+    def __init__(self):
+        self.checks = 0
+        self.latency = None  # trung bình trượt (EWMA) của thời gian health check
+        self.uses = 0
+        self.failures = 0
+        self.retired_until = 0.0
+
+    def record_latency(self, seconds):
+        self.checks += 1
+        self.latency = seconds if self.latency is None else 0.7 * self.latency + 0.3 * seconds
+
+    def failure_rate(self):
+        return self.failures / self.uses if self.uses else 0.0
+
+    def retired(self, now):
+        return now < self.retired_until
+
+
+class KeyState:
+    def __init__(self, key):
+        self.key = key
+        self.client = RotatingProxy(key)
+        self.proxy = None
+        self.handed = None  # proxy đang giao cho crawler (proxy có thể đã được làm mới trong lúc crawler dùng)
+        self.changed_at = 0.0
+        self.next_fetch = 0.0
+        self.in_use = False
+        self.released_at = 0.0
+        self.fetching = False
+
+
+class ProxyBroker:
+    def __init__(self, workers=PROXY_BROKER_WORKERS):
+        self.keys = {}
+        self.exits = {}
+        self._cond = threading.Condition()
+        self._executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="proxy-broker")
+        self._thread = None
+        self.stats = {"fetched": 0, "api_failures": 0, "health_failures": 0, "slow": 0, "retired": 0,
+                      "handed_out": 0, "waited": 0, "rotation_waits": 0}
+
+    def register(self, key):
+        with self._cond:
+            self.keys.setdefault(key, KeyState(key))
+            if self._thread is None:
+                self._thread = threading.Thread(target=self._loop, name="proxy-broker", daemon=True)
+                self._thread.start()
+            self._cond.notify_all()
+
+    def acquire(self, key, timeout=PROXY_ACQUIRE_TIMEOUT):
+        """Proxy sẵn sàng cho key ({ip, port, username, password}); chỉ chờ khi key chưa có proxy nào dùng được
+        (lúc khởi động, hoặc proxy vừa bị loại). Trả về None nếu hết timeout."""
+        self.register(key)
+        deadline = time.monotonic() + timeout
+        with self._cond:
+            state = self.keys[key]
+            if state.fetching:
+                # Đang gọi API đổi IP exit: giao proxy bây giờ thì IP đổi ngay giữa keyword, chờ lần làm mới xong
+                self.stats["rotation_waits"] += 1
+                self._cond.wait_for(lambda: not state.fetching, timeout)
+                if state.fetching:
+                    return None
+            state.in_use = True
+            if state.proxy is None:
+                self.stats["waited"] += 1
+                print(f"⏳ Proxy broker - Chờ proxy cho key ...{key[-6:]}")
+                self._cond.wait_for(lambda: state.proxy is not None, max(0.0, deadline - time.monotonic()))
+            if state.proxy is None:
+                state.in_use = False
+                return None
+            self.stats["handed_out"] += 1
+            state.handed = dict(state.proxy)
+            return dict(state.handed)
+
+    def release(self, key, ok=True):
+        """Crawler xong một keyword: ghi nhận kết quả cho IP exit và cho phép broker đổi proxy của key"""
+        with self._cond:
+            state = self.keys.get(key)
+            if state is None or not state.in_use:
+                return
+            state.in_use = False
+            state.released_at = now = time.time()
+            handed, state.handed = state.handed, None
+            if handed is not None:
+                ip = exit_ip(handed)
+                exit_stats = self._exit(ip)
+                exit_stats.uses += 1
+                exit_stats.failures += 0 if ok else 1
+                if exit_stats.uses >= PROXY_MIN_USES and exit_stats.failure_rate() >= PROXY_MAX_FAILURE_RATE:
+                    exit_stats.retired_until = now + PROXY_RETIRE_SECONDS
+                    self.stats["retired"] += 1
+                    print(f"🚫 Proxy broker - Loại exit {ip} (tỉ lệ lỗi {exit_stats.failure_rate():.0%})")
+                    if state.proxy is not None and exit_ip(state.proxy) == ip:
+                        state.proxy = None
+            self._cond.notify_all()
+
+    def _exit(self, ip):
+        return self.exits.setdefault(ip, ExitStats())
+
+    def _due(self, state, now):
+        if state.fetching or now < state.next_fetch:
+            return False
+        # Có proxy rồi thì chỉ đổi khi crawler đã nghỉ một lúc, tránh đổi IP giữa một keyword và giảm khả năng
+        # keyword kế tiếp bắt đầu đúng lúc đang đổi (khi đó acquire phải chờ)
+        if state.proxy is None:
+            return True
+        return not state.in_use and now - state.released_at >= PROXY_MIN_IDLE_SECONDS
+
+    def _loop(self):
+        while True:
+            with self._cond:
+                now = time.time()
+                for state in self.keys.values():
+                    if self._due(state, now):
+                        state.fetching = True
+                        self._executor.submit(self._refresh, state)
+                self._cond.wait(1)
+
+    def _refresh(self, state):
+        # Gọi API thành công là IP exit phía sau gateway đã đổi: từ đó trở đi state.proxy phải mang IP exit vừa đo,
+        # hoặc bị bỏ (None) để key lấy proxy mới ngay khi API cho phép; không giữ nhãn của exit cũ
+        rotated = False
+        try:
+            proxy = state.client.get_new_proxy()
+            if proxy is None:
+                with self._cond:
+                    self.stats["api_failures"] += 1
+                return
+            rotated = True
+
+            latency, ip = self.check(proxy)
+            now = time.time()
+            with self._cond:
+                if latency is None:
+                    # Chưa biết IP exit nên không tính vào số liệu exit nào (tránh loại nhầm gateway)
+                    self.stats["health_failures"] += 1
+                    state.proxy = None
+                    return
+                ip = ip or proxy["ip"]
+                exit_stats = self._exit(ip)
+                if exit_stats.retired(now):
+                    print(f"🚫 Proxy broker - Bỏ qua exit đã bị loại {ip}")
+                    state.proxy = None
+                    return
+                exit_stats.record_latency(latency)
+                if exit_stats.checks >= PROXY_MIN_CHECKS and exit_stats.latency > PROXY_MAX_LATENCY:
+                    self.stats["slow"] += 1
+                    exit_stats.retired_until = now + PROXY_RETIRE_SECONDS
+                    print(f"🐢 Proxy broker - Loại exit {ip} chậm ({exit_stats.latency:.1f}s)")
+                    state.proxy = None
+                    return
+                if latency > PROXY_MAX_LATENCY:
+                    # Một lần đo chậm chưa đủ để loại exit; exit đã đổi nên vẫn giao, với nhãn của exit mới
+                    self.stats["slow"] += 1
+                    print(f"🐢 Proxy broker - Exit {ip} chậm ({latency:.1f}s), chưa đủ {PROXY_MIN_CHECKS} lần đo để loại")
+                state.proxy = {**proxy, "exit_ip": ip, "latency": round(latency, 3)}
+                state.changed_at = now
+                self.stats["fetched"] += 1
+        except Exception as e:
+            print(f"❌ Proxy broker - Lỗi khi làm mới proxy: {e}")
+            if rotated:
+                with self._cond:
+                    state.proxy = None
+        finally:
+            with self._cond:
+                # Lần lấy tiếp theo (thành công hay không) đều phải cách PROXY_ROTATE_SECONDS vì giới hạn của API
+                state.next_fetch = time.time() + PROXY_ROTATE_SECONDS
+                state.fetching = False
+                self._cond.notify_all()
+
+    def check(self, proxy):
+        """(thời gian (giây) để tải PROXY_HEALTH_URL qua proxy, IP exit đọc từ phản hồi hoặc None);
+        (None, None) nếu lỗi"""
+        url = proxy_url(proxy)
+        started = time.monotonic()
+        try:
+            r = requests.get(PROXY_HEALTH_URL, proxies={"http": url, "https": url}, timeout=PROXY_HEALTH_TIMEOUT)
+            if r.status_code >= 400:
+                return None, None
+        except requests.RequestException:
+            return None, None
+        return time.monotonic() - started, parse_exit_ip(r)
+
+    def snapshot(self):
+        with self._cond:
+            now = time.time()
+            latencies = [e.latency for e in self.exits.values() if e.latency is not None]
+            return {
+                **self.stats,
+                "keys_ready": sum(1 for s in self.keys.values() if s.proxy is not None),
+                "keys": len(self.keys),
+                "exits_retired": sum(1 for e in self.exits.values() if e.retired(now)),
+                "avg_latency": round(sum(latencies) / len(latencies), 2) if latencies else None,
+            }
+
+
+broker = ProxyBroker()
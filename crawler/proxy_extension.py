@@ -0,0 +1,86 @@
+import json
+import os
+import tempfile
+import zipfile
+from urllib.parse import urlsplit, unquote
+
+# Chế độ "extension": Chrome tự kết nối tới proxy có xác thực qua một extension MV3 sinh ra lúc khởi động,
+# không còn proxy MITM Python (selenium-wire) nằm giữa mọi request. Chặn tài nguyên dùng declarativeNetRequest
+# của chính extension. Thông tin proxy được đóng vào extension nên đổi proxy = mở lại Chrome.
+
+_BACKGROUND_JS = """
+const config = %(config)s;
+chrome.proxy.settings.set({
+    value: {
+        mode: "fixed_servers",
+        rules: {
+            singleProxy: {scheme: config.scheme, host: config.host, port: config.port},
+            bypassList: ["localhost", "127.0.0.1"]
+        }
+    },
+    scope: "regular"
+});
+chrome.webRequest.onAuthRequired.addListener(
+    (details, callback) => callback({authCredentials: {username: config.username, password: config.password}}),
+    {urls: ["<all_urls>"]},
+    ["asyncBlocking"]
+);
+"""
+
+# Sec-Fetch-Dest (RequestPolicy) -> resourceTypes của declarativeNetRequest
+_DNR_TYPES = {
+    "image": "image",
+    "font": "font",
+    "media": "media",
+    "style": "stylesheet",
+    "script": "script",
+    "iframe": "sub_frame",
+    "empty": "xmlhttprequest",
+}
+
+
+def parse_proxy_url(proxy_url):
+    parts = urlsplit(proxy_url)
+    return {
+        "scheme": parts.scheme or "http",
+        "host": parts.hostname,
+        "port": parts.port,
+        "username": unquote(parts.username or ""),
+        "password": unquote(parts.password or ""),
+    }
+
+
+def block_rules(block_types, block_patterns):
+    """Luật declarativeNetRequest tương đương RequestPolicy.block_reason"""
+    rules = []
+    resource_types = sorted({_DNR_TYPES[t] for t in block_types if t in _DNR_TYPES})
+    if resource_types:
+        rules.append({"resourceTypes": resource_types})
+    rules.extend({"urlFilter": pattern} for pattern in block_patterns)
+    return [
+        {"id": i, "priority": 1, "action": {"type": "block"}, "condition": condition}
+        for i, condition in enumerate(rules, start=1)
+    ]
+
+
+def build_proxy_extension(proxy_url, block_types=(), block_patterns=(), name="proxy"):
+    """Ghi extension (zip) vào thư mục tạm, trả về đường dẫn. Xóa file sau khi webdriver.Chrome() đã khởi động."""
+    manifest = {
+        "manifest_version": 3,
+        "name": f"Crawler proxy ({name})",
+        "version": "1.0",
+        "permissions": ["proxy", "webRequest", "webRequestAuthProvider", "declarativeNetRequest"],
+        "host_permissions": ["<all_urls>"],
+        "background": {"service_worker": "background.js"},
+        "declarative_net_request": {
+            "rule_resources": [{"id": "block", "enabled": True, "path": "rules.json"}]
+        },
+        "minimum_chrome_version": "108",
+    }
+    fd, path = tempfile.mkstemp(prefix=f"proxy_ext_{name}_", suffix=".zip")
+    os.close(fd)
+    with zipfile.ZipFile(path, "w") as zf:
+        zf.writestr("manifest.json", json.dumps(manifest))
+        zf.writestr("background.js", _BACKGROUND_JS % {"config": json.dumps(parse_proxy_url(proxy_url))})
+        zf.writestr("rules.json", json.dumps(block_rules(block_types, block_patterns)))
+    return path
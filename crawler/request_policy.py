@@ -0,0 +1,155 @@
+import os
+import json
+import threading
+from urllib.parse import urlsplit
+
+# Loại tài nguyên bị chặn (theo header Sec-Fetch-Dest Chrome gửi kèm mỗi request): image, font, media, style,
+# script, ... Extractor chỉ đọc DOM (src / href là thuộc tính, không cần tải ảnh), ảnh sản phẩm được tải riêng
+# bằng requests khi lưu. Để trống để không chặn theo loại.
+CRAWLER_BLOCK_RESOURCE_TYPES = os.getenv("CRAWLER_BLOCK_RESOURCE_TYPES", "image,font,media")
+# Chuỗi con trong URL bị chặn (analytics, quảng cáo, log), ngăn cách bởi dấu phẩy
+CRAWLER_BLOCK_URL_PATTERNS = os.getenv(
+    "CRAWLER_BLOCK_URL_PATTERNS",
+    "google-analytics.com,googletagmanager.com,doubleclick.net,googlesyndication.com,"
+    "googleadservices.com,adservice.google.,/gen_204,/client_204,play.google.com/log",
+)
+# Số request tối đa selenium-wire giữ trong bộ nhớ (mặc định của selenium-wire là lưu hết xuống đĩa)
+CRAWLER_WIRE_MAX_REQUESTS = int(os.getenv("CRAWLER_WIRE_MAX_REQUESTS", "100"))
+
+# Dùng khi request không có Sec-Fetch-Dest (HTTP thường)
+_EXTENSION_TYPES = {
+    "image": (".png", ".jpg", ".jpeg", ".gif", ".webp", ".svg", ".ico", ".avif"),
+    "font": (".woff", ".woff2", ".ttf", ".otf", ".eot"),
+    "media": (".mp4", ".webm", ".mp3", ".ogg", ".m4a"),
+    "style": (".css",),
+}
+_MEDIA_DESTS = {"audio", "video", "track"}
+
+
+def _split(value):
+    return [v.strip() for v in value.split(",") if v.strip()]
+
+
+def resource_type(url, headers):
+    dest = (headers.get("Sec-Fetch-Dest") or "").lower()
+    if dest:
+        return "media" if dest in _MEDIA_DESTS else dest
+    path = urlsplit(url).path.lower()
+    for kind, extensions in _EXTENSION_TYPES.items():
+        if path.endswith(extensions):
+            return kind
+    return "other"
+
+
+class RequestPolicy:
+    """Chặn tài nguyên không cần thiết trước khi chúng đi qua proxy, và đếm byte / request theo từng trang.
+    Với driver selenium-wire: attach() gắn interceptor (chạy trên thread của selenium-wire). Với driver Chrome
+    thường (chế độ extension): extension chặn bằng declarativeNetRequest, số liệu đọc từ performance log."""
+
+    def __init__(self, block_types=CRAWLER_BLOCK_RESOURCE_TYPES, block_patterns=CRAWLER_BLOCK_URL_PATTERNS,
+                 max_stored=CRAWLER_WIRE_MAX_REQUESTS):
+        self.block_types = set(_split(block_types))
+        self.block_patterns = _split(block_patterns)
+        self.max_stored = max_stored
+        self._lock = threading.Lock()
+        self.page = self._empty()
+        self.totals = {**self._empty(), "pages": 0, "load_seconds": 0.0}
+
+    @staticmethod
+    def _empty():
+        return {"requests": 0, "bytes": 0, "blocked": 0, "blocked_by_type": {}}
+
+    def seleniumwire_options(self):
+        """Giới hạn những gì selenium-wire lưu lại: chỉ giữ trong RAM, tối đa max_stored request"""
+        return {
+            "request_storage": "memory",
+            "request_storage_max_size": self.max_stored,
+        }
+
+    def block_reason(self, url, headers):
+        kind = resource_type(url, headers)
+        if kind in self.block_types:
+            return kind
+        for pattern in self.block_patterns:
+            if pattern in url:
+                return "pattern"
+        return None
+
+    def chrome_logging_options(self, chrome_options):
+        """Bật performance log (chỉ sự kiện Network) cho driver không dùng selenium-wire"""
+        chrome_options.set_capability("goog:loggingPrefs", {"performance": "ALL"})
+        chrome_options.add_experimental_option("perfLoggingPrefs", {"enableNetwork": True, "enablePage": False})
+
+    def attach(self, driver):
+        if hasattr(driver, "request_interceptor"):
+            driver.request_interceptor = self._intercept_request
+            driver.response_interceptor = self._intercept_response
+
+    def _collect(self, driver):
+        if driver is None or hasattr(driver, "request_interceptor"):
+            return
+        try:
+            entries = driver.get_log("performance")
+        except Exception:
+            return
+        requests = size = blocked = 0
+        blocked_by_type = {}
+        for entry in entries:
+            message = json.loads(entry["message"])["message"]
+            params = message.get("params", {})
+            if message.get("method") == "Network.loadingFinished":
+                requests += 1
+                size += int(params.get("encodedDataLength", 0))
+            elif message.get("method") == "Network.loadingFailed" and params.get("errorText") == "net::ERR_BLOCKED_BY_CLIENT":
+                blocked += 1
+                kind = params.get("type", "other").lower()
+                blocked_by_type[kind] = blocked_by_type.get(kind, 0) + 1
+        with self._lock:
+            self.page["requests"] += requests
+            self.page["bytes"] += size
+            self.page["blocked"] += blocked
+            for kind, n in blocked_by_type.items():
+                self.page["blocked_by_type"][kind] = self.page["blocked_by_type"].get(kind, 0) + n
+
+    def _intercept_request(self, request):
+        reason = self.block_reason(request.url, request.headers)
+        if reason is not None:
+            # 204 trả ngay từ selenium-wire, không có byte nào đi qua proxy
+            request.abort(error_code=204)
+            with self._lock:
+                self.page["blocked"] += 1
+                self.page["blocked_by_type"][reason] = self.page["blocked_by_type"].get(reason, 0) + 1
+
+    def _intercept_response(self, request, response):
+        size = len(response.body or b"") + sum(len(k) + len(v) + 4 for k, v in response.headers.items())
+        with self._lock:
+            self.page["requests"] += 1
+            self.page["bytes"] += size
+
+    def start_page(self, driver=None):
+        self._collect(driver)  # bỏ log còn lại từ trang trước
+        with self._lock:
+            self.page = self._empty()
+
+    def finish_page(self, load_seconds, driver=None):
+        """Cộng số liệu của trang vừa xong vào tổng, trả về số liệu của trang"""
+        self._collect(driver)
+        with self._lock:
+            page, self.page = self.page, self._empty()
+            for key in ("requests", "bytes", "blocked"):
+                self.totals[key] += page[key]
+            for kind, n in page["blocked_by_type"].items():
+                self.totals["blocked_by_type"][kind] = self.totals["blocked_by_type"].get(kind, 0) + n
+            self.totals["pages"] += 1
+            self.totals["load_seconds"] += load_seconds
+        return {**page, "load_seconds": round(load_seconds, 2)}
+
+    def snapshot(self):
+        with self._lock:
+            pages = self.totals["pages"]
+            return {
+                **self.totals,
+                "blocked_by_type": dict(self.totals["blocked_by_type"]),
+                "avg_kb_per_page": round(self.totals["bytes"] / 1024 / pages, 1) if pages else 0.0,
+                "avg_load_seconds": round(self.totals["load_seconds"] / pages, 2) if pages else 0.0,
+            }
@@ -0,0 +1,407 @@
+import os
+import json
+import time
+import queue
+import zipfile
+import argparse
+import threading
+from datetime import datetime
+
+import boto3
+
+from data_management import (
+    es,
+    ES_INDEX,
+    clean_data,
+    latest_by_id,
+    stored_versions,
+    stored_fingerprints,
+    image_input_from_bytes,
+    download_image_input,
+    encode_changed,
+    upsert_to_milvus,
+)
+from pipeline import Stage, BatchStage, report_stats, DOWNLOAD_CONCURRENCY, WRITER_CONCURRENCY, QUEUE_SIZE
+
+# Nạp lại toàn bộ dữ liệu từ các archive mà crawler đã zip (json_<timestamp>_<máy>.zip và image_<...>.zip),
+# không đi qua SQS: đọc archive -> giải mã ảnh -> encode theo batch lớn -> ghi bulk.
+# Tiến độ được lưu theo từng archive vào file checkpoint nên chạy lại sẽ tiếp tục từ archive dở dang.
+BACKFILL_BATCH_SIZE = int(os.getenv("BACKFILL_BATCH_SIZE", "64"))
+BACKFILL_READ_CHUNK = int(os.getenv("BACKFILL_READ_CHUNK", "256"))
+# S3 (hoặc bản giả lập local như MinIO) chứa archives/json và archives/image
+BACKFILL_S3_BUCKET = os.getenv("BACKFILL_S3_BUCKET", os.getenv("S3_BUCKET_NAME", ""))
+BACKFILL_S3_ENDPOINT = os.getenv("BACKFILL_S3_ENDPOINT", "")
+# Số lần thử lại truy vấn Milvus của bước đọc trước khi coi cả chunk là lỗi
+BACKFILL_LOOKUP_RETRIES = int(os.getenv("BACKFILL_LOOKUP_RETRIES", "3"))
+# Mọi stage rảnh, hàng đợi rỗng quá số giây này mà checkpoint chưa xong thì dừng (tránh chờ mãi)
+BACKFILL_IDLE_EXIT = float(os.getenv("BACKFILL_IDLE_EXIT", "60"))
+
+
+def crawl_time(path):
+    """json_17062025_101500_may1.zip -> datetime của lần crawl (để nạp theo thứ tự thời gian)"""
+    parts = os.path.basename(path).split("_")
+    try:
+        return datetime.strptime(f"{parts[1]}_{parts[2]}", "%d%m%Y_%H%M%S")
+    except (IndexError, ValueError):
+        return datetime.min
+
+
+def find_archives(directory):
+    """Tìm các cặp (archive json, archive ảnh cùng lần crawl hoặc None), sắp xếp theo thời gian crawl"""
+    json_archives, image_archives = [], {}
+    for root, _, files in os.walk(directory):
+        for name in files:
+            if not name.endswith(".zip"):
+                continue
+            if name.startswith("json_"):
+                json_archives.append(os.path.join(root, name))
+            elif name.startswith("image_"):
+                image_archives[name[len("image_"):]] = os.path.join(root, name)
+    json_archives.sort(key=crawl_time)
+    return [(path, image_archives.get(os.path.basename(path)[len("json_"):])) for path in json_archives]
+
+
+def download_archives(bucket, staging_dir, endpoint_url=BACKFILL_S3_ENDPOINT, prefix="archives/"):
+    """Tải các archive từ S3 về staging_dir (bỏ qua file đã tải đủ), trả về staging_dir"""
+    s3 = boto3.client(
+        "s3",
+        endpoint_url=endpoint_url or None,
+        aws_access_key_id=os.getenv("AWS_ACCESS_KEY"),
+        aws_secret_access_key=os.getenv("AWS_SECRET_KEY"),
+        region_name=os.getenv("AWS_REGION"),
+    )
+    os.makedirs(staging_dir, exist_ok=True)
+    for page in s3.get_paginator("list_objects_v2").paginate(Bucket=bucket, Prefix=prefix):
+        for obj in page.get("Contents", []):
+            if not obj["Key"].endswith(".zip"):
+                continue
+            path = os.path.join(staging_dir, os.path.basename(obj["Key"]))
+            if os.path.exists(path) and os.path.getsize(path) == obj["Size"]:
+                continue
+            s3.download_file(bucket, obj["Key"], f"{path}.tmp")
+            os.replace(f"{path}.tmp", path)
+            print(f"📥 Đã tải s3://{bucket}/{obj['Key']}")
+    return staging_dir
+
+
+class Checkpoint:
+    """Theo dõi số record đã đọc / đã xong của từng archive. Archive đọc hết và xong hết (không lỗi) thì ghi vào file;
+    archive có record lỗi không được đánh dấu xong nên lần chạy sau sẽ đọc lại (record đã ghi được bỏ qua nhanh).
+    File cũng giữ refresh_interval gốc của index ES cho tới khi được khôi phục."""
+
+    def __init__(self, path):
+        self.path = path
+        self.lock = threading.Lock()
+        self.completed = set()
+        self.saved_refresh = False
+        self.refresh_interval = None
+        if os.path.exists(path):
+            with open(path, encoding="utf-8") as f:
+                saved = json.load(f)
+            self.completed = set(saved.get("completed", []))
+            self.saved_refresh = "refresh_interval" in saved
+            self.refresh_interval = saved.get("refresh_interval")
+        self.progress = {}
+        self.stats = {"read": 0, "skipped": 0, "history": 0, "reused": 0, "encoded": 0, "failed": 0}
+
+    def _write(self):
+        """Gọi khi đang giữ lock"""
+        state = {"completed": sorted(self.completed), "stats": self.stats}
+        if self.saved_refresh:
+            state["refresh_interval"] = self.refresh_interval
+        tmp = f"{self.path}.tmp"
+        with open(tmp, "w", encoding="utf-8") as f:
+            json.dump(state, f, indent=2)
+        os.replace(tmp, self.path)
+
+    def save_refresh_interval(self, value):
+        with self.lock:
+            self.saved_refresh, self.refresh_interval = True, value
+            self._write()
+
+    def clear_refresh_interval(self):
+        with self.lock:
+            self.saved_refresh, self.refresh_interval = False, None
+            self._write()
+
+    def read(self, archive, n):
+        with self.lock:
+            self.progress.setdefault(archive, {"read": 0, "done": 0, "failed": 0, "eof": False})["read"] += n
+            self.stats["read"] += n
+
+    def end_of_archive(self, archive):
+        with self.lock:
+            self.progress.setdefault(archive, {"read": 0, "done": 0, "failed": 0, "eof": False})["eof"] = True
+        self._maybe_complete(archive)
+
+    def archive_failed(self, archive):
+        """Archive không đọc được (zip hỏng...): không đánh dấu xong để lần sau đọc lại"""
+        with self.lock:
+            self.progress.setdefault(archive, {"read": 0, "done": 0, "failed": 0, "eof": False})["failed"] += 1
+
+    def done(self, archives, outcome):
+        """archives: archive của từng record đã xử lý xong; outcome: skipped | history | reused | encoded | failed"""
+        with self.lock:
+            for archive in archives:
+                self.progress[archive]["done"] += 1
+                if outcome == "failed":
+                    self.progress[archive]["failed"] += 1
+            self.stats[outcome] += len(archives)
+        for archive in set(archives):
+            self._maybe_complete(archive)
+
+    def _maybe_complete(self, archive):
+        with self.lock:
+            p = self.progress[archive]
+            if not p["eof"] or p["done"] < p["read"] or p.get("reported"):
+                return
+            p["reported"] = True
+            if p["failed"]:
+                print(f"⚠️ Archive {archive}: {p['failed']}/{p['read']} record lỗi, sẽ thử lại ở lần chạy sau")
+                return
+            self.completed.add(archive)
+            self._write()
+        print(f"✅ Xong archive {archive}")
+
+    def finished(self):
+        with self.lock:
+            return all(p["eof"] and p["done"] >= p["read"] for p in self.progress.values())
+
+    def unfinished(self):
+        with self.lock:
+            return [a for a, p in self.progress.items() if not p["eof"] or p["done"] < p["read"]]
+
+
+class ArchiveReader:
+    """Đọc lần lượt các record trong archive; mỗi lần gọi trả về một chunk đã lọc bỏ bản đã ghi"""
+
+    def __init__(self, archives, checkpoint, chunk_size=BACKFILL_READ_CHUNK):
+        self.archives = [a for a in archives if os.path.basename(a[0]) not in checkpoint.completed]
+        self.checkpoint = checkpoint
+        self.chunk_size = chunk_size
+        self.records = self._records()
+        self.exhausted = False
+
+    def _records(self):
+        for json_path, image_path in self.archives:
+            archive = os.path.basename(json_path)
+            images = None
+            try:
+                images = zipfile.ZipFile(image_path) if image_path else None
+                image_names = {os.path.basename(n): n for n in images.namelist()} if images else {}
+                with zipfile.ZipFile(json_path) as jsons:
+                    for name in jsons.namelist():
+                        if not name.endswith(".json"):
+                            continue
+                        try:
+                            data = clean_data(json.loads(jsons.read(name)))
+                        except Exception as e:
+                            print(f"❌ Bỏ qua {archive}/{name}: {e}")
+                            continue
+                        file_id = data.get("id", "").strip()
+                        if not file_id:
+                            continue
+                        image_name = image_names.get(f"{file_id}.jpg")
+                        content = images.read(image_name) if image_name else None
+                        yield {"file_id": file_id, "data": data, "content": content, "archive": archive}
+            except Exception as e:
+                # Lỗi ở mức archive (zip hỏng, không đọc được): bỏ phần còn lại, lần chạy sau đọc lại
+                print(f"❌ Không đọc được archive {archive}: {e}")
+                self.checkpoint.archive_failed(archive)
+            finally:
+                if images:
+                    images.close()
+            yield {"end_of_archive": archive}
+
+    def read_chunk(self):
+        if self.exhausted:
+            time.sleep(1)
+            return []
+        chunk, ended, exhausted = [], [], False
+        for record in self.records:
+            if "end_of_archive" in record:
+                ended.append(record["end_of_archive"])
+                if len(chunk) >= self.chunk_size // 2:
+                    break
+                continue
+            chunk.append(record)
+            if len(chunk) >= self.chunk_size:
+                break
+        else:
+            exhausted = True
+
+        # Tra Milvus trước khi ghi nhận tiến độ; lỗi hẳn thì cả chunk tính là lỗi (archive không được đánh dấu xong,
+        # lần chạy sau đọc lại) chứ không mất record giữa "đã đọc" và "đã xong"
+        try:
+            lookups = self._lookup(chunk)
+        except Exception as e:
+            print(f"❌ Không tra được Milvus cho {len(chunk)} record: {e}")
+            lookups = None
+        for archive in {r["archive"] for r in chunk}:
+            self.checkpoint.read(archive, sum(1 for r in chunk if r["archive"] == archive))
+        if lookups is None:
+            if chunk:
+                self.checkpoint.done([r["archive"] for r in chunk], "failed")
+            chunk = []
+        else:
+            chunk = self._drop_applied(chunk, *lookups)
+        for archive in ended:
+            self.checkpoint.end_of_archive(archive)
+        # Đặt cờ sau cùng để vòng chờ ở run_backfill không kết thúc trước khi chunk cuối được ghi nhận
+        self.exhausted = exhausted
+        return chunk
+
+    def _lookup(self, chunk, retries=BACKFILL_LOOKUP_RETRIES):
+        """(bản đang lưu, fingerprint) của các id trong chunk, thử lại khi Milvus lỗi tạm thời"""
+        if not chunk:
+            return {}, {}
+        ids = list({r["file_id"] for r in chunk})
+        for attempt in range(retries + 1):
+            try:
+                return stored_versions(ids), stored_fingerprints(ids)
+            except Exception as e:
+                if attempt == retries:
+                    raise
+                print(f"⚠️ Lỗi truy vấn Milvus ({e}), thử lại lần {attempt + 1}/{retries}")
+                time.sleep(2 ** attempt)
+
+    def _drop_applied(self, chunk, stored, fingerprints):
+        """Bỏ record có last_update bằng bản đang lưu (đã nạp ở lần chạy trước hoặc bởi ingestor realtime).
+        Bản cũ hơn chỉ cần ghi lịch sử nên không giải mã ảnh / encode."""
+        kept, applied = [], []
+        for r in chunk:
+            current = stored.get(r["file_id"])
+            if current is not None and current["last_update"] == r["data"]["last_update"]:
+                applied.append(r["archive"])
+                continue
+            r["history_only"] = current is not None and current["last_update"] > r["data"]["last_update"]
+            r["fingerprint"] = fingerprints.get(r["file_id"])
+            kept.append(r)
+        if applied:
+            self.checkpoint.done(applied, "skipped")
+        return kept
+
+
+def make_stages(reader, checkpoint):
+    read_q = queue.Queue(maxsize=BACKFILL_READ_CHUNK * 2)
+    decoded_q = queue.Queue(maxsize=QUEUE_SIZE)
+    encoded_q = queue.Queue(maxsize=max(1, WRITER_CONCURRENCY * 2))
+
+    def decode(record):
+        if record["history_only"]:
+            record["image_input"] = None
+        elif record["content"] is not None:
+            record["image_input"] = image_input_from_bytes(record["data"], record["content"], record["fingerprint"])
+        else:
+            # Archive ảnh thiếu file: tải qua image_url như ingestor realtime
+            record["image_input"] = download_image_input(record["data"], record["fingerprint"])
+        record["content"] = None
+        return [record]
+
+    def encode(records):
+        entries, superseded = latest_by_id([(r["file_id"], r["data"], r) for r in records])
+        kept = [r for _, _, r in entries]
+        file_ids = [r["file_id"] for r in kept]
+        vectors = encode_changed(file_ids, [r["data"] for r in kept], [r["image_input"] for r in kept])
+        if superseded:
+            checkpoint.done([r["archive"] for _, r in superseded], "skipped")
+        return [{"records": kept, "vectors": vectors}]
+
+    def store(batch):
+        records, vectors = batch["records"], batch["vectors"]
+        upsert_to_milvus([r["file_id"] for r in records], [r["data"] for r in records], vectors)
+        for outcome, selected in (
+            ("encoded", [r for r in records if r["file_id"] in vectors]),
+            ("history", [r for r in records if r["history_only"]]),
+            ("reused", [r for r in records if r["file_id"] not in vectors and not r["history_only"]]),
+        ):
+            if selected:
+                checkpoint.done([r["archive"] for r in selected], outcome)
+
+    def failed(item):
+        records = item["records"] if isinstance(item, dict) and "records" in item else item
+        records = records if isinstance(records, list) else [records]
+        checkpoint.done([r["archive"] for r in records], "failed")
+
+    return [
+        Stage("read", reader.read_chunk, 1, output_queue=read_q),
+        Stage("decode", decode, DOWNLOAD_CONCURRENCY, input_queue=read_q, output_queue=decoded_q, on_error=failed),
+        BatchStage("encode", encode, BACKFILL_BATCH_SIZE, 1.0, concurrency=1,
+                   input_queue=decoded_q, output_queue=encoded_q, on_error=failed),
+        Stage("store", store, WRITER_CONCURRENCY, input_queue=encoded_q, on_error=failed),
+    ]
+
+
+def relax_refresh_interval(checkpoint):
+    """Tắt refresh của index ES trong lúc nạp, trả về giá trị gốc để khôi phục.
+    Giá trị gốc được lưu vào checkpoint trước khi tắt: nếu lần chạy này bị ngắt, lần sau đọc lại từ checkpoint
+    thay vì đọc "-1" đang đặt trên index."""
+    if not checkpoint.saved_refresh:
+        settings = es.indices.get_settings(index=ES_INDEX)
+        current = settings[ES_INDEX]["settings"]["index"].get("refresh_interval")
+        # "-1" còn sót lại (từ lần chạy bị ngắt trước khi có checkpoint này) coi như chưa đặt
+        checkpoint.save_refresh_interval(None if current == "-1" else current)
+    es.indices.put_settings(index=ES_INDEX, body={"index": {"refresh_interval": "-1"}})
+    return checkpoint.refresh_interval
+
+
+def restore_refresh_interval(checkpoint, previous):
+    # None = xóa setting, quay về mặc định của ES
+    if previous == "-1":
+        previous = None
+    es.indices.put_settings(index=ES_INDEX, body={"index": {"refresh_interval": previous}})
+    es.indices.refresh(index=ES_INDEX)
+    checkpoint.clear_refresh_interval()
+
+
+def run_backfill(directory, checkpoint_path):
+    archives = find_archives(directory)
+    checkpoint = Checkpoint(checkpoint_path)
+    reader = ArchiveReader(archives, checkpoint)
+    print(f"Backfill {len(reader.archives)}/{len(archives)} archive (bỏ qua {len(archives) - len(reader.archives)} đã xong)")
+    if not reader.archives:
+        return checkpoint.stats
+
+    previous_refresh = relax_refresh_interval(checkpoint)
+    stop_event = threading.Event()
+    stages = make_stages(reader, checkpoint)
+    started = time.monotonic()
+    idle_since = None
+    try:
+        for s in stages:
+            s.start(stop_event)
+        threading.Thread(target=report_stats, args=(stages, stop_event), daemon=True).start()
+        while not (reader.exhausted and checkpoint.finished()):
+            time.sleep(1)
+            # Đọc hết, các stage xử lý (trừ stage đọc) đều rảnh và hàng đợi rỗng mà checkpoint chưa xong:
+            # có record bị mất đếm, dừng thay vì chờ mãi (các archive đó không được đánh dấu xong)
+            if reader.exhausted and all(s.idle() for s in stages[1:]):
+                idle_since = idle_since or time.monotonic()
+                if time.monotonic() - idle_since > BACKFILL_IDLE_EXIT:
+                    print(f"⚠️ Các stage đã rảnh {BACKFILL_IDLE_EXIT:.0f}s nhưng còn archive chưa xong, dừng: "
+                          f"{', '.join(checkpoint.unfinished())}")
+                    break
+            else:
+                idle_since = None
+    finally:
+        stop_event.set()
+        for s in stages:
+            for t in s.threads:
+                t.join()
+        restore_refresh_interval(checkpoint, previous_refresh)
+
+    elapsed = time.monotonic() - started
+    stats = checkpoint.stats
+    print(f"✅ Backfill xong trong {elapsed:.0f}s ({stats['read'] / max(elapsed, 1e-9):.1f} record/s): {stats}")
+    return stats
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Nạp lại dữ liệu từ archive của crawler (thư mục local hoặc S3)")
+    parser.add_argument("--source", default="archives", help="Thư mục chứa json_*.zip / image_*.zip")
+    parser.add_argument("--s3", action="store_true", help="Tải archive từ BACKFILL_S3_BUCKET về --source trước")
+    parser.add_argument("--checkpoint", default="backfill_checkpoint.json")
+    args = parser.parse_args()
+    if args.s3:
+        download_archives(BACKFILL_S3_BUCKET, args.source)
+    run_backfill(args.source, args.checkpoint)
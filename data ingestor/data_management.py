@@ -1,17 +1,24 @@
 import os
-import uuid
+import re
 import json
+import math
 import time
-import requests
+import hashlib
+import threading
+import unicodedata
+from contextlib import contextmanager
 import torch
 import numpy as np
 from dotenv import load_dotenv
-from PIL import Image
 from io import BytesIO
 from pymilvus import connections, Collection
 from elasticsearch import Elasticsearch
-import open_clip
+from elasticsearch.helpers import bulk
 import boto3
+from clip_backend import load_clip, CLIP_BACKEND
+from image_preprocess import preprocess_image
+from image_fetcher import fetcher, fetch_executor
+from dedup import AppliedVersions
 
 # Load ENV
 load_dotenv()
@@ -28,6 +35,18 @@ MILVUS_HOST = os.getenv("MILVUS_HOST", "localhost")
 MILVUS_PORT = os.getenv("MILVUS_PORT", "19530")
 ES_HOST = os.getenv("ES_HOST", "http://localhost:9200")
 ES_INDEX = "products"
+# Số message lấy mỗi lần poll SQS (tối đa 10) và được encode chung một batch
+INGEST_BATCH_SIZE = min(10, int(os.getenv("INGEST_BATCH_SIZE", "10")))
+# Long polling: receive_message chờ tối đa SQS_WAIT_TIME giây (tối đa 20) nên không cần sleep khi queue rỗng
+SQS_WAIT_TIME = min(20, int(os.getenv("SQS_WAIT_TIME", "20")))
+# Visibility timeout của message vừa nhận; message đang xử lý được gia hạn định kỳ cho tới khi bị xoá
+SQS_VISIBILITY_TIMEOUT = int(os.getenv("SQS_VISIBILITY_TIMEOUT", "120"))
+# Không gia hạn message giữ quá lâu (bị bỏ dở do lỗi), để SQS giao lại cho consumer khác
+SQS_MAX_IN_FLIGHT = float(os.getenv("SQS_MAX_IN_FLIGHT", "900"))
+# Số khoá ghi theo id (id chia theo hash vào các khoá), dùng chung cho mọi thread ghi trong process
+ID_LOCK_STRIPES = int(os.getenv("ID_LOCK_STRIPES", "256"))
+# Redis dùng chung với cache sản phẩm của search API (tùy chọn)
+REDIS_URL = os.getenv("REDIS_URL", "")
 
 # Kết nối Milvus và Elasticsearch
 connections.connect("default", host=MILVUS_HOST, port=MILVUS_PORT)
@@ -37,21 +56,21 @@ product_embed = Collection("product_embedding")
 price_history = Collection("product_price_history")
 review_history = Collection("product_review_history")
 
+# Thông báo cho search API bỏ cache sản phẩm vừa được ghi bản mới
+redis_client = None
+if REDIS_URL:
+    import redis
+    redis_client = redis.Redis.from_url(REDIS_URL)
+
 # Load mô hình OpenCLIP
 device = "cuda" if torch.cuda.is_available() else "cpu"
 print(f"Sử dụng {device}")
-print("Tải mô hình OpenClip ViT-L-14-336")
-model, _, preprocess = open_clip.create_model_and_transforms(
-    model_name="ViT-L-14-336", pretrained="openai", image_resolution=336
-)
-tokenizer = open_clip.get_tokenizer("ViT-L-14-336")
-model.to(device)
-model.eval()
+print(f"Tải mô hình OpenClip ViT-L-14-336 (backend: {CLIP_BACKEND})")
+model, preprocess, tokenizer = load_clip("ViT-L-14-336", pretrained="openai", device=device)
 
 def resize_image(img_bytes):
-    image = Image.open(BytesIO(img_bytes)).convert("RGB")
-    image = image.resize((336, 336), Image.BICUBIC)
-    return preprocess(image).unsqueeze(0).to(device)
+    # Giải mã JPEG ở chế độ draft + một lần resize/crop về 336x336 (thay cho resize rồi preprocess resize lại)
+    return preprocess_image(BytesIO(img_bytes)).unsqueeze(0).to(device)
 
 def clean_data(data):
     # Làm sạch giá trị
@@ -63,132 +82,499 @@ def clean_data(data):
     data["last_update"] = int(time.mktime(ts))
     return data
 
-def insert_history(file_id, data):
-    ts_int = data["last_update"]
-    record_id = str(uuid.uuid4())
-    dummy_vector = [0.0, 0.0]
-    price_history.insert([
-        [record_id],
-        [file_id],
-        [data["price"]],
-        [ts_int],
-        [dummy_vector]
-    ])
-    review_history.insert([
-        [record_id],
-        [file_id],
-        [data["rating"]],
-        [data["reviews_count"]],
-        [ts_int],
-        [dummy_vector]
-    ])
+def quoted_id_list(ids):
+    return ", ".join(json.dumps(i) for i in ids)
 
-def upsert_to_elasticsearch(file_id, data):
-    doc = {
-        "id": file_id,
-        "product_name": data["name"]
-    }
-    es.index(index=ES_INDEX, id=file_id, document=doc)
+def history_record_id(file_id, data):
+    # Khóa xác định theo (id, last_update): xử lý lại cùng một message (ở node khác) chỉ ghi đè, không nhân bản
+    return f"{file_id}_{data['last_update']}"
+
+def value_changed(old, new):
+    # Milvus lưu FLOAT 32-bit nên không so sánh bằng tuyệt đối
+    return not math.isclose(old, new, rel_tol=1e-6, abs_tol=1e-6)
+
+def price_changed(previous, data):
+    return previous is None or value_changed(previous["price"], data["price"])
+
+def review_changed(previous, data):
+    return (previous is None or value_changed(previous["rating"], data["rating"])
+            or previous["review_count"] != data["reviews_count"])
+
+def insert_history(file_ids, rows, previous=None):
+    """Ghi lịch sử giá / đánh giá cho cả batch: mỗi collection tối đa một lần upsert.
+
+    previous: file_id -> bản đang lưu trong product_info (bản liền trước). Khi có, chỉ ghi điểm mới nếu giá
+    (hoặc rating / số review) thực sự đổi; lịch sử là chuỗi bậc thang, giá trị giữ nguyên tới điểm kế tiếp.
+    Không có previous (bản cũ đến trễ) thì ghi tất cả."""
+    previous = previous or {}
+    price_rows = [(f, d) for f, d in zip(file_ids, rows) if price_changed(previous.get(f), d)]
+    review_rows = [(f, d) for f, d in zip(file_ids, rows) if review_changed(previous.get(f), d)]
+    if price_rows:
+        price_history.upsert([
+            [history_record_id(f, d) for f, d in price_rows],
+            [f for f, _ in price_rows],
+            [d["price"] for _, d in price_rows],
+            [d["last_update"] for _, d in price_rows],
+            # Milvus 2.5 bắt buộc mỗi collection có một trường vector
+            [[0.0, 0.0] for _ in price_rows]
+        ])
+    if review_rows:
+        review_history.upsert([
+            [history_record_id(f, d) for f, d in review_rows],
+            [f for f, _ in review_rows],
+            [d["rating"] for _, d in review_rows],
+            [d["reviews_count"] for _, d in review_rows],
+            [d["last_update"] for _, d in review_rows],
+            [[0.0, 0.0] for _ in review_rows]
+        ])
+
+def notify_products_updated(file_ids, rows):
+    if redis_client is None:
+        return
+    try:
+        pipe = redis_client.pipeline()
+        for file_id, data in zip(file_ids, rows):
+            pipe.delete(f"product:{file_id}")
+            pipe.publish("product_updates", f"{file_id}:{data['last_update']}")
+        pipe.execute()
+    except Exception as e:
+        print(f"⚠️ Không gửi được thông báo cập nhật cache cho {len(file_ids)} sản phẩm: {e}")
+
+def upsert_to_elasticsearch(file_ids, rows):
+    """Một request bulk cho cả batch"""
+    actions = [
+        {"_index": ES_INDEX, "_id": file_id, "_source": {"id": file_id, "product_name": data["name"]}}
+        for file_id, data in zip(file_ids, rows)
+    ]
+    bulk(es, actions)
+
+# Fingerprint của đầu vào đã sinh ra vector đang lưu trong product_embed
+FINGERPRINT_FIELDS = ["image_url", "image_etag", "image_hash", "title_hash"]
+# max_length (byte) của các cột VARCHAR tương ứng trong create_collections.py
+FINGERPRINT_MAX_BYTES = {"image_url": 1000, "image_etag": 200}
+
+def fingerprint_value(field, value):
+    """Giá trị quá dài so với cột thì lưu rỗng (một giá trị quá dài làm hỏng cả lệnh upsert của batch).
+    Không cắt ngắn: URL / ETag bị cắt không dùng được để so khớp hay gửi If-None-Match; rỗng chỉ có nghĩa
+    là lần sau tải lại ảnh và so bằng image_hash."""
+    value = value or ""
+    limit = FINGERPRINT_MAX_BYTES.get(field)
+    if limit is not None and len(value.encode("utf-8")) > limit:
+        return ""
+    return value
+
+def title_hash(name):
+    """Hash của tiêu đề đã chuẩn hóa (unicode, chữ thường, gộp khoảng trắng)"""
+    normalized = unicodedata.normalize("NFC", name).lower()
+    normalized = re.sub(r"\s+", " ", normalized).strip()
+    return hashlib.sha256(normalized.encode("utf-8")).hexdigest()
+
+def stored_fingerprints(file_ids):
+    """Một query cho cả batch: id -> fingerprint của vector đang lưu"""
+    if not file_ids:
+        return {}
+    expr = f"id in [{quoted_id_list(file_ids)}]"
+    return {r["id"]: r for r in product_embed.query(expr, output_fields=["id"] + FINGERPRINT_FIELDS)}
 
-# Hàm xóa embedding nếu đã tồn tại
-def delete_embedding_if_exists(collection, id, partition=None):
-    expr = f'id == "{id}"'
-    collection.delete(expr, partition_name=partition)
+def stored_versions(file_ids):
+    """Bản đang lưu trong product_info: id -> {last_update, price, rating, review_count}"""
+    expr = f"id in [{quoted_id_list(file_ids)}]"
+    fields = ["id", "last_update", "price", "rating", "review_count"]
+    return {r["id"]: r for r in product_info.query(expr, output_fields=fields)}
+
+# Các bản (id, last_update) đã ghi xong, để bỏ message trùng trước khi tải ảnh / chạy mô hình
+applied_versions = AppliedVersions()
+
+def filter_applied(entries):
+    """entries: list (file_id, data, message). Bỏ các bản đã ghi: tra bộ nhớ cục bộ trước, phần còn lại
+    tra product_info bằng một query (bản do process / node khác ghi).
+    Trả về (entries cần xử lý, message trùng để xoá khỏi queue, key của các bản cũ hơn bản đang lưu)"""
+    if not entries:
+        return [], [], set()
+    keys = [applied_versions.key(f, d["last_update"]) for f, d, _ in entries]
+    seen = applied_versions.seen(keys)
+    duplicates = [m for k, (_, _, m) in zip(keys, entries) if k in seen]
+    remaining = [(k, e) for k, e in zip(keys, entries) if k not in seen]
+    stored = stored_versions([e[0] for _, e in remaining]) if remaining else {}
+
+    kept, applied, history_only = [], [], set()
+    for k, (file_id, data, message) in remaining:
+        current = stored.get(file_id)
+        if current is not None and current["last_update"] == data["last_update"]:
+            applied.append(k)
+            duplicates.append(message)
+            continue
+        if current is not None and current["last_update"] > data["last_update"]:
+            # Chỉ cần ghi lịch sử, không tải ảnh / encode
+            history_only.add(k)
+        kept.append((file_id, data, message))
+    if applied:
+        applied_versions.add(applied)
+    applied_versions.count("remote_hits", len(applied))
+    applied_versions.count("misses", len(kept))
+    return kept, duplicates, history_only
+
+def select_rows(indices, *columns):
+    return [[column[i] for i in indices] for column in columns]
+
+_id_locks = [threading.Lock() for _ in range(ID_LOCK_STRIPES)]
+
+@contextmanager
+def locked_ids(file_ids):
+    """Giữ khoá của mọi id trong batch (lấy theo thứ tự cố định để không deadlock giữa các thread ghi)"""
+    stripes = sorted({hash(f) % ID_LOCK_STRIPES for f in file_ids})
+    for i in stripes:
+        _id_locks[i].acquire()
+    try:
+        yield
+    finally:
+        for i in reversed(stripes):
+            _id_locks[i].release()
+
+def upsert_to_milvus(file_ids, rows, vectors):
+    """Ghi cả batch: một upsert cho product_embed (mỗi sản phẩm một row), một upsert cho product_info.
+
+    vectors: file_id -> (text, image, combined) của các sản phẩm vừa encode. Sản phẩm không có trong vectors
+    (ảnh và tiêu đề không đổi) giữ nguyên vector cũ, chỉ cập nhật product_info và lịch sử.
+
+    - product_info được ghi sau cùng nên last_update trong đó đánh dấu bản đã ghi xong
+    - bản đã ghi (last_update bằng) bị bỏ qua, bản cũ hơn bản đang lưu chỉ được ghi vào lịch sử
+    - trong một process, các thread ghi giữ khoá theo id từ lúc đọc bản đang lưu tới lúc ghi xong, nên bản cũ
+      không ghi đè bản mới
+    - giữa các process / node chỉ là best-effort: last_update được kiểm tra lại ngay trước khi ghi ES và
+      product_info, nhưng vector của bản cũ vẫn có thể ghi đè vector của bản mới nếu hai bản được ghi cùng lúc
+    """
+    file_ids = list(file_ids)
+    with locked_ids(file_ids):
+        return _upsert_locked(file_ids, rows, vectors)
+
+def _upsert_locked(file_ids, rows, vectors):
+    stored = stored_versions(file_ids)
+    last_updates = {f: r["last_update"] for f, r in stored.items()}
+    fresh = [i for i, (f, d) in enumerate(zip(file_ids, rows)) if last_updates.get(f, -1) < d["last_update"]]
+    older = [i for i, (f, d) in enumerate(zip(file_ids, rows)) if last_updates.get(f, -1) > d["last_update"]]
+    if older:
+        insert_history(*select_rows(older, file_ids, rows))
+    if not fresh:
+        return []
+    file_ids, rows = select_rows(fresh, file_ids, rows)
+
+    # Mỗi sản phẩm một row chứa cả 3 vector và fingerprint đầu vào (nếu id trùng thì sẽ update)
+    encoded = [(f, d) for f, d in zip(file_ids, rows) if f in vectors]
+    if encoded:
+        product_embed.upsert([
+            [f for f, _ in encoded],
+            [vectors[f][0] for f, _ in encoded],
+            [vectors[f][1] for f, _ in encoded],
+            [vectors[f][2] for f, _ in encoded],
+            [fingerprint_value("image_url", d["image_url"]) for _, d in encoded],
+            [fingerprint_value("image_etag", d.get("image_etag")) for _, d in encoded],
+            [d["image_hash"] for _, d in encoded],
+            [d["title_hash"] for _, d in encoded],
+        ])
+
+    insert_history(file_ids, rows, previous=stored)
+
+    # Process / node khác có thể vừa ghi bản mới hơn (hoặc chính bản này): kiểm tra lại trước khi ghi product_info
+    latest = stored_versions(file_ids)
+    newest = [i for i, (f, d) in enumerate(zip(file_ids, rows))
+              if f not in latest or latest[f]["last_update"] < d["last_update"]]
+    if len(newest) < len(file_ids):
+        print(f"⚠️ {len(file_ids) - len(newest)} sản phẩm vừa được ghi bản mới hơn ở nơi khác, bỏ qua product_info")
+    if not newest:
+        return []
+    file_ids, rows = select_rows(newest, file_ids, rows)
+    upsert_to_elasticsearch(file_ids, rows)
 
-def upsert_to_milvus(file_id, data, text_embedding, image_embedding, combined_embedding):
-    dummy_vector = [0.0, 0.0]
     # Upsert product_info (nếu id trùng thì sẽ update)
     product_info.upsert([
-        [file_id],
-        [data["name"]],
-        [data["store_url"]],
-        [data["price"]],
-        [data["rating"]],
-        [data["reviews_count"]],
-        [data["last_update"]],
-        [data["image_url"]],
-        [dummy_vector]
+        file_ids,
+        [d["name"] for d in rows],
+        [d["store_url"] for d in rows],
+        [d["price"] for d in rows],
+        [d["rating"] for d in rows],
+        [d["reviews_count"] for d in rows],
+        [d["last_update"] for d in rows],
+        [d["image_url"] for d in rows],
+        [[0.0, 0.0] for _ in file_ids]
     ])
+    notify_products_updated(file_ids, rows)
+    return file_ids
+
+class InFlightMessages:
+    """Các message đã nhận nhưng chưa xoá: receipt handle -> [message, lúc nhận, lúc gia hạn gần nhất]"""
+
+    def __init__(self):
+        self.messages = {}
+        self.lock = threading.Lock()
+
+    def add(self, messages):
+        now = time.monotonic()
+        with self.lock:
+            for m in messages:
+                self.messages[m["ReceiptHandle"]] = [m, now, now]
 
-    # Xử lý upsert cho product_embed (xóa nếu đã tồn tại, rồi insert lại)
-    # text_search
-    delete_embedding_if_exists(product_embed, file_id, partition="text_search")
-    product_embed.insert([
-        [file_id],
-        [text_embedding.tolist()],
-        [image_embedding.tolist()],
-        [combined_embedding.tolist()]
-    ], partition_name="text_search")
-
-    # image_search
-    delete_embedding_if_exists(product_embed, file_id + "_img", partition="image_search")
-    product_embed.insert([
-        [file_id + "_img"],
-        [text_embedding.tolist()],
-        [image_embedding.tolist()],
-        [combined_embedding.tolist()]
-    ], partition_name="image_search")
-
-    # combined_search
-    delete_embedding_if_exists(product_embed, file_id + "_comb", partition="combined_search")
-    product_embed.insert([
-        [file_id + "_comb"],
-        [text_embedding.tolist()],
-        [image_embedding.tolist()],
-        [combined_embedding.tolist()]
-    ], partition_name="combined_search")
-
-    insert_history(file_id, data)
-    upsert_to_elasticsearch(file_id, data)
-
-def receive_messages_from_sqs(max_messages=1, wait_time=5):
+    def release(self, messages):
+        with self.lock:
+            for m in messages:
+                self.messages.pop(m["ReceiptHandle"], None)
+
+    def due(self, timeout=SQS_VISIBILITY_TIMEOUT, max_age=SQS_MAX_IN_FLIGHT):
+        """Message đã dùng quá nửa visibility timeout; message giữ quá max_age bị bỏ theo dõi"""
+        now = time.monotonic()
+        with self.lock:
+            for handle, (_, received, _) in list(self.messages.items()):
+                if now - received > max_age:
+                    del self.messages[handle]
+            return [m for m, _, extended in self.messages.values() if now - extended >= timeout / 2]
+
+    def mark_extended(self, messages):
+        now = time.monotonic()
+        with self.lock:
+            for m in messages:
+                entry = self.messages.get(m["ReceiptHandle"])
+                if entry is not None:
+                    entry[2] = now
+
+    def __len__(self):
+        with self.lock:
+            return len(self.messages)
+
+in_flight = InFlightMessages()
+
+def receive_messages_from_sqs(max_messages=INGEST_BATCH_SIZE, wait_time=SQS_WAIT_TIME):
     response = sqs.receive_message(
         QueueUrl=queue_url,
         MaxNumberOfMessages=max_messages,
-        WaitTimeSeconds=wait_time
+        WaitTimeSeconds=wait_time,
+        VisibilityTimeout=SQS_VISIBILITY_TIMEOUT
     )
-    return response.get("Messages", [])
+    messages = response.get("Messages", [])
+    in_flight.add(messages)
+    return messages
 
-def process_sqs_message(message, thread_id):
-    try:
-        body = json.loads(message["Body"])
-        file_id = body.get("id", "").strip()
-        if not file_id:
-            print(f"❌ Bỏ qua message vì thiếu hoặc rỗng ID: {body}")
-            return
-        data = clean_data(body)
-        img_response = requests.get(data["image_url"])
-        image_input = resize_image(img_response.content)
-        with torch.no_grad():
-            image_embedding = model.encode_image(image_input).cpu().numpy()[0]
-            text_input = tokenizer([data["name"]]).to(device)
-            text_embedding = model.encode_text(text_input).cpu().numpy()[0]
-        image_embedding /= np.linalg.norm(image_embedding)
-        text_embedding /= np.linalg.norm(text_embedding)
-        combined_embedding = (image_embedding + text_embedding) / 2
-        combined_embedding /= np.linalg.norm(combined_embedding)
-        upsert_to_milvus(file_id, data, text_embedding, image_embedding, combined_embedding)
-        print(f"Thread {thread_id} đã xử lý ID: {file_id}")
-        # Xoá message khỏi queue sau khi xử lý thành công
-        sqs.delete_message(
+def approximate_queue_depth():
+    """Số message đang chờ trong queue (xấp xỉ, theo SQS)"""
+    response = sqs.get_queue_attributes(QueueUrl=queue_url, AttributeNames=["ApproximateNumberOfMessages"])
+    return int(response["Attributes"]["ApproximateNumberOfMessages"])
+
+def extend_visibility(messages, timeout=SQS_VISIBILITY_TIMEOUT):
+    """Gia hạn visibility cho các message đang xử lý (tối đa 10 entry mỗi lần gọi)"""
+    for i in range(0, len(messages), 10):
+        chunk = messages[i:i + 10]
+        response = sqs.change_message_visibility_batch(
+            QueueUrl=queue_url,
+            Entries=[
+                {"Id": str(j), "ReceiptHandle": m["ReceiptHandle"], "VisibilityTimeout": timeout}
+                for j, m in enumerate(chunk)
+            ]
+        )
+        failed = {int(f["Id"]) for f in response.get("Failed", [])}
+        # Receipt handle hết hạn: message đã được giao cho consumer khác, không theo dõi nữa
+        in_flight.release([chunk[j] for j in failed])
+        in_flight.mark_extended([m for j, m in enumerate(chunk) if j not in failed])
+
+def visibility_heartbeat(stop_event=None, interval=SQS_VISIBILITY_TIMEOUT / 4):
+    """Chạy nền: gia hạn các message giữ quá nửa visibility timeout để batch chậm không bị giao lại giữa chừng"""
+    stop_event = stop_event or threading.Event()
+    while not stop_event.wait(interval):
+        due = in_flight.due()
+        if not due:
+            continue
+        try:
+            extend_visibility(due)
+        except Exception as e:
+            print(f"⚠️ Không gia hạn được visibility cho {len(due)} message: {e}")
+
+def start_visibility_heartbeat(stop_event=None):
+    t = threading.Thread(target=visibility_heartbeat, args=(stop_event,), name="sqs-visibility", daemon=True)
+    t.start()
+    return t
+
+def delete_messages_from_sqs(messages):
+    """Xoá message khỏi queue bằng delete_message_batch (tối đa 10 entry mỗi lần gọi)"""
+    for i in range(0, len(messages), 10):
+        chunk = messages[i:i + 10]
+        response = sqs.delete_message_batch(
             QueueUrl=queue_url,
-            ReceiptHandle=message["ReceiptHandle"]
+            Entries=[{"Id": str(j), "ReceiptHandle": m["ReceiptHandle"]} for j, m in enumerate(chunk)]
         )
+        for failed in response.get("Failed", []):
+            print(f"⚠️ Không xoá được message khỏi queue: {failed.get('Message')}")
+    in_flight.release(messages)
+
+def parse_message(message):
+    """Đọc body của message SQS, trả về (file_id, data) hoặc None nếu không hợp lệ"""
+    body = json.loads(message["Body"])
+    file_id = body.get("id", "").strip()
+    if not file_id:
+        print(f"❌ Bỏ qua message vì thiếu hoặc rỗng ID: {body}")
+        return None
+    return file_id, clean_data(body)
+
+def encode_batch(image_inputs, names):
+    """Một lần forward cho mỗi tower, trả về (text, image, combined) đã chuẩn hóa"""
+    with torch.no_grad():
+        image_embeddings = model.encode_image(torch.cat(image_inputs)).float().cpu().numpy()
+        text_input = tokenizer(names).to(device)
+        text_embeddings = model.encode_text(text_input).float().cpu().numpy()
+    image_embeddings /= np.linalg.norm(image_embeddings, axis=1, keepdims=True)
+    text_embeddings /= np.linalg.norm(text_embeddings, axis=1, keepdims=True)
+    combined_embeddings = (image_embeddings + text_embeddings) / 2
+    combined_embeddings /= np.linalg.norm(combined_embeddings, axis=1, keepdims=True)
+    return text_embeddings, image_embeddings, combined_embeddings
+
+def latest_by_id(entries):
+    """entries: list (file_id, data, message). Cùng một sản phẩm xuất hiện nhiều lần thì chỉ giữ bản mới nhất
+    (Milvus không cho trùng khóa chính trong một lần upsert). Trả về (giữ lại, list (file_id, message) bị thay thế)"""
+    latest, superseded = {}, []
+    for file_id, data, message in entries:
+        if file_id in latest:
+            kept = latest[file_id]
+            if kept[1]["last_update"] >= data["last_update"]:
+                superseded.append((file_id, message))
+                continue
+            superseded.append((file_id, kept[2]))
+        latest[file_id] = (file_id, data, message)
+    return list(latest.values()), superseded
+
+def parse_messages(messages):
+    entries = []
+    for message in messages:
+        try:
+            parsed = parse_message(message)
+        except Exception as e:
+            print(f"Lỗi xử lý message: {e}")
+            parsed = None
+        if parsed is None:
+            # Để SQS giao lại theo visibility timeout, không gia hạn
+            in_flight.release([message])
+            continue
+        entries.append((parsed[0], parsed[1], message))
+    return entries
+
+def encode_changed(file_ids, rows, image_inputs):
+    """Chỉ encode các sản phẩm có image_input (None = dùng lại vector đang lưu).
+    Trả về dict file_id -> (text, image, combined)"""
+    changed = [i for i, image_input in enumerate(image_inputs) if image_input is not None]
+    if not changed:
+        return {}
+    text_embeddings, image_embeddings, combined_embeddings = encode_batch(
+        [image_inputs[i] for i in changed], [rows[i]["name"] for i in changed]
+    )
+    return {
+        file_ids[i]: (t, img, comb)
+        for i, t, img, comb in zip(changed, text_embeddings.tolist(), image_embeddings.tolist(), combined_embeddings.tolist())
+    }
+
+def fetch_image(data, fingerprint=None):
+    """Tải ảnh qua pool kết nối dùng chung (có timeout, giới hạn dung lượng, thử lại, cache đĩa).
+    Nếu URL trùng bản đã lưu và có ETag thì gửi If-None-Match; trả về None khi ảnh không đổi"""
+    etag = None
+    if fingerprint and fingerprint["image_url"] == data["image_url"] and fingerprint["image_etag"]:
+        etag = fingerprint["image_etag"]
+    result = fetcher.fetch(data["image_url"], etag)
+    if result.not_modified:
+        return None
+    data["image_etag"] = result.etag
+    return result.content
+
+def download_image_input(data, fingerprint=None):
+    """Tải + tiền xử lý ảnh của một sản phẩm. Trả về None nếu tiêu đề và ảnh khớp fingerprint đã lưu
+    (vector cũ vẫn đúng, không cần chạy mô hình)"""
+    data["title_hash"] = title_hash(data["name"])
+    same_title = fingerprint is not None and fingerprint["title_hash"] == data["title_hash"]
+    content = fetch_image(data, fingerprint if same_title else None)
+    if content is None:
+        data["image_etag"], data["image_hash"] = fingerprint["image_etag"], fingerprint["image_hash"]
+        return None
+    return image_input_from_bytes(data, content, fingerprint if same_title else None)
+
+def image_input_from_bytes(data, content, fingerprint=None):
+    """Tiền xử lý ảnh đã có sẵn bytes (tải về hoặc đọc từ archive); None nếu khớp fingerprint đã lưu"""
+    data.setdefault("title_hash", title_hash(data["name"]))
+    data["image_hash"] = hashlib.sha256(content).hexdigest()
+    if (fingerprint is not None and fingerprint["title_hash"] == data["title_hash"]
+            and fingerprint["image_hash"] == data["image_hash"]):
+        return None
+    return resize_image(content)
+
+def store_batch(file_ids, rows, image_inputs, messages, superseded=()):
+    """Encode (những sản phẩm đã đổi) + ghi một batch đã tải ảnh, sau đó xoá các message (kể cả bản trùng đã bị thay thế)"""
+    vectors = encode_changed(file_ids, rows, image_inputs)
+    write_batch(file_ids, rows, vectors, messages, superseded)
+    return vectors
+
+def write_batch(file_ids, rows, vectors, messages, superseded=()):
+    upsert_to_milvus(file_ids, rows, vectors)
+    # Mọi bản trong batch giờ đã được áp dụng (ghi mới, đã có sẵn, hoặc chỉ ghi lịch sử)
+    applied_versions.add(applied_versions.key(f, d["last_update"]) for f, d in zip(file_ids, rows))
+    # Xoá message khỏi queue sau khi xử lý thành công
+    written = set(file_ids)
+    delete_messages_from_sqs(list(messages) + [m for file_id, m in superseded if file_id in written])
+
+def process_sqs_batch(messages, thread_id):
+    """Xử lý một batch message: encode chung một lần, ghi bulk, xoá message bằng một lệnh batch"""
+    parsed = parse_messages(messages)
+    try:
+        entries, duplicates, history_only = filter_applied(parsed)
+        if duplicates:
+            delete_messages_from_sqs(duplicates)
+            print(f"Thread {thread_id}: bỏ qua {len(duplicates)} message đã xử lý")
+        entries, superseded = latest_by_id(entries)
+        fingerprints = stored_fingerprints([file_id for file_id, _, _ in entries])
     except Exception as e:
-        print(f"Lỗi xử lý message: {e}")
+        # Milvus lỗi: không xoá, không gia hạn, để SQS giao lại sau visibility timeout
+        print(f"Lỗi tra cứu Milvus cho batch {len(parsed)} message: {e}")
+        in_flight.release([m for _, _, m in parsed])
+        return 0
+
+    # Tải ảnh của cả batch song song (bản cũ chỉ ghi lịch sử thì không cần ảnh)
+    futures = [
+        None if applied_versions.key(file_id, data["last_update"]) in history_only
+        else fetch_executor.submit(download_image_input, data, fingerprints.get(file_id))
+        for file_id, data, _ in entries
+    ]
+    accepted, file_ids, rows, image_inputs = [], [], [], []
+    for (file_id, data, message), future in zip(entries, futures):
+        try:
+            image_inputs.append(future.result() if future is not None else None)
+            accepted.append(message)
+            file_ids.append(file_id)
+            rows.append(data)
+        except Exception as e:
+            print(f"Lỗi xử lý message: {e}")
+            in_flight.release([message])
+
+    if not accepted:
+        return 0
+    try:
+        vectors = store_batch(file_ids, rows, image_inputs, accepted, superseded)
+        print(f"Thread {thread_id} đã xử lý {len(file_ids)} ID (dùng lại embedding: {len(file_ids) - len(vectors)}): "
+              f"{', '.join(file_ids)}")
+    except Exception as e:
+        print(f"Lỗi xử lý batch {len(accepted)} message: {e}")
+        in_flight.release(accepted)
+        return 0
+    return len(accepted)
+
+def process_sqs_message(message, thread_id):
+    return process_sqs_batch([message], thread_id)
 
 def worker(thread_id):
     print(f"Thread {thread_id} bắt đầu tiêu thụ từ SQS...")
     while True:
-        messages = receive_messages_from_sqs()
-        if not messages:
-            print(f"Thread {thread_id}: Không có message mới. Đợi 5s...")
-            time.sleep(60)
-            continue
-        for msg in messages:
-            print(f"Thread {thread_id}: Nhận message")
-            process_sqs_message(msg, thread_id)
-        time.sleep(1)
+        # Long poll: khi queue rỗng lệnh này tự chờ tới SQS_WAIT_TIME giây, message đến là xử lý ngay
+        try:
+            messages = receive_messages_from_sqs()
+            if not messages:
+                continue
+            print(f"Thread {thread_id}: Nhận {len(messages)} message")
+            process_sqs_batch(messages, thread_id)
+        except Exception as e:
+            # Không để một lỗi (SQS, Milvus...) làm chết thread; message chưa xoá sẽ được giao lại
+            print(f"Thread {thread_id}: lỗi {e}, thử lại sau 1 giây")
+            time.sleep(1)
 
 # if __name__ == "__main__":
 #     print("Bắt đầu tiêu thụ dữ liệu từ SQS...")
@@ -0,0 +1,102 @@
+import os
+import sqlite3
+import threading
+from collections import OrderedDict
+
+# Số cặp (id, last_update) đã ghi được nhớ trong RAM (LRU)
+DEDUP_MAX_ENTRIES = int(os.getenv("DEDUP_MAX_ENTRIES", "200000"))
+# File sqlite để giữ danh sách qua các lần khởi động lại (các process trên cùng máy dùng chung được), bỏ trống để tắt
+DEDUP_DB_PATH = os.getenv("DEDUP_DB_PATH", "")
+
+
+class DiskTier:
+    """Bảng sqlite giới hạn số dòng: xóa các dòng cũ nhất khi vượt max_entries"""
+
+    def __init__(self, path, max_entries):
+        self.conn = sqlite3.connect(path, check_same_thread=False, timeout=30)
+        self.conn.execute("PRAGMA journal_mode=WAL")
+        self.conn.execute("CREATE TABLE IF NOT EXISTS applied (key TEXT PRIMARY KEY)")
+        self.conn.commit()
+        self.max_entries = max_entries
+        self.lock = threading.Lock()
+
+    def contains(self, keys):
+        if not keys:
+            return set()
+        with self.lock:
+            rows = self.conn.execute(
+                f"SELECT key FROM applied WHERE key IN ({', '.join('?' for _ in keys)})", list(keys)
+            ).fetchall()
+        return {r[0] for r in rows}
+
+    def add(self, keys):
+        with self.lock:
+            self.conn.executemany("INSERT OR IGNORE INTO applied (key) VALUES (?)", [(k,) for k in keys])
+            # rowid tăng dần nên dòng có rowid nhỏ nhất là dòng cũ nhất
+            self.conn.execute(
+                "DELETE FROM applied WHERE rowid <= (SELECT MAX(rowid) FROM applied) - ?", (self.max_entries,)
+            )
+            self.conn.commit()
+
+
+class AppliedVersions:
+    """Các bản (id, last_update) đã ghi xong. SQS giao message ít nhất một lần nên cùng một bản có thể đến
+    nhiều lần; tra ở đây trước khi tải ảnh / chạy mô hình để bỏ qua ngay."""
+
+    def __init__(self, max_entries=DEDUP_MAX_ENTRIES, db_path=DEDUP_DB_PATH):
+        self.max_entries = max_entries
+        self.disk = DiskTier(db_path, max_entries) if db_path else None
+        self._keys = OrderedDict()
+        self._lock = threading.Lock()
+        self.stats = {"hits": 0, "disk_hits": 0, "remote_hits": 0, "misses": 0, "evictions": 0}
+
+    @staticmethod
+    def key(file_id, last_update):
+        return f"{file_id}:{last_update}"
+
+    def seen(self, keys):
+        """Trả về tập key đã ghi (RAM, rồi sqlite)"""
+        found = set()
+        with self._lock:
+            for k in keys:
+                if k in self._keys:
+                    self._keys.move_to_end(k)
+                    found.add(k)
+            self.stats["hits"] += len(found)
+        if self.disk is not None:
+            on_disk = self.disk.contains([k for k in keys if k not in found])
+            if on_disk:
+                self._remember(on_disk)
+                with self._lock:
+                    self.stats["disk_hits"] += len(on_disk)
+                found |= on_disk
+        return found
+
+    def count(self, stat, n):
+        with self._lock:
+            self.stats[stat] += n
+
+    def add(self, keys):
+        keys = list(keys)
+        self._remember(keys)
+        if self.disk is not None:
+            self.disk.add(keys)
+
+    def _remember(self, keys):
+        with self._lock:
+            for k in keys:
+                self._keys[k] = None
+                self._keys.move_to_end(k)
+            while len(self._keys) > self.max_entries:
+                self._keys.popitem(last=False)
+                self.stats["evictions"] += 1
+
+    def snapshot(self):
+        with self._lock:
+            lookups = self.stats["hits"] + self.stats["disk_hits"] + self.stats["remote_hits"] + self.stats["misses"]
+            duplicates = lookups - self.stats["misses"]
+            return {
+                **self.stats,
+                "duplicate_rate": round(duplicates / lookups, 4) if lookups else 0.0,
+                "entries": len(self._keys),
+            }
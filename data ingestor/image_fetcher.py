@@ -0,0 +1,195 @@
+import os
+import time
+import random
+import hashlib
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+import requests
+from requests.adapters import HTTPAdapter
+
+from image_preprocess import MAX_IMAGE_BYTES, ImageTooLarge
+
+# Kết nối keep-alive dùng chung cho mọi thread tải ảnh (nên >= DOWNLOAD_CONCURRENCY)
+IMAGE_POOL_SIZE = int(os.getenv("IMAGE_POOL_SIZE", "16"))
+IMAGE_CONNECT_TIMEOUT = float(os.getenv("IMAGE_CONNECT_TIMEOUT", "3"))
+IMAGE_READ_TIMEOUT = float(os.getenv("IMAGE_READ_TIMEOUT", "10"))
+# Số lần thử lại khi lỗi kết nối / timeout / 429 / 5xx, chờ theo backoff lũy thừa có jitter
+IMAGE_FETCH_RETRIES = int(os.getenv("IMAGE_FETCH_RETRIES", "3"))
+IMAGE_BACKOFF_BASE = float(os.getenv("IMAGE_BACKOFF_BASE", "0.5"))
+IMAGE_BACKOFF_MAX = float(os.getenv("IMAGE_BACKOFF_MAX", "8"))
+# Số thread tải song song trong chế độ threads (pipeline dùng DOWNLOAD_CONCURRENCY)
+IMAGE_FETCH_WORKERS = int(os.getenv("IMAGE_FETCH_WORKERS", "8"))
+# Cache ảnh trên đĩa, bỏ trống để tắt. Trong IMAGE_CACHE_TTL giây ảnh được dùng lại không cần gọi mạng,
+# sau đó được kiểm tra lại bằng ETag (If-None-Match)
+IMAGE_CACHE_DIR = os.getenv("IMAGE_CACHE_DIR", "")
+IMAGE_CACHE_TTL = float(os.getenv("IMAGE_CACHE_TTL", "86400"))
+IMAGE_CACHE_MAX_MB = float(os.getenv("IMAGE_CACHE_MAX_MB", "2048"))
+
+RETRY_STATUS = {429, 500, 502, 503, 504}
+CHUNK_SIZE = 64 * 1024
+
+
+class FetchResult:
+    """content: bytes của ảnh (None khi not_modified), etag: ETag hiện tại,
+    not_modified: ảnh trùng với etag mà caller đã đưa vào"""
+
+    def __init__(self, content=None, etag="", not_modified=False):
+        self.content = content
+        self.etag = etag
+        self.not_modified = not_modified
+
+
+class DiskCache:
+    """Mỗi ảnh hai file: <sha256(url)>.bin (nội dung) và .etag. mtime của .bin là thời điểm kiểm tra gần nhất.
+    Ghi qua file tạm + os.replace nên nhiều process dùng chung thư mục được"""
+
+    def __init__(self, directory, ttl=IMAGE_CACHE_TTL, max_mb=IMAGE_CACHE_MAX_MB):
+        os.makedirs(directory, exist_ok=True)
+        self.directory = directory
+        self.ttl = ttl
+        self.max_bytes = int(max_mb * 1024 * 1024)
+        self.puts = 0
+        self.lock = threading.Lock()
+
+    def _path(self, url, ext):
+        return os.path.join(self.directory, hashlib.sha256(url.encode("utf-8")).hexdigest() + ext)
+
+    def get(self, url):
+        """Trả về (content, etag, fresh) hoặc None"""
+        path = self._path(url, ".bin")
+        try:
+            checked = os.path.getmtime(path)
+            with open(path, "rb") as f:
+                content = f.read()
+        except OSError:
+            return None
+        try:
+            with open(self._path(url, ".etag"), encoding="utf-8") as f:
+                etag = f.read()
+        except OSError:
+            etag = ""
+        return content, etag, time.time() - checked <= self.ttl
+
+    def put(self, url, content, etag):
+        for ext, data, mode in ((".etag", etag, "w"), (".bin", content, "wb")):
+            path = self._path(url, ext)
+            tmp = f"{path}.{os.getpid()}.{threading.get_ident()}.tmp"
+            with open(tmp, mode, **({"encoding": "utf-8"} if mode == "w" else {})) as f:
+                f.write(data)
+            os.replace(tmp, path)
+        with self.lock:
+            self.puts += 1
+            should_prune = self.puts % 100 == 0
+        if should_prune:
+            self.prune()
+
+    def touch(self, url):
+        try:
+            os.utime(self._path(url, ".bin"))
+        except OSError:
+            pass
+
+    def prune(self):
+        """Xóa ảnh kiểm tra lâu nhất cho tới khi thư mục dưới IMAGE_CACHE_MAX_MB"""
+        entries, total = [], 0
+        for entry in os.scandir(self.directory):
+            if entry.name.endswith(".bin"):
+                stat = entry.stat()
+                entries.append((stat.st_mtime, stat.st_size, entry.path))
+                total += stat.st_size
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            for p in (path, path[:-len(".bin")] + ".etag"):
+                try:
+                    os.remove(p)
+                except OSError:
+                    pass
+            total -= size
+
+
+class ImageFetcher:
+    def __init__(self, pool_size=IMAGE_POOL_SIZE, cache_dir=IMAGE_CACHE_DIR):
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=pool_size, pool_maxsize=pool_size)
+        self.session.mount("http://", adapter)
+        self.session.mount("https://", adapter)
+        self.cache = DiskCache(cache_dir) if cache_dir else None
+        self.lock = threading.Lock()
+        self.stats = {"requests": 0, "cache_hits": 0, "not_modified": 0, "retries": 0, "errors": 0, "bytes": 0}
+
+    def _count(self, key, n=1):
+        with self.lock:
+            self.stats[key] += n
+
+    def _read_body(self, response):
+        """Đọc body theo từng chunk, dừng ngay khi vượt MAX_IMAGE_BYTES"""
+        length = response.headers.get("Content-Length")
+        if length and int(length) > MAX_IMAGE_BYTES:
+            raise ImageTooLarge(f"Ảnh {length} bytes vượt giới hạn {MAX_IMAGE_BYTES} bytes")
+        chunks, size = [], 0
+        for chunk in response.iter_content(CHUNK_SIZE):
+            size += len(chunk)
+            if size > MAX_IMAGE_BYTES:
+                raise ImageTooLarge(f"Ảnh vượt giới hạn {MAX_IMAGE_BYTES} bytes")
+            chunks.append(chunk)
+        return b"".join(chunks)
+
+    def _get(self, url, validator=None):
+        """GET có timeout và thử lại. Trả về (status, content, etag)"""
+        headers = {"If-None-Match": validator} if validator else {}
+        for attempt in range(IMAGE_FETCH_RETRIES + 1):
+            self._count("requests")
+            try:
+                with self.session.get(url, headers=headers, stream=True,
+                                      timeout=(IMAGE_CONNECT_TIMEOUT, IMAGE_READ_TIMEOUT)) as response:
+                    if response.status_code == 304:
+                        return 304, None, validator
+                    if response.status_code not in RETRY_STATUS:
+                        response.raise_for_status()
+                        content = self._read_body(response)
+                        self._count("bytes", len(content))
+                        return response.status_code, content, response.headers.get("ETag", "")
+                    error = requests.HTTPError(f"HTTP {response.status_code} khi tải {url}")
+            except (requests.ConnectionError, requests.Timeout, requests.exceptions.ChunkedEncodingError) as e:
+                error = e
+            if attempt == IMAGE_FETCH_RETRIES:
+                break
+            self._count("retries")
+            # Full jitter: tránh nhiều thread cùng thử lại một lúc vào CDN
+            time.sleep(random.uniform(0, min(IMAGE_BACKOFF_MAX, IMAGE_BACKOFF_BASE * 2 ** attempt)))
+        raise error
+
+    def fetch(self, url, etag=None):
+        """Tải ảnh. etag: ETag của bản caller đã có; nếu ảnh không đổi trả về FetchResult(not_modified=True)"""
+        try:
+            cached = self.cache.get(url) if self.cache else None
+            if cached and cached[2]:
+                self._count("cache_hits")
+                if etag and cached[1] == etag:
+                    return FetchResult(etag=etag, not_modified=True)
+                return FetchResult(cached[0], cached[1])
+
+            validator = etag or (cached[1] if cached else None)
+            status, content, new_etag = self._get(url, validator)
+            if status == 304:
+                self._count("not_modified")
+                if etag:
+                    return FetchResult(etag=etag, not_modified=True)
+                self.cache.touch(url)
+                return FetchResult(cached[0], cached[1])
+            if self.cache:
+                self.cache.put(url, content, new_etag)
+            return FetchResult(content, new_etag)
+        except Exception:
+            self._count("errors")
+            raise
+
+    def snapshot(self):
+        with self.lock:
+            return dict(self.stats)
+
+
+fetcher = ImageFetcher()
+fetch_executor = ThreadPoolExecutor(max_workers=IMAGE_FETCH_WORKERS, thread_name_prefix="image-fetch")
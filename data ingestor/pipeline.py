@@ -0,0 +1,305 @@
+import os
+import math
+import time
+import queue
+import threading
+
+from image_fetcher import fetcher
+from data_management import (
+    receive_messages_from_sqs,
+    approximate_queue_depth,
+    start_visibility_heartbeat,
+    in_flight,
+    parse_messages,
+    filter_applied,
+    applied_versions,
+    delete_messages_from_sqs,
+    latest_by_id,
+    stored_fingerprints,
+    download_image_input,
+    encode_changed,
+    write_batch,
+)
+
+# Số thread của từng stage và kích thước hàng đợi giữa các stage
+# Số poller SQS co giãn trong [MIN_POLLERS, FETCH_CONCURRENCY] theo số message đang chờ trong queue
+FETCH_CONCURRENCY = int(os.getenv("FETCH_CONCURRENCY", "4"))
+MIN_POLLERS = int(os.getenv("MIN_POLLERS", "1"))
+MESSAGES_PER_POLLER = int(os.getenv("MESSAGES_PER_POLLER", "100"))
+POLLER_SCALE_INTERVAL = float(os.getenv("POLLER_SCALE_INTERVAL", "15"))
+DOWNLOAD_CONCURRENCY = int(os.getenv("DOWNLOAD_CONCURRENCY", "8"))
+WRITER_CONCURRENCY = int(os.getenv("WRITER_CONCURRENCY", "2"))
+ENCODE_BATCH_SIZE = int(os.getenv("ENCODE_BATCH_SIZE", "16"))
+ENCODE_MAX_WAIT = float(os.getenv("ENCODE_MAX_WAIT", "0.5"))
+QUEUE_SIZE = int(os.getenv("PIPELINE_QUEUE_SIZE", "64"))
+STATS_INTERVAL = float(os.getenv("PIPELINE_STATS_INTERVAL", "30"))
+
+
+class Stage:
+    """Một stage của pipeline: `concurrency` thread lấy item từ input_queue, gọi fn(item) và đẩy
+    các kết quả sang output_queue. Hàng đợi có giới hạn nên stage sau chậm sẽ chặn stage trước (backpressure).
+    Stage không có input_queue là stage nguồn: fn() được gọi liên tục.
+    on_error(input) được gọi khi fn lỗi (ví dụ để trả message về queue)."""
+
+    def __init__(self, name, fn, concurrency=1, input_queue=None, output_queue=None, on_error=None):
+        self.name = name
+        self.fn = fn
+        self.concurrency = concurrency
+        self.input_queue = input_queue
+        self.output_queue = output_queue
+        self.on_error = on_error
+        self.processed = 0
+        self.errors = 0
+        self.busy = 0  # số thread đang chạy fn
+        self.lock = threading.Lock()
+        self.threads = []
+
+    def next_input(self, stop_event):
+        """Trả về input tiếp theo, hoặc None nếu chưa có (để kiểm tra stop_event)"""
+        try:
+            return self.input_queue.get(timeout=1)
+        except queue.Empty:
+            return None
+
+    def emit(self, output, stop_event):
+        while not stop_event.is_set():
+            try:
+                self.output_queue.put(output, timeout=1)
+                return
+            except queue.Full:
+                continue
+
+    def is_active(self, index):
+        return True
+
+    def run(self, stop_event, index=0):
+        while not stop_event.is_set():
+            if not self.is_active(index):
+                # Thread tạm nghỉ (stage đang thu nhỏ), chỉ thức dậy để kiểm tra lại
+                stop_event.wait(1)
+                continue
+            if self.input_queue is None:
+                args = ()
+            else:
+                item = self.next_input(stop_event)
+                if item is None:
+                    continue
+                args = (item,)
+            with self.lock:
+                self.busy += 1
+            try:
+                outputs = self.fn(*args) or []
+            except Exception as e:
+                with self.lock:
+                    self.busy -= 1
+                    self.errors += 1
+                print(f"[{self.name}] Lỗi: {e}")
+                if self.on_error is not None and args:
+                    self.on_error(args[0])
+                elif not args:
+                    # Stage nguồn lỗi (mất kết nối SQS...): chờ một chút thay vì thử lại liên tục
+                    stop_event.wait(1)
+                continue
+            # Stage nguồn đếm số item sinh ra, stage batch đếm số item trong batch
+            if not args:
+                count = len(outputs)
+            else:
+                count = len(args[0]) if isinstance(args[0], list) else 1
+            with self.lock:
+                self.processed += count
+            if self.output_queue is not None:
+                for output in outputs:
+                    self.emit(output, stop_event)
+            # Chỉ hết bận sau khi kết quả đã vào hàng đợi kế tiếp, để "mọi stage rảnh + hàng đợi rỗng" nghĩa là xong
+            with self.lock:
+                self.busy -= 1
+
+    def start(self, stop_event):
+        for i in range(self.concurrency):
+            t = threading.Thread(target=self.run, args=(stop_event, i), name=f"{self.name}-{i}", daemon=True)
+            t.start()
+            self.threads.append(t)
+
+    def queue_depth(self):
+        return self.input_queue.qsize() if self.input_queue is not None else 0
+
+    def idle(self):
+        with self.lock:
+            return self.busy == 0 and self.queue_depth() == 0
+
+
+class BatchStage(Stage):
+    """Stage gom item thành batch: chờ item đầu tiên rồi gom thêm tối đa max_wait giây hoặc đủ batch_size"""
+
+    def __init__(self, name, fn, batch_size, max_wait, **kwargs):
+        super().__init__(name, fn, **kwargs)
+        self.batch_size = batch_size
+        self.max_wait = max_wait
+
+    def next_input(self, stop_event):
+        first = super().next_input(stop_event)
+        if first is None:
+            return None
+        batch = [first]
+        deadline = time.monotonic() + self.max_wait
+        while len(batch) < self.batch_size:
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                break
+            try:
+                batch.append(self.input_queue.get(timeout=remaining))
+            except queue.Empty:
+                break
+        return batch
+
+
+class PollerStage(Stage):
+    """Stage nguồn poll SQS: khởi tạo sẵn `concurrency` thread nhưng chỉ `active` thread đầu tiên chạy.
+    scale() đặt active theo số message đang chờ, mỗi poller gánh khoảng MESSAGES_PER_POLLER message.
+    Poller long poll (SQS_WAIT_TIME) nên giữ ít poller lúc queue rỗng gần như không tốn gì."""
+
+    def __init__(self, name, fn, concurrency, min_active=MIN_POLLERS, **kwargs):
+        super().__init__(name, fn, concurrency, **kwargs)
+        self.min_active = max(1, min(min_active, concurrency))
+        self.active = self.min_active
+        self.queue_backlog = None
+
+    def is_active(self, index):
+        return index < self.active
+
+    def scale(self):
+        self.queue_backlog = approximate_queue_depth()
+        target = math.ceil(self.queue_backlog / MESSAGES_PER_POLLER)
+        active = max(self.min_active, min(self.concurrency, target))
+        if active != self.active:
+            print(f"[{self.name}] {self.queue_backlog} message đang chờ -> {active} poller")
+            self.active = active
+
+    def autoscale(self, stop_event, interval=POLLER_SCALE_INTERVAL):
+        while not stop_event.is_set():
+            try:
+                self.scale()
+            except Exception as e:
+                print(f"[{self.name}] Không đọc được độ sâu queue: {e}")
+            stop_event.wait(interval)
+
+    def start(self, stop_event):
+        super().start(stop_event)
+        t = threading.Thread(target=self.autoscale, args=(stop_event,), name=f"{self.name}-scaler", daemon=True)
+        t.start()
+        self.threads.append(t)
+
+
+# ---- Các hàm xử lý của từng stage ----
+
+def fetch():
+    """Poll SQS, bỏ ngay các bản đã ghi, trả về các work item {file_id, data, message, fingerprint, history_only}"""
+    parsed = parse_messages(receive_messages_from_sqs())
+    try:
+        entries, duplicates, history_only = filter_applied(parsed)
+        if duplicates:
+            delete_messages_from_sqs(duplicates)
+        fingerprints = stored_fingerprints([f for f, _, _ in entries])
+    except Exception:
+        # Milvus lỗi: ngừng gia hạn để SQS giao lại các message này sau visibility timeout
+        in_flight.release([m for _, _, m in parsed])
+        raise
+    return [{
+        "file_id": f, "data": d, "message": m, "fingerprint": fingerprints.get(f),
+        "history_only": applied_versions.key(f, d["last_update"]) in history_only,
+    } for f, d, m in entries]
+
+
+def download(item):
+    """Tải + giải mã ảnh của một sản phẩm (image_input = None nếu dùng lại được vector đang lưu
+    hoặc bản này chỉ cần ghi lịch sử)"""
+    if item["history_only"]:
+        item["image_input"] = None
+    else:
+        item["image_input"] = download_image_input(item["data"], item["fingerprint"])
+    return [item]
+
+
+def encode(items):
+    """Một lần forward cho các sản phẩm đã đổi trong batch (chỉ một thread chạy mô hình)"""
+    entries, superseded = latest_by_id([(it["file_id"], it["data"], it) for it in items])
+    kept = [it for _, _, it in entries]
+    file_ids = [it["file_id"] for it in kept]
+    vectors = encode_changed(file_ids, [it["data"] for it in kept], [it["image_input"] for it in kept])
+    return [{
+        "file_ids": file_ids,
+        "rows": [it["data"] for it in kept],
+        "messages": [it["message"] for it in kept],
+        "superseded": [(file_id, it["message"]) for file_id, it in superseded],
+        "vectors": vectors,
+    }]
+
+
+def store(batch):
+    write_batch(batch["file_ids"], batch["rows"], batch["vectors"], batch["messages"], batch["superseded"])
+    reused = len(batch["file_ids"]) - len(batch["vectors"])
+    print(f"[store] Đã ghi {len(batch['file_ids'])} sản phẩm (dùng lại embedding: {reused})")
+
+
+def release_items(items):
+    """Item lỗi: ngừng gia hạn visibility để SQS giao lại message sau timeout"""
+    items = items if isinstance(items, list) else [items]
+    in_flight.release([it["message"] for it in items])
+
+
+def release_batch(batch):
+    in_flight.release(batch["messages"] + [m for _, m in batch["superseded"]])
+
+
+def build_pipeline():
+    fetched = queue.Queue(maxsize=QUEUE_SIZE)
+    decoded = queue.Queue(maxsize=QUEUE_SIZE)
+    encoded = queue.Queue(maxsize=max(1, QUEUE_SIZE // ENCODE_BATCH_SIZE))
+    return [
+        PollerStage("fetch", fetch, FETCH_CONCURRENCY, output_queue=fetched),
+        Stage("download", download, DOWNLOAD_CONCURRENCY, input_queue=fetched, output_queue=decoded,
+              on_error=release_items),
+        BatchStage("encode", encode, ENCODE_BATCH_SIZE, ENCODE_MAX_WAIT, concurrency=1,
+                   input_queue=decoded, output_queue=encoded, on_error=release_items),
+        Stage("store", store, WRITER_CONCURRENCY, input_queue=encoded, on_error=release_batch),
+    ]
+
+
+def report_stats(stages, stop_event, interval=STATS_INTERVAL):
+    """In định kỳ độ sâu hàng đợi đầu vào và throughput của từng stage"""
+    last = {s.name: 0 for s in stages}
+    last_time = time.monotonic()
+    while not stop_event.wait(interval):
+        now = time.monotonic()
+        elapsed = now - last_time
+        lines = []
+        for s in stages:
+            with s.lock:
+                processed, errors = s.processed, s.errors
+            rate = (processed - last[s.name]) / elapsed
+            last[s.name] = processed
+            lines.append(f"{s.name}: queue={s.queue_depth()} {rate:.2f}/s total={processed} errors={errors}")
+        last_time = now
+        for s in stages:
+            if isinstance(s, PollerStage):
+                lines.append(f"pollers={s.active}/{s.concurrency} sqs_backlog={s.queue_backlog} in_flight={len(in_flight)}")
+        fetch_stats = " ".join(f"{k}={v}" for k, v in fetcher.snapshot().items())
+        dedup_stats = " ".join(f"{k}={v}" for k, v in applied_versions.snapshot().items())
+        print("📊 Pipeline | " + " | ".join(lines) + f" | images: {fetch_stats} | dedup: {dedup_stats}")
+
+
+def run_pipeline(stop_event=None):
+    stop_event = stop_event or threading.Event()
+    # Thread encode là nơi duy nhất chạy mô hình, các stage khác chủ yếu chờ I/O
+    stages = build_pipeline()
+    for s in stages:
+        s.start(stop_event)
+    start_visibility_heartbeat(stop_event)
+    print("Pipeline: " + " -> ".join(f"{s.name}(x{s.concurrency})" for s in stages))
+    try:
+        report_stats(stages, stop_event)
+    except KeyboardInterrupt:
+        stop_event.set()
+    for s in stages:
+        for t in s.threads:
+            t.join()
@@ -0,0 +1,85 @@
+import os
+import sys
+import time
+import multiprocessing
+
+# Chạy nhiều process ingest trên một máy: mỗi process load mô hình một lần, tự mở kết nối Milvus / ES
+# và chạy pipeline của riêng nó. Có thể chạy cùng lệnh trên nhiều node với cùng một queue SQS.
+INGEST_PROCESSES = int(os.getenv("INGEST_PROCESSES", "2"))
+# Danh sách CPU cho từng process, ví dụ "0-7;8-15". Bỏ trống thì chia đều các core cho các process
+INGEST_CPU_SETS = os.getenv("INGEST_CPU_SETS", "")
+
+
+def parse_cpu_set(spec):
+    """'0-3,8' -> {0, 1, 2, 3, 8}"""
+    cpus = set()
+    for part in spec.split(","):
+        part = part.strip()
+        if not part:
+            continue
+        if "-" in part:
+            start, end = part.split("-")
+            cpus.update(range(int(start), int(end) + 1))
+        else:
+            cpus.add(int(part))
+    return cpus
+
+
+def plan_cpu_sets(num_processes, spec=INGEST_CPU_SETS):
+    if spec:
+        sets = [parse_cpu_set(s) for s in spec.split(";") if s.strip()]
+        if len(sets) != num_processes:
+            raise ValueError(f"INGEST_CPU_SETS có {len(sets)} nhóm nhưng INGEST_PROCESSES={num_processes}")
+        return sets
+    available = sorted(os.sched_getaffinity(0)) if hasattr(os, "sched_getaffinity") else list(range(os.cpu_count()))
+    per_process = max(1, len(available) // num_processes)
+    return [set(available[i * per_process:(i + 1) * per_process]) or set(available) for i in range(num_processes)]
+
+
+def run_ingest_process(index, cpus, mode):
+    # Ghim CPU và giới hạn thread trước khi import torch (qua data_management) để các process không tranh core
+    if hasattr(os, "sched_setaffinity"):
+        os.sched_setaffinity(0, cpus)
+    os.environ["OMP_NUM_THREADS"] = str(len(cpus))
+    os.environ["MKL_NUM_THREADS"] = str(len(cpus))
+    import torch
+    torch.set_num_threads(len(cpus))
+
+    print(f"Process {index} (pid {os.getpid()}) dùng CPU {sorted(cpus)}")
+    if mode == "threads":
+        from thread_runner import run_threads
+        run_threads()
+    else:
+        from pipeline import run_pipeline
+        run_pipeline()
+
+
+def run_processes(num_processes=INGEST_PROCESSES, mode="pipeline"):
+    # spawn: mỗi process con import lại module, có mô hình và kết nối riêng (không kế thừa socket của cha)
+    ctx = multiprocessing.get_context("spawn")
+    processes = []
+    for index, cpus in enumerate(plan_cpu_sets(num_processes)):
+        p = ctx.Process(target=run_ingest_process, args=(index, cpus, mode), name=f"ingest-{index}")
+        p.start()
+        processes.append(p)
+
+    try:
+        while True:
+            for i, p in enumerate(processes):
+                if not p.is_alive():
+                    print(f"⚠️ Process {i} đã dừng (exit code {p.exitcode}), khởi động lại...")
+                    cpus = plan_cpu_sets(num_processes)[i]
+                    processes[i] = ctx.Process(target=run_ingest_process, args=(i, cpus, mode), name=f"ingest-{i}")
+                    processes[i].start()
+            time.sleep(5)
+    except KeyboardInterrupt:
+        for p in processes:
+            p.terminate()
+        for p in processes:
+            p.join()
+
+
+if __name__ == "__main__":
+    mode = sys.argv[1] if len(sys.argv) > 1 else "pipeline"
+    print(f"Khởi chạy {INGEST_PROCESSES} process ingest (chế độ {mode})...")
+    run_processes(mode=mode)
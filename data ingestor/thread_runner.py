@@ -1,7 +1,10 @@
+import sys
 import threading
-from data_management import worker
+from data_management import worker, start_visibility_heartbeat
+from pipeline import run_pipeline
 
 def run_threads(num_threads=10):
+    start_visibility_heartbeat()
     threads = []
     for i in range(num_threads):
         t = threading.Thread(target=worker, args=(i,))
@@ -12,5 +15,10 @@ def run_threads(num_threads=10):
         t.join()
 
 if __name__ == "__main__":
-    print("Khởi chạy hệ thống tiêu thụ đa luồng từ SQS...")
-    run_threads()
+    # Mặc định chạy pipeline nhiều stage; "python thread_runner.py threads" để chạy kiểu cũ (mỗi thread làm toàn bộ)
+    if len(sys.argv) > 1 and sys.argv[1] == "threads":
+        print("Khởi chạy hệ thống tiêu thụ đa luồng từ SQS...")
+        run_threads()
+    else:
+        print("Khởi chạy pipeline tiêu thụ SQS: fetch -> download -> encode -> store...")
+        run_pipeline()
@@ -0,0 +1,102 @@
+import os
+import json
+import time
+import argparse
+from pymilvus import Collection
+
+from create_collections import wait_for_milvus
+
+# Nén lịch sử giá / đánh giá cũ:
+#   - điểm cũ hơn HISTORY_RAW_DAYS ngày được gom theo bucket HISTORY_BUCKET_SECONDS giây, mỗi bucket giữ điểm cuối
+#   - các điểm liên tiếp cùng giá trị (dữ liệu ghi trước khi ingestor có change detection) chỉ giữ điểm đầu
+# Lịch sử là chuỗi bậc thang nên giá trị tại mọi thời điểm sau bucket vẫn đúng, chỉ mất độ chi tiết bên trong bucket.
+# Chạy lại nhiều lần không đổi kết quả; nên chạy định kỳ (cron) ngoài giờ cao điểm.
+
+HISTORY_RAW_DAYS = float(os.getenv("HISTORY_RAW_DAYS", "30"))
+HISTORY_BUCKET_SECONDS = int(os.getenv("HISTORY_BUCKET_SECONDS", "86400"))
+
+HISTORY_COLLECTIONS = {
+    "product_price_history": ["price"],
+    "product_review_history": ["rating", "review_count"],
+}
+
+
+def value_key(row, value_fields):
+    # Milvus lưu FLOAT 32-bit, làm tròn để so sánh ổn định
+    return tuple(round(row[f], 4) if isinstance(row[f], float) else row[f] for f in value_fields)
+
+
+def records_to_drop(points, value_fields, bucket_seconds):
+    """points: các điểm của một sản phẩm (trước mốc nén). Trả về record_id cần xóa"""
+    points = sorted(points, key=lambda r: r["timestamp"])
+    last_in_bucket = {}
+    for r in points:
+        last_in_bucket[r["timestamp"] // bucket_seconds] = r
+    kept, previous = set(), None
+    for r in sorted(last_in_bucket.values(), key=lambda r: r["timestamp"]):
+        key = value_key(r, value_fields)
+        if key != previous:
+            kept.add(r["record_id"])
+            previous = key
+    return [r["record_id"] for r in points if r["record_id"] not in kept]
+
+
+def iter_batches(collection, expr, output_fields, batch_size):
+    # query() giới hạn số row mỗi lần gọi, iterator thì không
+    iterator = collection.query_iterator(batch_size=batch_size, expr=expr, output_fields=output_fields)
+    try:
+        while True:
+            rows = iterator.next()
+            if not rows:
+                break
+            yield rows
+    finally:
+        iterator.close()
+
+
+def iter_product_ids(batch_size):
+    info = Collection("product_information")
+    info.load()
+    for rows in iter_batches(info, 'id != ""', ["id"], batch_size):
+        yield [r["id"] for r in rows]
+
+
+def compact_collection(name, value_fields, cutoff, bucket_seconds, batch_size, dry_run=False):
+    collection = Collection(name)
+    collection.load()
+    scanned = dropped = 0
+    for product_ids in iter_product_ids(batch_size):
+        expr = f"product_id in [{', '.join(json.dumps(i) for i in product_ids)}] and timestamp < {cutoff}"
+        fields = ["record_id", "product_id", "timestamp"] + value_fields
+        rows = [r for batch in iter_batches(collection, expr, fields, 5000) for r in batch]
+        by_product = {}
+        for r in rows:
+            by_product.setdefault(r["product_id"], []).append(r)
+        drop = []
+        for points in by_product.values():
+            drop.extend(records_to_drop(points, value_fields, bucket_seconds))
+        scanned += len(rows)
+        dropped += len(drop)
+        if drop and not dry_run:
+            collection.delete(f"record_id in [{', '.join(json.dumps(i) for i in drop)}]")
+    if not dry_run:
+        collection.flush()
+    print(f"✅ {name}: {scanned} điểm cũ, xóa {dropped}{' (dry run)' if dry_run else ''}")
+    return scanned, dropped
+
+
+def compact(raw_days=HISTORY_RAW_DAYS, bucket_seconds=HISTORY_BUCKET_SECONDS, batch_size=500, dry_run=False):
+    wait_for_milvus()
+    cutoff = int(time.time() - raw_days * 86400)
+    for name, value_fields in HISTORY_COLLECTIONS.items():
+        compact_collection(name, value_fields, cutoff, bucket_seconds, batch_size, dry_run)
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Nén lịch sử giá / đánh giá cũ thành bucket thưa hơn")
+    parser.add_argument("--raw-days", type=float, default=HISTORY_RAW_DAYS)
+    parser.add_argument("--bucket-seconds", type=int, default=HISTORY_BUCKET_SECONDS)
+    parser.add_argument("--batch-size", type=int, default=500)
+    parser.add_argument("--dry-run", action="store_true")
+    args = parser.parse_args()
+    compact(args.raw_days, args.bucket_seconds, args.batch_size, args.dry_run)
@@ -16,7 +16,7 @@ INDEX_NAME = "products"
 TEXT_EMBED_DIM = 768
 IMAGE_EMBED_DIM = 768
 COMBINED_EMBED_DIM = 768
-PARTITIONS = ["text_search", "image_search", "combined_search"]
+EMBED_INDEX_PARAMS = {"metric_type": "COSINE", "index_type": "HNSW", "params": {"M": 8, "efConstruction": 64}}
 
 def wait_for_elasticsearch(max_retries=20, wait_seconds=10):
     for i in range(max_retries):
@@ -62,6 +62,31 @@ def create_elasticsearch_index(es):
     es.indices.create(index=INDEX_NAME, body=index_settings)
     print(f"✅ Tạo chỉ mục Elasticsearch '{INDEX_NAME}' thành công.")
 
+def create_embedding_collection(name="product_embedding"):
+    # Mỗi sản phẩm một row duy nhất (không chia partition text/image/combined), ghi bằng một lệnh upsert
+    embed_fields = [
+        FieldSchema(name="id", dtype=DataType.VARCHAR, is_primary=True, max_length=100),
+        FieldSchema(name="text_embedding", dtype=DataType.FLOAT_VECTOR, dim=TEXT_EMBED_DIM),
+        FieldSchema(name="image_embedding", dtype=DataType.FLOAT_VECTOR, dim=IMAGE_EMBED_DIM),
+        FieldSchema(name="combine_embedding", dtype=DataType.FLOAT_VECTOR, dim=COMBINED_EMBED_DIM),
+        # Dấu vân tay của đầu vào đã sinh ra vector: ingestor so khớp để bỏ qua encode khi sản phẩm không đổi
+        FieldSchema(name="image_url", dtype=DataType.VARCHAR, max_length=1000),
+        FieldSchema(name="image_etag", dtype=DataType.VARCHAR, max_length=200),
+        FieldSchema(name="image_hash", dtype=DataType.VARCHAR, max_length=64),
+        FieldSchema(name="title_hash", dtype=DataType.VARCHAR, max_length=64)
+    ]
+    embed_schema = CollectionSchema(embed_fields, description="Embedding sản phẩm", enable_dynamic_field=False)
+    embed_collection = Collection(
+        name=name,
+        schema=embed_schema,
+        shards_num=8,
+        consistency_level="Strong"
+    )
+    for field in ["text_embedding", "image_embedding", "combine_embedding"]:
+        embed_collection.create_index(field_name=field, index_params=EMBED_INDEX_PARAMS)
+    embed_collection.release()
+    return embed_collection
+
 def create_milvus_collections():
     collections = ["product_information", "product_embedding", "product_price_history", "product_review_history"]
     for name in collections:
@@ -98,26 +123,8 @@ def create_milvus_collections():
     print("✅ Tạo collection 'product_information' với index dummy")
 
     # product_embedding
-    embed_fields = [
-        FieldSchema(name="id", dtype=DataType.VARCHAR, is_primary=True, max_length=100),
-        FieldSchema(name="text_embedding", dtype=DataType.FLOAT_VECTOR, dim=TEXT_EMBED_DIM),
-        FieldSchema(name="image_embedding", dtype=DataType.FLOAT_VECTOR, dim=IMAGE_EMBED_DIM),
-        FieldSchema(name="combine_embedding", dtype=DataType.FLOAT_VECTOR, dim=COMBINED_EMBED_DIM)
-    ]
-    embed_schema = CollectionSchema(embed_fields, description="Embedding sản phẩm", enable_dynamic_field=False)
-    embed_collection = Collection(
-        name="product_embedding",
-        schema=embed_schema,
-        shards_num=8,
-        consistency_level="Strong"
-    )
-    for p in PARTITIONS:
-        embed_collection.create_partition(p)
-    index_params = {"metric_type": "COSINE", "index_type": "HNSW", "params": {"M": 8, "efConstruction": 64}}
-    for field in ["text_embedding", "image_embedding", "combine_embedding"]:
-        embed_collection.create_index(field_name=field, index_params=index_params)
-    embed_collection.release()
-    print("✅ Tạo collection 'product_embedding' với index và partition")
+    create_embedding_collection("product_embedding")
+    print("✅ Tạo collection 'product_embedding' với index")
 
     # product_price_history
     price_fields = [
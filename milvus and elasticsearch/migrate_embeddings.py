@@ -0,0 +1,108 @@
+import argparse
+from pymilvus import Collection, utility
+
+from create_collections import wait_for_milvus, create_embedding_collection
+
+# Chuyển product_embedding từ layout cũ (3 partition text_search / image_search / combined_search,
+# mỗi sản phẩm lưu 3 lần với id, id_img, id_comb) sang layout mới: mỗi sản phẩm một row.
+# Collection đã một row / sản phẩm nhưng chưa có các cột fingerprint cũng được chuyển (Milvus không thêm cột
+# vào collection có sẵn được, và ingestor upsert cả các cột này).
+#
+#   1. Tạo collection tạm product_embedding_single (không partition, cùng index)
+#   2. Copy các row của partition text_search (id gốc, chính là row search API đang đọc; layout một row thì
+#      copy toàn bộ) theo từng batch
+#   3. Đổi tên: product_embedding -> product_embedding_legacy, product_embedding_single -> product_embedding
+#   4. (--drop-legacy) xóa collection cũ
+#
+# Copy dùng upsert nên chạy lại sau khi bị ngắt vẫn an toàn. Nên dừng ingestor trong lúc migrate.
+
+SOURCE = "product_embedding"
+TARGET = "product_embedding_single"
+LEGACY = "product_embedding_legacy"
+SOURCE_PARTITION = "text_search"
+FIELDS = ["id", "text_embedding", "image_embedding", "combine_embedding"]
+# Layout cũ không có fingerprint: để trống, ingestor sẽ encode lại và ghi fingerprint ở lần crawl tiếp theo
+FINGERPRINT_FIELDS = ["image_url", "image_etag", "image_hash", "title_hash"]
+
+
+def is_legacy_layout(collection):
+    return any(p.name == SOURCE_PARTITION for p in collection.partitions)
+
+
+def missing_fields(collection):
+    names = {f.name for f in collection.schema.fields}
+    return [f for f in FINGERPRINT_FIELDS if f not in names]
+
+
+def needs_migration(collection):
+    return is_legacy_layout(collection) or bool(missing_fields(collection))
+
+
+def copy_rows(source, target, batch_size):
+    source.load()
+    # Layout 3 partition: chỉ copy partition text_search; layout một row thiếu cột: copy toàn bộ
+    partitions = [SOURCE_PARTITION] if is_legacy_layout(source) else None
+    iterator = source.query_iterator(
+        batch_size=batch_size,
+        expr='id != ""',
+        output_fields=FIELDS,
+        partition_names=partitions,
+    )
+    copied = 0
+    try:
+        while True:
+            rows = iterator.next()
+            if not rows:
+                break
+            columns = [[r[f] for r in rows] for f in FIELDS]
+            target.upsert(columns + [[""] * len(rows) for _ in FINGERPRINT_FIELDS])
+            copied += len(rows)
+            print(f"📦 Đã copy {copied} row")
+    finally:
+        iterator.close()
+    target.flush()
+    return copied
+
+
+def drop_legacy_collection():
+    if utility.has_collection(LEGACY):
+        utility.drop_collection(LEGACY)
+        print(f"🗑️ Đã xóa '{LEGACY}'")
+    else:
+        print(f"ℹ️ Không có '{LEGACY}' để xóa")
+
+
+def migrate(batch_size=1000, drop_legacy=False):
+    wait_for_milvus()
+    source = Collection(SOURCE)
+    if not needs_migration(source):
+        print(f"✅ '{SOURCE}' đã dùng layout một row / sản phẩm có fingerprint, không cần migrate.")
+        # Bước 4 thường chạy riêng sau khi đã kiểm tra layout mới, lúc đó collection đã được migrate
+        if drop_legacy:
+            drop_legacy_collection()
+        return
+
+    if not is_legacy_layout(source):
+        print(f"ℹ️ '{SOURCE}' thiếu cột {', '.join(missing_fields(source))}, chuyển sang schema mới")
+    target = Collection(TARGET) if utility.has_collection(TARGET) else create_embedding_collection(TARGET)
+    copied = copy_rows(source, target, batch_size)
+    print(f"✅ Copy xong {copied} sản phẩm")
+
+    source.release()
+    if utility.has_collection(LEGACY):
+        utility.drop_collection(LEGACY)
+    utility.rename_collection(SOURCE, LEGACY)
+    utility.rename_collection(TARGET, SOURCE)
+    Collection(SOURCE).load()
+    print(f"✅ '{SOURCE}' đã chuyển sang layout mới, bản cũ giữ ở '{LEGACY}'")
+
+    if drop_legacy:
+        drop_legacy_collection()
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description="Gộp 3 partition embedding thành một row mỗi sản phẩm")
+    parser.add_argument("--batch-size", type=int, default=1000)
+    parser.add_argument("--drop-legacy", action="store_true")
+    args = parser.parse_args()
+    migrate(args.batch_size, args.drop_legacy)